@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 13:05:51 2026
+
+Access to the VCT calcification library (report.xlsx and the .zip
+files with the voxels of each calcification).
+
+The report is parsed once and cached on a .npz file next to it
+(report.index.npz), which is rebuilt whenever the report changes (size
+or mtime). Each process then keeps the index in memory, so queries and
+random draws are just array operations.
+
+The voxels are read straight from the .zip member (nothing is extracted
+to disk) and the last calcifications used are kept in memory, already
+reshaped and normalized. If the library was packed into an atlas
+(tools/build_calc_atlas.py), the voxels come from a single memory-mapped
+file instead of one .zip per calcification.
+
+"""
+
+import os
+import zipfile
+import functools
+import numpy as np
+import pandas as pd
+
+# Index of each report loaded on this process
+_indexes = dict()
+
+# Atlas of each calcification folder opened on this process (None if there is none)
+_atlases = dict()
+
+# Number of calcifications kept in memory by load_calc_voxels
+calc_cache_size = 1024
+
+# Atlas files inside the calcification folder: atlas.npy (voxels) and atlas.npz (table)
+atlas_name = 'atlas'
+
+
+def load_calc_index(pathCalcificationsReport):
+
+    """
+    Columns of the calcification report as a dict of arrays.
+    """
+
+    pathCalcificationsReport = os.path.abspath(pathCalcificationsReport)
+
+    stat = os.stat(pathCalcificationsReport)
+    stamp = np.array((stat.st_size, stat.st_mtime_ns), dtype=np.int64)
+
+    if pathCalcificationsReport in _indexes:
+        index = _indexes[pathCalcificationsReport]
+        if np.array_equal(index['_stamp'], stamp):
+            return index
+
+    pathIndex = os.path.splitext(pathCalcificationsReport)[0] + '.index.npz'
+
+    index = None
+
+    if os.path.isfile(pathIndex):
+        with np.load(pathIndex) as npz:
+            if np.array_equal(npz['_stamp'], stamp):
+                index = {key: npz[key] for key in npz.files}
+
+    if index is None:
+
+        df = pd.read_excel(pathCalcificationsReport)
+
+        index = dict()
+        for column in df.columns:
+            values = df[column].to_numpy()
+            # Text columns as fixed size strings, so we do not need pickle
+            if values.dtype == object:
+                values = values.astype(str)
+            index[str(column)] = values
+
+        index['_stamp'] = stamp
+
+        # The cache is optional (e.g. read-only library)
+        try:
+            pathIndex_tmp = '{}.{}.tmp.npz'.format(os.path.splitext(pathIndex)[0], os.getpid())
+            np.savez(pathIndex_tmp, **index)
+            os.replace(pathIndex_tmp, pathIndex)
+        except OSError:
+            pass
+
+    _indexes[pathCalcificationsReport] = index
+
+    return index
+
+
+def filter_calcs(index, calc_type='calc', bb_min=3, bb_max=8):
+
+    """
+    Rows of the index with the given type and a bounding box between
+    bb_min and bb_max voxels on each axis.
+    """
+
+    keep = index['Type'] == calc_type
+
+    for axis in ('X', 'Y', 'Z'):
+        bb_count = index['BB_Count' + axis]
+        keep &= (bb_count >= bb_min) & (bb_count <= bb_max)
+
+    return np.flatnonzero(keep)
+
+
+def sample_calcs(index, candidates, number_calc):
+
+    """
+    Draw number_calc calcifications (with replacement) from the candidate
+    rows. Returns their names, e.g. 'calc_0001_5x4x6', and sizes as
+    (BB_CountZ, BB_CountY, BB_CountX).
+    """
+
+    rows = candidates[np.random.randint(0, candidates.shape[0], number_calc)]
+
+    calc_sizes = np.stack((index['BB_CountZ'][rows],
+                           index['BB_CountY'][rows],
+                           index['BB_CountX'][rows]), axis=-1)
+
+    calc_names = get_calc_names(index, rows)
+
+    return calc_names, calc_sizes
+
+
+def get_calc_names(index, rows):
+
+    """
+    File names (without .zip) of the given rows, e.g. 'calc_0001_5x4x6'.
+    """
+
+    return ['{}_{}x{}x{}'.format(name, x, y, z) for name, x, y, z in zip(index['FileName'][rows],
+                                                                         index['BB_CountX'][rows],
+                                                                         index['BB_CountY'][rows],
+                                                                         index['BB_CountZ'][rows])]
+
+
+@functools.lru_cache(maxsize=calc_cache_size)
+def load_calc_voxels(pathCalcifications, calc_name, calc_size):
+
+    """
+    Voxels of one calcification with the slices on the last axis,
+    normalized so that the maximum of its vertical projection is 1
+    (multiply by the contrast to use it). calc_size is
+    (BB_CountZ, BB_CountY, BB_CountX).
+
+    The returned array is shared by the cache, so it is read-only.
+    """
+
+    atlas = open_calc_atlas(pathCalcifications)
+
+    if atlas is not None and calc_name in atlas:
+        calc_3D = atlas.get(calc_name)
+    else:
+        calc_3D = read_calc_zip(pathCalcifications, calc_name, calc_size)
+
+    # Fix dimensions (slice on last)
+    calc_3D = np.transpose(calc_3D, (1, 2, 0))
+
+    # Normalize by the sum of pixels equal to 1 on a 2D vertical projection
+    calc_3D = (1 / (np.sum(calc_3D, axis=-1).max()/255)) * (calc_3D / calc_3D.max())
+
+    calc_3D.setflags(write=False)
+
+    return calc_3D
+
+
+def read_calc_zip(pathCalcifications, calc_name, calc_size):
+
+    """
+    Raw voxels (uint8, calc_size) of one calcification from its .zip.
+    """
+
+    with zipfile.ZipFile("{}/{}.zip".format(pathCalcifications, calc_name), "r") as zip_ref:
+        calc_3D = zip_ref.read("{}/{}.raw".format(calc_name, calc_name))
+
+    return np.frombuffer(calc_3D, dtype=np.uint8).reshape(calc_size)
+
+#-----------------------------------------------------------------------------#
+#                                                                             #
+#-----------------------------------------------------------------------------#
+
+class CalcAtlas:
+    '''
+
+    Description: Whole calcification library packed in two files: the raw
+    voxels of every calcification, one after the other, in a .npy that is
+    memory-mapped (so all workers share it through the page cache), and a
+    .npz with the offset and shape of each one plus the report columns.
+    The .npz also keeps the size of the .npy it was built with, and the
+    two are checked against each other when opened (they are replaced one
+    after the other by build_calc_atlas).
+
+    Input:
+        - pathAtlas = atlas path without extension, e.g. ".../calc/atlas"
+
+    Usage:
+        atlas = CalcAtlas(pathAtlas)
+        calc_3D = atlas.get('calc_0001_5x4x6')    # (Z, Y, X) uint8 view
+
+    '''
+
+    def __init__(self, pathAtlas):
+
+        self.voxels = np.load(pathAtlas + '.npy', mmap_mode='r')
+
+        with np.load(pathAtlas + '.npz') as npz:
+            self.index = {key: npz[key] for key in npz.files}
+
+        # Offsets of another build (being rebuilt, or a crash between the
+        # two replaces) would give wrong views
+        if 'AtlasSize' not in self.index or int(self.index['AtlasSize']) != self.voxels.size:
+            raise ValueError('The offsets of {}.npz do not match {}.npy, rebuild the atlas.'.format(pathAtlas, pathAtlas))
+
+        self._rows = {name: row for row, name in enumerate(self.index['CalcName'])}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, calc_name):
+        return calc_name in self._rows
+
+    def get(self, calc_name):
+        """Raw voxels (Z, Y, X) of one calcification. It is a read-only view on the memmap."""
+
+        row = self._rows[calc_name]
+
+        offset = self.index['AtlasOffset'][row]
+        shape = tuple(self.index['AtlasShape'][row])
+
+        return self.voxels[offset:offset + np.prod(shape)].reshape(shape)
+
+
+def get_atlas_path(pathCalcifications):
+    return os.path.join(pathCalcifications, atlas_name)
+
+
+def open_calc_atlas(pathCalcifications):
+
+    """
+    Atlas of a calcification folder, opened once per process. None if the
+    folder was not packed, or its two files do not match.
+    """
+
+    if pathCalcifications not in _atlases:
+
+        pathAtlas = get_atlas_path(pathCalcifications)
+
+        _atlases[pathCalcifications] = None
+
+        if os.path.isfile(pathAtlas + '.npy') and os.path.isfile(pathAtlas + '.npz'):
+            try:
+                _atlases[pathCalcifications] = CalcAtlas(pathAtlas)
+            except ValueError as e:
+                # The .zip files are read instead
+                print(e)
+
+    return _atlases[pathCalcifications]
+
+
+def build_calc_atlas(pathCalcifications, pathCalcificationsReport, pathAtlas=None, print_debug=False):
+
+    """
+    Pack every calcification of the report that has a .zip on
+    pathCalcifications into an atlas (see CalcAtlas). Returns the number of
+    calcifications packed.
+    """
+
+    if pathAtlas is None:
+        pathAtlas = get_atlas_path(pathCalcifications)
+
+    index = load_calc_index(pathCalcificationsReport)
+
+    rows = np.arange(index['FileName'].shape[0])
+    calc_names = np.array(get_calc_names(index, rows))
+
+    # Only the calcifications we actually have
+    available = np.array([os.path.isfile("{}/{}.zip".format(pathCalcifications, calc_name)) for calc_name in calc_names], dtype=bool)
+    rows, calc_names = rows[available], calc_names[available]
+
+    shapes = np.stack((index['BB_CountZ'][rows],
+                       index['BB_CountY'][rows],
+                       index['BB_CountX'][rows]), axis=-1).astype(np.int64)
+
+    n_voxels = np.prod(shapes, axis=-1)
+    offsets = np.hstack((0, np.cumsum(n_voxels)[:-1])).astype(np.int64)
+
+    # Write on temporary files, so a partial atlas is never used
+    pathAtlas_tmp = '{}.{}.tmp'.format(pathAtlas, os.getpid())
+
+    atlas_size = max(int(n_voxels.sum()), 1)
+
+    voxels = np.lib.format.open_memmap(pathAtlas_tmp + '.npy', mode='w+', dtype=np.uint8, shape=(atlas_size,))
+
+    for k, calc_name in enumerate(calc_names):
+
+        if print_debug and k % 1000 == 0:
+            print("Packing calcification {}/{}...".format(k, len(calc_names)))
+
+        voxels[offsets[k]:offsets[k] + n_voxels[k]] = read_calc_zip(pathCalcifications, calc_name, tuple(shapes[k])).ravel()
+
+    voxels.flush()
+    del voxels
+
+    table = {key: values[rows] for key, values in index.items() if not key.startswith('_')}
+    table['CalcName'] = calc_names
+    table['AtlasOffset'] = offsets
+    table['AtlasShape'] = shapes
+    table['AtlasSize'] = np.int64(atlas_size)
+
+    np.savez(pathAtlas_tmp + '.npz', **table)
+
+    os.replace(pathAtlas_tmp + '.npy', pathAtlas + '.npy')
+    os.replace(pathAtlas_tmp + '.npz', pathAtlas + '.npz')
+
+    _atlases.pop(pathCalcifications, None)
+
+    return len(calc_names)
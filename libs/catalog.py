@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:41:26 2026
+
+Header catalog of the cohort. The headers of every projection are parsed
+once (stop_before_pixels, on a pool of worker processes) and the fields
+the pipeline needs are stored in a SQLite file, one row per projection.
+Later runs only parse the files that are new or changed (size or mtime),
+so the stages query the catalog instead of reading Dicom headers again.
+
+"""
+
+import os
+import sqlite3
+import pathlib
+import pydicom
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .jobstore import _Transaction, _placeholders
+
+# Header fields kept for each projection (Dicom keyword, SQLite type)
+header_columns = (('ImageLaterality', 'TEXT'),
+                  ('Laterality', 'TEXT'),
+                  ('ViewPosition', 'TEXT'),
+                  ('PatientOrientation', 'TEXT'),
+                  ('DetectorSecondaryAngle', 'REAL'),
+                  ('PositionerPrimaryAngle', 'REAL'),
+                  ('BodyPartThickness', 'REAL'),
+                  ('Rows', 'INTEGER'),
+                  ('Columns', 'INTEGER'),
+                  ('InstanceNumber', 'INTEGER'),
+                  ('TransferSyntaxUID', 'TEXT'))
+
+_columns = ('path', 'exam_id', 'proj_index', 'size', 'mtime_ns') + tuple(keyword for keyword, _ in header_columns)
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS projections (
+    path                    TEXT PRIMARY KEY,
+    exam_id                 TEXT NOT NULL,
+    proj_index              INTEGER,
+    size                    INTEGER NOT NULL,
+    mtime_ns                INTEGER NOT NULL,
+    {}
+);
+CREATE INDEX IF NOT EXISTS projections_exam ON projections (exam_id, proj_index);
+'''.format(',\n    '.join('{:<23} {}'.format(keyword, sql_type) for keyword, sql_type in header_columns))
+
+
+class HeaderCatalog:
+    '''
+
+    Description: Header fields of every projection of the cohort, stored
+    in SQLite and updated incrementally.
+
+    Input:
+        - path = SQLite file, e.g. "data/catalog.sqlite".
+        - timeout = seconds to wait for a concurrent writer
+
+    Usage:
+        catalog = HeaderCatalog('data/catalog.sqlite')
+        catalog.update(exams)                           # exam folders
+        dcmFiles = catalog.files(exam_id)               # ordered by projection
+        dcmHdrs = catalog.headers(exam_id)              # dicts, same order
+        dcmHdrs[0]['ViewPosition']
+
+    '''
+
+    def __init__(self, path, timeout=60):
+
+        self.path = str(path)
+        self.timeout = timeout
+
+        self._conn = None
+        self._pid = None
+
+        self._connect().executescript(_schema)
+
+    def __getstate__(self):
+        # Connections are not shared between processes
+        return {'path': self.path, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connect(self):
+
+        if self._conn is None or self._pid != os.getpid():
+
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._pid = os.getpid()
+
+        return self._conn
+
+    def _transaction(self):
+        return _Transaction(self._connect())
+
+    #-------------------------------------------------------------------------#
+
+    def update(self, exams, n_workers=None, print_debug=False):
+        """
+        Catalog the .dcm files of the exam folders. Only files that are
+        new or changed since the last update are parsed, and files that
+        are gone are dropped. Returns the number of files parsed.
+        """
+
+        on_disk = dict()
+
+        for exam in exams:
+
+            exam_id = get_exam_id(exam)
+
+            for dcmFile in pathlib.Path(exam).glob('*.dcm'):
+                stat = dcmFile.stat()
+                on_disk[str(dcmFile)] = (exam_id, stat.st_size, stat.st_mtime_ns)
+
+        exam_ids = sorted(set(get_exam_id(exam) for exam in exams))
+
+        stored = dict()
+
+        conn = self._connect()
+        for start in range(0, len(exam_ids), 500):
+            chunk = exam_ids[start:start + 500]
+            for row in conn.execute('SELECT path, size, mtime_ns FROM projections WHERE exam_id IN ({})'.format(_placeholders(chunk)), chunk):
+                stored[row['path']] = (row['size'], row['mtime_ns'])
+
+        paths2read = [path for path, (_, size, mtime_ns) in on_disk.items() if stored.get(path) != (size, mtime_ns)]
+        paths2remove = [path for path in stored if path not in on_disk]
+
+        if print_debug:
+            print("Cataloging {} of {} Dicom files...".format(len(paths2read), len(on_disk)))
+
+        n_workers = n_workers if n_workers is not None else (os.cpu_count() or 1)
+
+        if n_workers == 1 or len(paths2read) < 64:
+            headers = list(map(read_header_fields, paths2read))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                headers = list(executor.map(read_header_fields, paths2read, chunksize=32))
+
+        rows = []
+        for path, header in zip(paths2read, headers):
+            exam_id, size, mtime_ns = on_disk[path]
+            rows.append((path, exam_id, get_proj_index(path), size, mtime_ns) + header)
+
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM projections WHERE path = ?', [(path,) for path in paths2remove])
+            conn.executemany('INSERT OR REPLACE INTO projections ({}) VALUES ({})'.format(', '.join(_columns), _placeholders(_columns)), rows)
+
+        return len(paths2read)
+
+    #-------------------------------------------------------------------------#
+
+    def exam_ids(self):
+        return [row['exam_id'] for row in self._connect().execute('SELECT DISTINCT exam_id FROM projections ORDER BY exam_id')]
+
+    def files(self, exam_id):
+        """Dicom files of one exam, ordered by projection index."""
+
+        return [row['path'] for row in self._connect().execute('SELECT path FROM projections WHERE exam_id = ? ORDER BY proj_index, path',
+                                                                (exam_id,))]
+
+    def headers(self, exam_id):
+        """Header fields (dicts keyed by Dicom keyword) of one exam, in the order of files()."""
+
+        return [dict(row) for row in self._connect().execute('SELECT * FROM projections WHERE exam_id = ? ORDER BY proj_index, path',
+                                                              (exam_id,))]
+
+    def to_dataframe(self):
+        """The whole catalog as a DataFrame."""
+
+        return pd.read_sql_query('SELECT * FROM projections ORDER BY exam_id, proj_index, path', self._connect())
+
+#-----------------------------------------------------------------------------#
+#                                                                             #
+#-----------------------------------------------------------------------------#
+
+def get_exam_id(exam):
+    """Exam ID of an exam folder, e.g. '29738414/903' (the same as main.py)."""
+    return '/'.join(os.path.normpath(str(exam)).split(os.sep)[-2:])
+
+
+def get_proj_index(dcmFile):
+    """Projection index from the file name (last '_' field), None if there is none."""
+
+    try:
+        return int(os.path.basename(dcmFile).split('_')[-1].split('.')[0])
+    except ValueError:
+        return None
+
+
+def read_header_fields(dcmFile):
+
+    """
+    Values of header_columns of one file, read without the pixel data.
+    Unreadable files give None on every field.
+    """
+
+    try:
+        dcmH = pydicom.dcmread(dcmFile, stop_before_pixels=True)
+    except Exception as e:
+        print("Could not read the header of {}: {}".format(dcmFile, e))
+        return len(header_columns) * (None,)
+
+    values = []
+
+    for keyword, sql_type in header_columns:
+
+        if keyword == 'TransferSyntaxUID':
+            value = dcmH.file_meta.get('TransferSyntaxUID') if getattr(dcmH, 'file_meta', None) is not None else None
+        else:
+            value = dcmH.get(keyword)
+
+        if value is None or value == '':
+            values.append(None)
+        elif sql_type == 'REAL':
+            values.append(float(value))
+        elif sql_type == 'INTEGER':
+            values.append(int(value))
+        elif isinstance(value, pydicom.multival.MultiValue):
+            values.append('\\'.join(str(x) for x in value))
+        else:
+            values.append(str(value))
+
+    return tuple(values)
+
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:12:40 2026
+
+Job manifest for the cohort runs. It replaces IDs_processed.txt,
+IDs_processed_recon.txt and status.csv by a single SQLite file with
+one row per exam and stage ('insert', 'recon').
+
+Each process opens its own connection and every state change is one
+short transaction, so several workers (or several runs of main.py)
+can share the same file.
+
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import pathlib
+import pandas as pd
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    exam_id             TEXT NOT NULL,
+    stage               TEXT NOT NULL,
+    state               TEXT NOT NULL DEFAULT 'pending',
+    attempts            INTEGER NOT NULL DEFAULT 0,
+    worker              TEXT,
+    started             REAL,
+    finished            REAL,
+    elapsed             REAL,
+    n_rois_cluster      INTEGER NOT NULL DEFAULT 0,
+    n_rois_no_cluster   INTEGER NOT NULL DEFAULT 0,
+    error               TEXT,
+    PRIMARY KEY (exam_id, stage)
+);
+CREATE INDEX IF NOT EXISTS jobs_stage_state ON jobs (stage, state);
+'''
+
+
+class JobStore:
+    '''
+
+    Description: Per-exam, per-stage job states stored in SQLite.
+
+    Input:
+        - path = SQLite file, e.g. "data/jobs.sqlite".
+        - timeout = seconds to wait for a concurrent writer
+
+    Usage:
+        store = JobStore('data/jobs.sqlite')
+        store.add(ids2run, 'insert')
+        if store.start(current_id, 'insert'):
+            ...
+            store.done(current_id, 'insert')
+
+    '''
+
+    def __init__(self, path, timeout=60):
+
+        self.path = str(path)
+        self.timeout = timeout
+
+        self._conn = None
+        self._pid = None
+
+        self._connect().executescript(_schema)
+
+    def __getstate__(self):
+        # Connections are not shared between processes
+        return {'path': self.path, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connect(self):
+
+        if self._conn is None or self._pid != os.getpid():
+
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._pid = os.getpid()
+
+        return self._conn
+
+    def _transaction(self):
+        return _Transaction(self._connect())
+
+    #-------------------------------------------------------------------------#
+
+    def add(self, exam_ids, stage):
+        """Register exams as pending. Exams already in the store are kept."""
+
+        with self._transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO jobs (exam_id, stage) VALUES (?, ?)',
+                             [(exam_id, stage) for exam_id in exam_ids])
+
+    def start(self, exam_id, stage, retry_failed=False):
+        """
+        Atomically claim one exam. Returns False if it is not pending
+        (e.g., another worker got it first).
+        """
+
+        states = _claimable(retry_failed)
+
+        with self._transaction() as conn:
+            cur = conn.execute('''UPDATE jobs SET state = ?, attempts = attempts + 1, worker = ?,
+                                  started = ?, finished = NULL, elapsed = NULL, error = NULL,
+                                  n_rois_cluster = 0, n_rois_no_cluster = 0
+                                  WHERE exam_id = ? AND stage = ? AND state IN ({})'''.format(_placeholders(states)),
+                               (RUNNING, _worker_name(), time.time(), exam_id, stage) + states)
+
+        return cur.rowcount == 1
+
+    def claim(self, stage, retry_failed=False):
+        """Atomically claim the next pending exam of a stage. Returns None if there is none."""
+
+        states = _claimable(retry_failed)
+
+        with self._transaction() as conn:
+            row = conn.execute('SELECT exam_id FROM jobs WHERE stage = ? AND state IN ({}) ORDER BY exam_id LIMIT 1'.format(_placeholders(states)),
+                               (stage,) + states).fetchone()
+            if row is None:
+                return None
+            conn.execute('''UPDATE jobs SET state = ?, attempts = attempts + 1, worker = ?,
+                            started = ?, finished = NULL, elapsed = NULL, error = NULL,
+                            n_rois_cluster = 0, n_rois_no_cluster = 0
+                            WHERE exam_id = ? AND stage = ?''',
+                         (RUNNING, _worker_name(), time.time(), row['exam_id'], stage))
+
+        return row['exam_id']
+
+    def done(self, exam_id, stage):
+        self._finish(exam_id, stage, DONE, None)
+
+    def fail(self, exam_id, stage, error=None):
+        self._finish(exam_id, stage, FAILED, error)
+
+    def _finish(self, exam_id, stage, state, error):
+
+        now = time.time()
+
+        with self._transaction() as conn:
+            conn.execute('''UPDATE jobs SET state = ?, finished = ?, elapsed = ? - started, error = ?
+                            WHERE exam_id = ? AND stage = ?''',
+                         (state, now, now, error, exam_id, stage))
+
+    def reset(self, stage, states=(RUNNING,)):
+        """Put exams back to pending, e.g., the ones left running by a crashed run."""
+
+        with self._transaction() as conn:
+            conn.execute('UPDATE jobs SET state = ? WHERE stage = ? AND state IN ({})'.format(_placeholders(states)),
+                         (PENDING, stage) + tuple(states))
+
+    def allocate_rois(self, exam_id, stage, n_rois, n_max_rois_cluster):
+        """
+        Decide, atomically over all workers, whether the ROIs of this
+        exam get a cluster. ROIs get a cluster while the ROIs with
+        cluster already allocated in the stage are below n_max_rois_cluster.
+        Returns (n_rois_cluster, n_rois_no_cluster).
+        """
+
+        with self._transaction() as conn:
+
+            n_rois_cluster_total = conn.execute('SELECT COALESCE(SUM(n_rois_cluster), 0) FROM jobs WHERE stage = ?',
+                                                (stage,)).fetchone()[0]
+
+            if n_rois_cluster_total < n_max_rois_cluster:
+                n_rois_cluster, n_rois_no_cluster = n_rois, 0
+            else:
+                n_rois_cluster, n_rois_no_cluster = 0, n_rois
+
+            conn.execute('UPDATE jobs SET n_rois_cluster = ?, n_rois_no_cluster = ? WHERE exam_id = ? AND stage = ?',
+                         (n_rois_cluster, n_rois_no_cluster, exam_id, stage))
+
+        return n_rois_cluster, n_rois_no_cluster
+
+    #-------------------------------------------------------------------------#
+
+    def get(self, exam_id, stage):
+        """Row of one exam as a dict (None if it is not in the store)."""
+
+        row = self._connect().execute('SELECT * FROM jobs WHERE exam_id = ? AND stage = ?', (exam_id, stage)).fetchone()
+
+        return dict(row) if row is not None else None
+
+    def ids(self, stage, state=None):
+        """Exam IDs of a stage, optionally only the ones in a given state."""
+
+        if state is None:
+            rows = self._connect().execute('SELECT exam_id FROM jobs WHERE stage = ?', (stage,))
+        else:
+            rows = self._connect().execute('SELECT exam_id FROM jobs WHERE stage = ? AND state = ?', (stage, state))
+
+        return [row['exam_id'] for row in rows]
+
+    def status(self, stage):
+        """Number of exams per state and the total number of ROIs of a stage."""
+
+        conn = self._connect()
+
+        status = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for row in conn.execute('SELECT state, COUNT(*) AS n FROM jobs WHERE stage = ? GROUP BY state', (stage,)):
+            status[row['state']] = row['n']
+
+        row = conn.execute('''SELECT COALESCE(SUM(n_rois_cluster), 0), COALESCE(SUM(n_rois_no_cluster), 0)
+                              FROM jobs WHERE stage = ?''', (stage,)).fetchone()
+        status['nROIsCluster'], status['nROIsNoCluster'] = row[0], row[1]
+
+        return status
+
+    def to_dataframe(self, stage=None):
+        """The whole manifest (or one stage) as a DataFrame."""
+
+        if stage is None:
+            return pd.read_sql_query('SELECT * FROM jobs', self._connect())
+
+        return pd.read_sql_query('SELECT * FROM jobs WHERE stage = ?', self._connect(), params=(stage,))
+
+    #-------------------------------------------------------------------------#
+
+    def import_legacy(self, stage, path_ids_processed, path_status=None):
+        """
+        Import IDs_processed.txt (and the ROI counts of status.csv) from
+        previous runs. Those exams are marked as done.
+        """
+
+        path_ids_processed = pathlib.Path(path_ids_processed)
+
+        if not path_ids_processed.exists():
+            return
+
+        with path_ids_processed.open('r') as file:
+            ids_processed = [line.strip() for line in file.readlines() if line.strip()]
+
+        rois = dict()
+        if path_status is not None and pathlib.Path(path_status).exists():
+            df = pd.read_csv(path_status)
+            rois = {ID: (int(c), int(nc)) for ID, c, nc in zip(df['ID'], df['nROIsCluster'], df['nROIsNoCluster'])}
+
+        with self._transaction() as conn:
+            for exam_id in ids_processed:
+                n_rois_cluster, n_rois_no_cluster = rois.get(exam_id, (0, 0))
+                conn.execute('''INSERT INTO jobs (exam_id, stage, state, n_rois_cluster, n_rois_no_cluster)
+                                VALUES (?, ?, ?, ?, ?)
+                                ON CONFLICT (exam_id, stage) DO UPDATE SET state = excluded.state,
+                                n_rois_cluster = excluded.n_rois_cluster, n_rois_no_cluster = excluded.n_rois_no_cluster''',
+                             (exam_id, stage, DONE, n_rois_cluster, n_rois_no_cluster))
+
+#-----------------------------------------------------------------------------#
+#                                                                             #
+#-----------------------------------------------------------------------------#
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, so concurrent writers wait for each other."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
+
+
+def _claimable(retry_failed):
+    return (PENDING, FAILED) if retry_failed else (PENDING,)
+
+
+def _placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+def _worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
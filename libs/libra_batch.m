@@ -0,0 +1,27 @@
+function libra_batch(listFile)
+%LIBRA_BATCH Run LIBRA on a list of Dicom files in one MATLAB session
+%   LIBRA_BATCH(LISTFILE) reads LISTFILE, where each line has a Dicom
+%   file and its output folder separated by a tab, and calls
+%   libra(dcmFile, outFolder, 1) for each line. The masks land on
+%   outFolder/Result_Images/Masks_<name>.mat as with single calls.
+%
+%   A file that fails is reported and the remaining ones still run.
+%
+%   See also LIBRA.
+
+fid = fopen(listFile, 'r');
+jobs = textscan(fid, '%s%s', 'Delimiter', '\t', 'Whitespace', '');
+fclose(fid);
+
+dcmFiles = jobs{1};
+outFolders = jobs{2};
+
+for k = 1:numel(dcmFiles)
+    try
+        libra(dcmFiles{k}, outFolders{k}, 1);
+    catch err
+        fprintf('LIBRA failed on %s: %s\n', dcmFiles{k}, err.message);
+    end
+end
+
+end
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:05:52 2026
+
+Sparse container for the cluster mask projections. The masks are zero
+outside the footprint of the inserted clusters, so only those tiles are
+kept, per projection, and a full projection is materialized only when
+it is inserted on the exam.
+
+"""
+
+import numpy as np
+
+
+class SparseMasks:
+    '''
+
+    Description: Mask projections (nv, nu, nProj) stored as tiles,
+    i.e. for each projection a list of (v0, u0, patch) that are added on
+    [v0:v0+h, u0:u0+w]. Tiles may overlap.
+
+    Input:
+        - shape = (nv, nu, nProj) of the dense projections
+
+    Usage:
+        masks = SparseMasks((geo.nv, geo.nu, geo.nProj))
+        masks.add(get_projection_cluster_mask(...))         # once per cluster
+        masks_mtf = masks.filter_mtf(mtf_filter)
+        proj_mask = masks_mtf.dense(ind, normalize=True)
+
+    '''
+
+    def __init__(self, shape):
+
+        self.shape = tuple(int(x) for x in shape)
+        self.tiles = [[] for _ in range(self.shape[-1])]
+
+    @classmethod
+    def from_dense(cls, projs):
+        """One tile per projection holding the whole projection."""
+
+        masks = cls(projs.shape)
+
+        for p in range(projs.shape[-1]):
+            masks.tiles[p].append((0, 0, projs[:,:,p]))
+
+        return masks
+
+    def add(self, projs_footprint):
+        """Add the projections of one cluster, [(v0, u0, patch), ...] one per projection."""
+
+        for p, (v0, u0, patch) in enumerate(projs_footprint):
+            if patch.size:
+                self.tiles[p].append((int(v0), int(u0), np.float32(patch)))
+
+    def filter_mtf(self, mtf_filter, radius=32):
+        """Blurred copy, each tile blurred on its own (see MTFFilter.filter_footprint)."""
+
+        masks_mtf = SparseMasks(self.shape)
+
+        for p, tiles in enumerate(self.tiles):
+            masks_mtf.tiles[p] = mtf_filter.filter_footprint(tiles, self.shape[:2], radius)
+
+        return masks_mtf
+
+    def dense(self, p, normalize=False):
+        """
+        Projection p as a dense (nv, nu) float32 array. With normalize,
+        its absolute value is min-max normalized (all zeros if it is
+        constant). That does not depend on the contrast, so it is done
+        once per projection for the whole contrast sweep.
+        """
+
+        proj = np.zeros(self.shape[:2], dtype=np.float32)
+
+        for v0, u0, patch in self.tiles[p]:
+            proj[v0:v0+patch.shape[0], u0:u0+patch.shape[1]] += patch
+
+        if normalize:
+
+            np.abs(proj, out=proj)
+
+            proj -= proj.min()
+
+            # A constant projection (e.g., no tiles) is all zeros now, and
+            # stays so instead of 0/0
+            proj_max = proj.max()
+            if proj_max > 0:
+                proj /= proj_max
+
+        return proj
+
+    def to_dense(self):
+        """All the projections, (nv, nu, nProj)."""
+
+        return np.stack([self.dense(p) for p in range(self.shape[-1])], axis=-1)
+
+    @property
+    def nbytes(self):
+        return sum(patch.nbytes for tiles in self.tiles for _, _, patch in tiles)
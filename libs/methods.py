@@ -6,21 +6,26 @@ Created on Wed Feb  9 14:17:42 2022
 @author: rodrigo
 """
 
+import os
+import functools
 import numpy as np
 import cv2
-import pandas as pd
-import zipfile
 import pydicom
 import subprocess
+import tempfile
+import pathlib
 import matplotlib.pyplot as plt
 
 from scipy.io import loadmat
-from scipy.stats import multivariate_normal
+from concurrent.futures import ThreadPoolExecutor
 
 from .utilities import makedir, removedir, filesep
+from .segmentation import get_breast_masks_numpy
+from .calc_library import load_calc_index, filter_calcs, sample_calcs, load_calc_voxels
+from .projectors import get_projector, select_projector
+from .mtf import get_mtf_filter
 
 from pydbt.functions.phantoms import phantom3d
-from pydbt.functions.projection_operators import backprojectionDDb_cuda, projectionDD
 from pydbt.parameters.parameterSettings import geometry_settings
 from pydbt.functions.initialConfig import initialConfig
 
@@ -33,6 +38,9 @@ def get_projection_cluster_mask(roi_3D, contrasts_individual, geo, x_clust, y_cl
     """
     Here, we are recreating the volume but now with higher resolution on
     the Z axis.      
+    
+    The cluster is projected only on its footprint on the detector, so it
+    returns, for each projection, (v0, u0, patch) (see libs/masks.py).
     """
     
     if flags['print_debug']:
@@ -68,37 +76,36 @@ def get_projection_cluster_mask(roi_3D, contrasts_individual, geo, x_clust, y_cl
     geo.DAG += vol_z_offset
     
     
-    projs_masks = np.zeros((geo.nv, geo.nu, geo.nProj))
+    # flags['projector'] is resolved by the caller (select_projector)
+    projector = get_projector(flags.get('projector', 'pydbt'), libFiles, flags.get('threads'))
+    
+    # Project all the calcifications (channels of roi_3D) together, in a
+    # single pass with the NumPy projector, one call per channel with pyDBT
+    projs_masks_calcs, projs_masks_calcs_max = projector.project_channels(roi_3D, geo)
     
+    # Each calcification is normalized by its own max and weighted by its contrast
+    weights = np.zeros(len(contrasts_individual))
     
     calc_out = 0
     for idX, contrast_individual in enumerate(contrasts_individual):
-
-        print("Processing calc {}/{}...".format(idX + 1, len(contrasts_individual)))
-        
-        # Create a empty volume specific for that part (calcification cluster)
-        vol = np.zeros((geo.ny, geo.nx, geo.nz))
         
-        # Load the cluster on this volume. Note that Z has the same size
-        vol = roi_3D[..., idX]
-        
-        # Project this volume
-        projs_masks_tmp = projectionDD(np.float64(vol), geo, -1, libFiles)
-        
-        if projs_masks_tmp.max() != 0:
-            projs_masks_tmp = (projs_masks_tmp / projs_masks_tmp.max()) * contrast_individual
-        
-            projs_masks += projs_masks_tmp
+        if projs_masks_calcs_max[idX] != 0:
+            weights[idX] = contrast_individual / projs_masks_calcs_max[idX]
         else:
             print("Calc {}/{} skipped".format(idX+1, len(contrasts_individual)))
             calc_out += 1
-        
-        
-    projs_masks /= projs_masks.max()
+    
+    projs_masks = [(v0, u0, patch @ weights) for v0, u0, patch in projs_masks_calcs]
+    
+    projs_masks_max = max([patch.max() for _, _, patch in projs_masks if patch.size], default=0)
+    
+    if projs_masks_max != 0:
+        for _, _, patch in projs_masks:
+            patch /= projs_masks_max
     
     
     if flags['flip_projection_angle']:
-        projs_masks = np.flip(projs_masks, axis=-1)
+        projs_masks = projs_masks[::-1]
 
     # Refresh backup
     geo.nx = geo_nx
@@ -113,19 +120,59 @@ def get_projection_cluster_mask(roi_3D, contrasts_individual, geo, x_clust, y_cl
 
     return projs_masks
 
+def get_contrast_sweep(dcmData, proj_mask, contrasts, flags):
+    
+    """
+    Emit all contrast levels of one projection at once. The output has
+    shape (n_contrasts, H, W) and is equivalent to running the insertion
+    once per contrast, i.e., dcmData * (1 - contrast * proj_mask) on the
+    columns after bound_X (in the right breast orientation). If proj_mask
+    is None, the projection is just replicated.
+    """
+    
+    contrasts = np.asarray(contrasts, dtype=np.float32)
+    
+    dcmData_sweep = np.repeat(dcmData[np.newaxis].astype(np.float32), contrasts.shape[0], axis=0)
+    
+    if proj_mask is None:
+        return dcmData_sweep
+    
+    # The mask covers the columns after bound_X, i.e., the last
+    # proj_mask.shape[1] columns of the right-oriented projection
+    n_cols = proj_mask.shape[1]
+    
+    # Instead of flipping the projection twice, we flip the mask and
+    # apply it on the mirrored columns
+    if flags['right_breast']:
+        cols = np.s_[dcmData.shape[1] - n_cols:]
+    else:
+        proj_mask = np.fliplr(proj_mask)
+        cols = np.s_[:n_cols]
+    
+    # Attenuation for every contrast level (n_contrasts, H, W)
+    attenuation = 1 - contrasts[:, np.newaxis, np.newaxis] * proj_mask[np.newaxis]
+    
+    dcmData_sweep[:, :, cols] *= attenuation
+    
+    return dcmData_sweep
+
 #-----------------------------------------------------------------------------#
 #                                                                             #
 #-----------------------------------------------------------------------------#
 
-def get_XYZ_cluster_positions(final_mask, mask_breast, bdyThick, buildDir, flags):
+def get_XYZ_cluster_positions(final_mask, mask_breast, bdyThick, buildDir, flags, libFiles=None):
 
     denseThreshold = 0.4
 
     if flags['print_debug']:
         print("Reconstructing density mask and generate random coords for cluster...")
     
-    # Call function for initial configurations
-    libFiles = initialConfig(buildDir=buildDir, createOutFolder=False)
+    projector_name = select_projector(flags.get('projector', 'pydbt'), buildDir)
+
+    # Call function for initial configurations (unless the caller keeps them
+    # loaded), only pyDBT needs them
+    if libFiles is None and projector_name == 'pydbt':
+        libFiles = initialConfig(buildDir=buildDir, createOutFolder=False)
     
     # Create a DBT geometry  
     geo = geometry_settings()
@@ -158,39 +205,26 @@ def get_XYZ_cluster_positions(final_mask, mask_breast, bdyThick, buildDir, flags
 
     geo.detAngle = 0
     
-    vol = backprojectionDDb_cuda(np.float64(final_mask), geo, -1, libFiles)
-    vol_mask = backprojectionDDb_cuda(np.float64(mask_breast), geo, -1, libFiles)
-
-    slice2check = vol[..., geo.nz//2].copy()
-    slice2check_mask = vol_mask[..., geo.nz // 2].copy()
-
-    del vol, vol_mask
+    projector = get_projector(projector_name, libFiles, flags.get('threads'))
+    
+    # Only the middle slice is used
+    slice2check = backproject_slices(final_mask, geo, projector, [geo.nz//2])[..., 0]
+    slice2check_mask = backproject_slices(mask_breast, geo, projector, [geo.nz//2])[..., 0]
 
+    # The thresholds are on pyDBT's scale, the NumPy backprojector is a
+    # mean over the projections as well
     slice2check_bool = slice2check > denseThreshold
     slice2check_mask_bool = slice2check_mask > 0.01
 
-    x_pos, y_pos = [], []
+    # Define the stride based on the overlap
+    stride = max(int(cluster_pixel_size * (1 - flags.get('roi_overlap', 0))), 1)
 
-    # slice2check_bool_copy = 255*np.uint8(slice2check_bool)
-    # slice2check_bool_copy = np.stack((slice2check_bool_copy,) * 3, axis=-1)
+    # Windows with at least 10% of dense tissue, fully inside the breast
+    x_pos, y_pos, _ = find_candidate_windows(slice2check_bool, slice2check_mask_bool, cluster_pixel_size, stride,
+                                             density_fraction=flags.get('roi_density_fraction', 0.1),
+                                             min_spacing=flags.get('roi_min_spacing', 0))
 
-    # Define the stride based on the overlap
-    stride = int(cluster_pixel_size * (1 - 0))
-    mysums = []
-    npixelsroi = cluster_pixel_size ** 2
-    height, width = slice2check_bool.shape[:2]
-    # Slide a window over the image to extract ROIs
-    for y in range(0, height - cluster_pixel_size + 1, stride):
-        for x in range(0, width - cluster_pixel_size + 1, stride):
-            roi = slice2check_bool[y:y+cluster_pixel_size, x:x+cluster_pixel_size]
-            roi_mask = slice2check_mask_bool[y:y+cluster_pixel_size, x:x+cluster_pixel_size]
-            sumroi = np.sum(roi)
-            sumroimask = np.sum(roi_mask == 0)
-            mysums.append(sumroi)
-            if sumroi >= npixelsroi * 0.1 and sumroimask == 0:
-                # cv2.rectangle(slice2check_bool_copy, (x, y), (x + cluster_pixel_size, y + cluster_pixel_size), (0, 255, 0), 2)
-                x_pos.append(int(x+(cluster_pixel_size/2)))
-                y_pos.append(int(y+(cluster_pixel_size/2)))
+    x_pos, y_pos = list(x_pos), list(y_pos)
 
     z_pos = len(x_pos) * [geo.nz//2]
 
@@ -201,93 +235,285 @@ def get_XYZ_cluster_positions(final_mask, mask_breast, bdyThick, buildDir, flags
     
     return (x_pos, y_pos, z_pos), geo, libFiles, bound_X, slice2check_bool
 
+def backproject_slices(projs, geo, projector, slices=None):
+    '''
+    
+    Description: Backproject only some slices of the volume. Each slice is
+    reconstructed as a one-slice volume, shifting the air gap to its
+    height (as get_projection_cluster_mask does to project the cluster),
+    so time and memory do not grow with geo.nz.
+    
+    Input:
+        - projs = projections (nv, nu, nProj)
+        - geo = geometry of the whole volume (restored on return)
+        - projector = see libs/projectors.py
+        - slices = z indexes to reconstruct (defaults to the middle slice)
+    
+    Output:
+        - vol = (ny, nx, len(slices)) volume
+    
+    '''
+    
+    if slices is None:
+        slices = [geo.nz//2]
+    
+    projs = np.float64(projs)
+    
+    vol = np.zeros((geo.ny, geo.nx, len(slices)))
+    
+    # Backup
+    geo_nz = geo.nz
+    geo_DAG = geo.DAG
+    
+    try:
+        for ind, z in enumerate(slices):
+            
+            geo.nz = 1
+            geo.DAG = geo_DAG + z * geo.dz
+            
+            vol[..., ind] = projector.backproject(projs, geo).reshape(geo.ny, geo.nx)
+    finally:
+        # Refresh backup
+        geo.nz = geo_nz
+        geo.DAG = geo_DAG
+    
+    return vol
+
+def find_candidate_windows(dense_bool, mask_bool, window_size, stride=None, density_fraction=0.1, min_spacing=0):
+    '''
+    
+    Description: Slide a square window over a slice and keep the positions
+    with enough dense tissue that are fully inside the breast. Every window
+    sum comes from an integral image (summed-area table), so the cost does
+    not depend on the window size or on the overlap.
+    
+    Input:
+        - dense_bool = dense tissue mask (2D)
+        - mask_bool = breast mask (2D)
+        - window_size = window side (pixels)
+        - stride = step between windows (defaults to window_size, i.e. no overlap)
+        - density_fraction = minimum fraction of dense pixels in the window
+        - min_spacing = minimum distance (pixels) between two picks; the
+          densest windows are kept first. 0 keeps all of them.
+    
+    Output:
+        - x_pos, y_pos = window centers
+        - scores = fraction of dense pixels of each window
+    
+    '''
+    
+    if stride is None:
+        stride = window_size
+    
+    height, width = dense_bool.shape[:2]
+    
+    ys = np.arange(0, height - window_size + 1, stride)
+    xs = np.arange(0, width - window_size + 1, stride)
+    
+    # Sums of all the windows at once
+    sum_dense = window_sums(dense_bool, window_size, ys, xs)
+    sum_mask = window_sums(mask_bool, window_size, ys, xs)
+    
+    npixelsroi = window_size ** 2
+    
+    keep = (sum_dense >= npixelsroi * density_fraction) & (sum_mask == npixelsroi)
+    
+    # Raster order (rows first), as the windows are visited
+    iy, ix = np.nonzero(keep)
+    
+    x_pos = (xs[ix] + window_size/2).astype(int)
+    y_pos = (ys[iy] + window_size/2).astype(int)
+    scores = sum_dense[iy, ix] / npixelsroi
+    
+    if min_spacing > 0 and x_pos.shape[0]:
+        
+        picked = np.zeros(x_pos.shape[0], dtype=bool)
+        
+        # Greedy: densest first, drop the ones too close to a pick
+        for ind in np.argsort(-scores, kind='stable'):
+            dist2 = (x_pos[picked] - x_pos[ind])**2 + (y_pos[picked] - y_pos[ind])**2
+            if not np.any(dist2 < min_spacing**2):
+                picked[ind] = True
+        
+        x_pos, y_pos, scores = x_pos[picked], y_pos[picked], scores[picked]
+    
+    return x_pos, y_pos, scores
+
+def window_sums(img, window_size, ys, xs):
+    '''
+    Sum of img on the windows [y:y+window_size, x:x+window_size] for every
+    y in ys and x in xs, from the integral image.
+    '''
+    
+    integral = np.zeros((img.shape[0]+1, img.shape[1]+1), dtype=np.int64)
+    np.cumsum(np.cumsum(img, axis=0, dtype=np.int64), axis=1, out=integral[1:,1:])
+    
+    y0, x0 = ys[:,None], xs[None,:]
+    y1, x1 = y0 + window_size, x0 + window_size
+    
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
 #-----------------------------------------------------------------------------#
 #                                                                             #
 #-----------------------------------------------------------------------------#
 
-def get_XYZ_calc_positions(number_calc, cluster_size, calc_window, flags):
+def get_XYZ_calc_positions(number_calc, cluster_size, calc_window, flags, rng=None, return_history=False):
     
     if flags['print_debug']:
         print("Generating XYZ positions for each calcification...")
     
-    x_pos = number_calc * [None]
-    y_pos = number_calc * [None]
-    z_pos = number_calc * [None]
-    cluster_PDF_history = number_calc * [None]
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2**32, dtype=np.uint64))
+    
+    positions, cluster_PDF_history = sample_calc_positions(number_calc, cluster_size, calc_window, rng,
+                                                           return_history=return_history)
+    
+    x_pos, y_pos, z_pos = positions[0]
+    
+    if return_history:
+        cluster_PDF_history = cluster_PDF_history[0]
+    
+    return (list(x_pos), list(y_pos), list(z_pos)), cluster_PDF_history
+
+def sample_calc_positions(number_calc, cluster_size, calc_window, rng, batch_size=16, return_history=False):
+    '''
+    
+    Description: XYZ positions of the calcifications of one or several
+    clusters. Each calcification is drawn from the cluster PDF (a gaussian
+    with stdev 30), which is then knocked out around it by the inverted
+    calcification PDF (stdev 15), so the next ones do not overlap.
+    
+    Input:
+        - number_calc = number of calcifications, or one per cluster
+        - cluster_size = cluster PDF size
+        - calc_window = knock out window size
+        - rng = np.random.Generator
+        - batch_size = clusters drawn together (each one keeps a copy of the PDF)
+        - return_history = also return the cluster PDFs after each calcification
+    
+    Output:
+        - positions = (x, y, z) arrays for each cluster
+        - history = cluster PDFs of each cluster (None if not asked)
+    
+    '''
+    
+    number_calc = np.atleast_1d(number_calc).astype(int)
+    
+    positions = []
+    history = [] if return_history else None
+    
+    for start in range(0, number_calc.shape[0], batch_size):
+        
+        batch_positions, batch_history = _sample_calc_positions(number_calc[start:start+batch_size], cluster_size, calc_window, rng, return_history)
         
+        positions += batch_positions
+        
+        if return_history:
+            history += batch_history
+    
+    return positions, history
+
+def _sample_calc_positions(number_calc, cluster_size, calc_window, rng, return_history):
+    
+    n_clusters = number_calc.shape[0]
+    
     microcalc_PDF = gauss3D(calc_window, stdev=15)
     microcalc_PDF = 1 - ((microcalc_PDF - microcalc_PDF.min()) / (microcalc_PDF.max() - microcalc_PDF.min()))
     
-    cluster_PDF = gauss3D(cluster_size, stdev=30)
+    # One (unnormalized) PDF per cluster and its projection along z, which
+    # is updated only where it is knocked out
+    cluster_PDF = np.repeat(_gauss3D(tuple(int(x) for x in cluster_size), 30)[None], n_clusters, axis=0)
+    proj_2D_PDF = np.sum(cluster_PDF, axis=-1)
+    
+    # Knock out window, [index - ceil(w/2), index + floor(w/2))
+    windows = [np.arange(-np.ceil(w/2).astype(int), np.floor(w/2).astype(int)) for w in calc_window]
+    
+    pos = np.zeros((n_clusters, 3, number_calc.max()), dtype=int)
+    history = [number_calc[k] * [None] for k in range(n_clusters)] if return_history else None
+    
+    for calc_n in range(number_calc.max()):
         
-    for calc_n in range(number_calc):
+        active = np.flatnonzero(number_calc > calc_n)
         
-        proj_2D_PDF = np.sum(cluster_PDF, axis=-1)
-        proj_2D_PDF /= proj_2D_PDF.sum()                    # Normalize PDF
+        u = rng.random((active.shape[0], 3))
         
         # Get x index
-        x_pos[calc_n] = getIndex(proj_2D_PDF, cluster_size[0], calc_window[0])
+        x = sample_index(np.sum(proj_2D_PDF[active], axis=1), u[:,0], cluster_size[0], calc_window[0])
         
         # Get y index
-        y_pos[calc_n] = getIndex(proj_2D_PDF[:, x_pos[calc_n]:x_pos[calc_n]+1].T, cluster_size[1], calc_window[1])
+        y = sample_index(proj_2D_PDF[active, :, x], u[:,1], cluster_size[1], calc_window[1])
         
         # Get z index
-        z_pos[calc_n] = getIndex(cluster_PDF[y_pos[calc_n], x_pos[calc_n]:x_pos[calc_n]+1, :], cluster_size[2], calc_window[2])
+        z = sample_index(cluster_PDF[active, y, x, :], u[:,2], cluster_size[2], calc_window[2])
+        
+        pos[active, :, calc_n] = np.stack((x, y, z), axis=-1)
         
         # Update cluster PDF, nocking out where we put the current calcification
-        cluster_PDF[x_pos[calc_n]-np.ceil(calc_window[0]/2).astype(int):x_pos[calc_n]+np.floor(calc_window[0]/2).astype(int), 
-                    y_pos[calc_n]-np.ceil(calc_window[1]/2).astype(int):y_pos[calc_n]+np.floor(calc_window[1]/2).astype(int),
-                    z_pos[calc_n]-np.ceil(calc_window[2]/2).astype(int):z_pos[calc_n]+np.floor(calc_window[2]/2).astype(int)] *= microcalc_PDF
+        ix = (x[:,None] + windows[0])[:,:,None,None]
+        iy = (y[:,None] + windows[1])[:,None,:,None]
+        iz = (z[:,None] + windows[2])[:,None,None,:]
+        ik = active[:,None,None,None]
         
-        # Normalize for PDF
-        cluster_PDF /= cluster_PDF.sum()
+        window_PDF = cluster_PDF[ik, ix, iy, iz]
+        window_PDF_new = window_PDF * microcalc_PDF
         
-        # Store each cluster PDF
-        cluster_PDF_history[calc_n] = cluster_PDF.copy()
+        cluster_PDF[ik, ix, iy, iz] = window_PDF_new
+        proj_2D_PDF[ik[...,0], ix[...,0], iy[...,0]] += np.sum(window_PDF_new, axis=-1) - np.sum(window_PDF, axis=-1)
+        np.maximum(proj_2D_PDF, 0, out=proj_2D_PDF)
         
+        # Store each cluster PDF
+        if return_history:
+            for k in active:
+                history[k][calc_n] = cluster_PDF[k] / cluster_PDF[k].sum()
     
-    return (x_pos, y_pos, z_pos), cluster_PDF_history
-
-def getIndex(cluster_PDF, cluster_size, calc_window):
+    positions = [tuple(pos[k, :, :number_calc[k]]) for k in range(n_clusters)]
     
-    x_PDF = np.sum(cluster_PDF, axis=0)     # Get x-axis PDF
-    x_PDF /= x_PDF.sum()                    # Normalize PDF
+    return positions, history
+
+def sample_index(PDF, u, cluster_size, calc_window):
+    '''
+    Inverse CDF sampling of one index per row of PDF (not normalized), for
+    the uniform draws u, clamped so the calcification window fits on the
+    cluster window.
+    '''
     
-    x_CDF = np.cumsum(x_PDF)
+    n_rows, n = PDF.shape
     
-    # Generate random probability 0-1
-    x_rand = np.random.uniform()
+    CDF = np.cumsum(PDF, axis=-1)
+    CDF /= CDF[:,-1:]
     
-    # Find the index of the corresponding probability in the CDF
-    index = np.where((x_rand >= x_CDF) == False)[0][0]
+    # First index where the CDF is above u. Row k is shifted by k, so all
+    # rows are searched at once on a single increasing array
+    offsets = np.arange(n_rows)
+    index = np.searchsorted((CDF + offsets[:,None]).ravel(), u + offsets, side='right') - offsets * n
+    index = np.clip(index, 0, n - 1)
     
     # Make sure the calcification window fits on the cluster window
-    index = np.min((np.max((index, 1+calc_window//2)), cluster_size - (calc_window//2)))
+    index = np.minimum(np.maximum(index, 1+calc_window//2), cluster_size - (calc_window//2))
     
     return index
 
 def gauss3D(roi_size, stdev):
     '''
-    Source gauss fit : https://stackoverflow.com/a/25723181/8682939
+    Isotropic 3D gaussian centered on the ROI, normalized to sum 1. Same
+    axis order as np.meshgrid, i.e. shape (roi_size[1], roi_size[0], roi_size[2]).
+    Built once per (roi_size, stdev); each call returns a copy.
     '''
     
-    mu = [x // 2 for x in roi_size]
-    
-    xx, yy, zz = np.meshgrid(np.linspace(0,roi_size[0]-1,roi_size[0]), 
-                             np.linspace(0,roi_size[1]-1,roi_size[1]),
-                             np.linspace(0,roi_size[2]-1,roi_size[2]))
-    
-    xyz = np.column_stack([xx.flat, yy.flat, zz.flat])
+    return _gauss3D(tuple(int(x) for x in roi_size), stdev).copy()
 
-    mean_gauss_2d = np.array([mu[0],mu[1],mu[2]])
-    cov_gauss_2d = np.diagflat([stdev**2,stdev**2,stdev**2])
-
-    w = multivariate_normal.pdf(xyz, mean=mean_gauss_2d, cov=cov_gauss_2d)
+@functools.lru_cache(maxsize=16)
+def _gauss3D(roi_size, stdev):
+    
+    # Isotropic covariance, so the gaussian is the outer product of 1D ones
+    gx, gy, gz = [np.exp(-0.5 * ((np.arange(n) - n // 2) / stdev)**2) for n in roi_size]
     
-    w = w.reshape(xx.shape)
+    w = gy[:,None,None] * gx[None,:,None] * gz[None,None,:]
     
     w /= w.sum()
     
+    w.setflags(write=False)
+    
     return w
 
 
@@ -309,7 +535,8 @@ def get_calc_cluster(pathCalcifications, pathCalcificationsReport, number_calc,
     # calcs_3D = number_calc * [calc_3d]
     
     
-    df = pd.read_excel(pathCalcificationsReport)
+    # Parsed once per process (and cached next to the report)
+    calc_index = load_calc_index(pathCalcificationsReport)
 
     # pathCalcifications = pathCalcifications.replace('/calc', '/cluster')
 
@@ -318,13 +545,9 @@ def get_calc_cluster(pathCalcifications, pathCalcificationsReport, number_calc,
     (0.14/0.048)**3
     (0.35/0.048)**3
     '''
-    df = df[df['Type'] == 'calc'] #'cluster']
-    # df = df[(df['nVoxels'] <= 387) & (df['nVoxels'] >= 3)]
-    df = df[(df['BB_CountX'] <= 8) & (df['BB_CountX'] >= 3)]
-    df = df[(df['BB_CountY'] <= 8) & (df['BB_CountY'] >= 3)]
-    df = df[(df['BB_CountZ'] <= 8) & (df['BB_CountZ'] >= 3)]
+    candidates = filter_calcs(calc_index, calc_type='calc', bb_min=3, bb_max=8) #'cluster'
 
-    rand_index = np.random.randint(0, df.shape[0], number_calc)
+    calc_names, calc_sizes = sample_calcs(calc_index, candidates, number_calc)
     
     cluster_size = np.hstack((cluster_size,np.array(number_calc)))
     
@@ -334,31 +557,12 @@ def get_calc_cluster(pathCalcifications, pathCalcificationsReport, number_calc,
 
     for idX, contrast in enumerate(contrasts_local):
         
-        
-        calc_size = (df.iloc[rand_index[idX]]['BB_CountZ'], 
-                     df.iloc[rand_index[idX]]['BB_CountY'], 
-                     df.iloc[rand_index[idX]]['BB_CountX'])
+        calc_size = calc_sizes[idX]
     
-        calc_name = df.iloc[rand_index[idX]]['FileName'] + '_{}x{}x{}'.format(calc_size[2],
-                                                                              calc_size[1],
-                                                                              calc_size[0])
-        
-        # Extract zip in tmp folder
-        zip_ref =  zipfile.ZipFile("{}/{}.zip".format(pathCalcifications,
-                                                      calc_name),"r") 
-        zip_ref.extractall("/tmp")
-        
-        # Read .raw file
-        calc_3D = np.fromfile("/tmp/{}/{}.raw".format(calc_name,calc_name), dtype=np.uint8, sep="")
+        calc_name = calc_names[idX]
         
-        # Reshape it 
-        calc_3D = calc_3D.reshape(calc_size)
-        
-        # Fix dimensions (slice on last)
-        calc_3D = np.transpose(calc_3D, (1, 2, 0))
-        
-        # Normalize by the sum of pixels equal to 1 on a 2D vertical projection
-        calc_3D = (contrast / (np.sum(calc_3D, axis=-1).max()/255)) * (calc_3D / calc_3D.max())
+        # Read from the zip (or from the in-memory cache) and scale by the contrast
+        calc_3D = contrast * load_calc_voxels(pathCalcifications, calc_name, tuple(int(x) for x in calc_size))
         
         roi_3D[x_calc[idX]-(calc_3D.shape[0]//2):x_calc[idX]-(calc_3D.shape[0]//2)+calc_3D.shape[0],
                y_calc[idX]-(calc_3D.shape[1]//2):y_calc[idX]-(calc_3D.shape[1]//2)+calc_3D.shape[1],
@@ -372,10 +576,31 @@ def get_calc_cluster(pathCalcifications, pathCalcificationsReport, number_calc,
 
 def get_breast_masks(dcmFiles, patient_case, pathPatientDensity, pathLibra, pathMatlab, pathAuxLibs, flags):
     
+    """
+    Dense and breast masks of each projection. The backend is chosen by
+    flags['mask_backend']: 'libra' (default, MATLAB) or 'numpy'
+    (in-process, see libs/segmentation.py).
+    """
+    
+    mask_backend = flags.get('mask_backend', 'libra')
+    
+    if mask_backend == 'libra':
+        return get_breast_masks_libra(dcmFiles, patient_case, pathPatientDensity, pathLibra, pathMatlab, pathAuxLibs, flags)
+    elif mask_backend == 'numpy':
+        return get_breast_masks_numpy(dcmFiles, flags)
+    else:
+        raise ValueError('Unknown mask backend: {}'.format(mask_backend))
+
+
+def get_breast_masks_libra(dcmFiles, patient_case, pathPatientDensity, pathLibra, pathMatlab, pathAuxLibs, flags):
+    
         
         path2write_patient_name = "{}{}{}".format(pathPatientDensity , filesep(), "/".join(patient_case.split('/')[-2:]))
         
-        if makedir(path2write_patient_name):
+        makedir(path2write_patient_name)
+        
+        # The folder alone is not enough, LIBRA may have failed on it
+        if libra_masks_found(dcmFiles, path2write_patient_name):
             flag_mask_found = True
         else:
             flag_mask_found = False
@@ -383,6 +608,12 @@ def get_breast_masks(dcmFiles, patient_case, pathPatientDensity, pathLibra, path
             if flags['print_debug']:
                 print("Runing LIBRA to estimate density and breast mask...")
                 
+        if not flag_mask_found or flags['force_libra']:
+            
+            libra_jobs, dcmH = write_libra_inputs(dcmFiles, path2write_patient_name, flags)
+            
+            run_libra(libra_jobs, pathLibra, pathMatlab, pathAuxLibs, flags)
+                
         if flags['print_debug']:
             print("Loading density and breast mask...")
             
@@ -393,72 +624,6 @@ def get_breast_masks(dcmFiles, patient_case, pathPatientDensity, pathLibra, path
         for idX, dcmFile in enumerate(dcmFiles):
             
             ind = int(str(dcmFile).split('/')[-1].split('_')[2].split('.')[0])
-            
-            if not flag_mask_found or flags['force_libra']:
-            
-                dcmH = pydicom.dcmread(str(dcmFile))
-                                                
-                # As we are using DBT, we need to change some header param
-                dcmH.ImagesInAcquisition = '1'
-                # dcmH.Manufacturer = 'GE MEDICAL'
-                
-                if flags['vct_image']:
-                    # Simulate random parameters for VCT data
-                    # ViewPosition
-                    dcmH.add_new((0x0018,0x5101),'CS', 'CC')
-                    # BodyPartThickness
-                    dcmH.add_new((0x0018,0x11A0),'DS', 60)
-                    # CompressionForce
-                    dcmH.add_new((0x0018,0x11A2),'DS', 119.5)
-                    # ExposureTime
-                    dcmH.add_new((0x0018,0x1150),'DS', 770)
-                    # XrayTubeCurrent
-                    dcmH.add_new((0x0018,0x1151),'DS', 100)
-                    # Exposure
-                    dcmH.add_new((0x0018,0x1152),'DS', 87)
-                    # ExposureInuAs
-                    dcmH.add_new((0x0018,0x1153),'DS', 86800)
-                    # kvP
-                    dcmH.add_new((0x0018,0x0060),'DS', 29)               
-                else:
-                    # BodyPartThickness
-                    dcmH.add_new((0x0018,0x11A0),'FL', dcmH.BodyPartThickness)
-                    # CompressionForce
-                    dcmH.add_new((0x0018,0x11A2),'FL', dcmH.CompressionForce)
-                    # ExposureTime
-                    dcmH.add_new((0x0018,0x1150),'FL', dcmH.ExposureTime)
-                    # XrayTubeCurrent
-                    dcmH.add_new((0x0018,0x1151),'FL', dcmH.XRayTubeCurrent)
-                    # Exposure
-                    dcmH.add_new((0x0018,0x1152),'FL', dcmH.Exposure)
-                    # ExposureInuAs
-                    dcmH.add_new((0x0018,0x1153),'FL', dcmH.ExposureInuAs)
-                    # kvP
-                    dcmH.add_new((0x0018,0x0060),'FL', dcmH.KVP)
-
-                dcmH.add_new((0x0008, 0x0068), 'CS', 'FOR PROCESSING')
-
-                dcmFile_tmp = path2write_patient_name + '{}{}.dcm'.format(filesep(), ind)
-                
-                pydicom.dcmwrite(dcmFile_tmp,
-                                 dcmH, 
-                                 write_like_original=True)
-
-                try:
-
-                    subprocess.run("{} -r \"addpath(genpath('{}'));addpath('{}');run('libra_startup');libra('{}', '{}', 1);exit\" -nodisplay -nosplash".format(pathMatlab,
-                                                                  pathLibra,
-                                                                  pathAuxLibs,
-                                                                  dcmFile_tmp,
-                                                                  path2write_patient_name), shell=True)
-                except subprocess.CalledProcessError as e:
-                    # Handle any errors that occur during execution
-                    print("An error occurred while running the MATLAB script:")
-                    print(e)
-                except Exception as e:
-                    # Handle any other unexpected errors
-                    print("An unexpected error occurred:")
-                    print(e)
 
             try:
                 # Read masks from LIBRA
@@ -483,32 +648,259 @@ def get_breast_masks(dcmFiles, patient_case, pathPatientDensity, pathLibra, path
             removedir(path2write_patient_name)
                 
         return mask_dense, mask_breast, bdyThick
+
+
+def libra_masks_found(dcmFiles, path2write_patient_name):
+    
+    """
+    Whether the LIBRA masks (and the body part thickness) of all the
+    projections are on the patient density folder.
+    """
+    
+    path2results = '{}{}Result_Images{}'.format(path2write_patient_name, filesep(), filesep())
+    
+    if not os.path.isfile(path2results + 'bodyPartThickness.npy'):
+        return False
+    
+    for dcmFile in dcmFiles:
+        
+        ind = int(str(dcmFile).split('/')[-1].split('_')[2].split('.')[0])
+        
+        if not os.path.isfile('{}Masks_{}.mat'.format(path2results, ind)):
+            return False
+    
+    return True
+
+
+def write_libra_inputs(dcmFiles, path2write_patient_name, flags):
+    
+    """
+    Write the Dicom files LIBRA reads ({ind}.dcm on the patient density
+    folder). Returns the LIBRA jobs, i.e., (Dicom file, output folder), and
+    the last header read.
+    """
+    
+    libra_jobs = []
+    
+    for dcmFile in dcmFiles:
+        
+        ind = int(str(dcmFile).split('/')[-1].split('_')[2].split('.')[0])
+            
+        dcmH = pydicom.dcmread(str(dcmFile))
+                                        
+        # As we are using DBT, we need to change some header param
+        dcmH.ImagesInAcquisition = '1'
+        # dcmH.Manufacturer = 'GE MEDICAL'
+        
+        if flags['vct_image']:
+            # Simulate random parameters for VCT data
+            # ViewPosition
+            dcmH.add_new((0x0018,0x5101),'CS', 'CC')
+            # BodyPartThickness
+            dcmH.add_new((0x0018,0x11A0),'DS', 60)
+            # CompressionForce
+            dcmH.add_new((0x0018,0x11A2),'DS', 119.5)
+            # ExposureTime
+            dcmH.add_new((0x0018,0x1150),'DS', 770)
+            # XrayTubeCurrent
+            dcmH.add_new((0x0018,0x1151),'DS', 100)
+            # Exposure
+            dcmH.add_new((0x0018,0x1152),'DS', 87)
+            # ExposureInuAs
+            dcmH.add_new((0x0018,0x1153),'DS', 86800)
+            # kvP
+            dcmH.add_new((0x0018,0x0060),'DS', 29)               
+        else:
+            # BodyPartThickness
+            dcmH.add_new((0x0018,0x11A0),'FL', dcmH.BodyPartThickness)
+            # CompressionForce
+            dcmH.add_new((0x0018,0x11A2),'FL', dcmH.CompressionForce)
+            # ExposureTime
+            dcmH.add_new((0x0018,0x1150),'FL', dcmH.ExposureTime)
+            # XrayTubeCurrent
+            dcmH.add_new((0x0018,0x1151),'FL', dcmH.XRayTubeCurrent)
+            # Exposure
+            dcmH.add_new((0x0018,0x1152),'FL', dcmH.Exposure)
+            # ExposureInuAs
+            dcmH.add_new((0x0018,0x1153),'FL', dcmH.ExposureInuAs)
+            # kvP
+            dcmH.add_new((0x0018,0x0060),'FL', dcmH.KVP)
+
+        dcmH.add_new((0x0008, 0x0068), 'CS', 'FOR PROCESSING')
+
+        dcmFile_tmp = path2write_patient_name + '{}{}.dcm'.format(filesep(), ind)
+        
+        pydicom.dcmwrite(dcmFile_tmp,
+                         dcmH, 
+                         write_like_original=True)
+        
+        libra_jobs.append((dcmFile_tmp, path2write_patient_name))
+        
+    return libra_jobs, dcmH
+
+
+def run_libra(libra_jobs, pathLibra, pathMatlab, pathAuxLibs, flags):
+    
+    """
+    Run LIBRA on a list of (Dicom file, output folder). By default, all
+    of them go to one MATLAB session through libra_batch.m, so MATLAB
+    starts only once. With flags['libra_batch'] = False, MATLAB is started
+    once per file. Either way the masks land on
+    {output folder}/Result_Images/Masks_{ind}.mat. Returns False if a
+    MATLAB run failed.
+    """
+    
+    if not libra_jobs:
+        return True
+    
+    if flags.get('libra_batch', True):
+        
+        # One line per job: Dicom file <tab> output folder
+        fd, listFile = tempfile.mkstemp(suffix='.txt', prefix='libra_batch_', dir=libra_jobs[0][1])
+        with os.fdopen(fd, 'w') as file:
+            for dcmFile_tmp, path2write in libra_jobs:
+                file.write("{}\t{}\n".format(dcmFile_tmp, path2write))
+        
+        matlab_cmds = ["libra_batch('{}')".format(listFile)]
+        
+    else:
+        
+        listFile = None
+        
+        matlab_cmds = ["libra('{}', '{}', 1)".format(dcmFile_tmp, path2write) for dcmFile_tmp, path2write in libra_jobs]
+    
+    success = True
+    
+    for matlab_cmd in matlab_cmds:
+    
+        try:
+    
+            subprocess.run("{} -r \"addpath(genpath('{}'));addpath('{}');run('libra_startup');{};exit\" -nodisplay -nosplash".format(pathMatlab,
+                                                          pathLibra,
+                                                          pathAuxLibs,
+                                                          matlab_cmd), shell=True, check=True)
+        except subprocess.CalledProcessError as e:
+            # Handle any errors that occur during execution
+            print("An error occurred while running the MATLAB script:")
+            print(e)
+            success = False
+        except Exception as e:
+            # Handle any other unexpected errors
+            print("An unexpected error occurred:")
+            print(e)
+            success = False
+            
+    if listFile is not None:
+        os.remove(listFile)
+    
+    return success
+
+
+def run_libra_cohort(exams, pathPatientDensity, pathLibra, pathMatlab, pathAuxLibs, flags):
+    
+    """
+    Run LIBRA for all exams that do not have masks yet in one MATLAB
+    session. get_breast_masks then just loads the masks. Returns False if
+    the MATLAB run failed (get_breast_masks then runs LIBRA on the exams
+    whose masks are missing).
+    """
+    
+    libra_jobs = []
+    
+    for exam in exams:
+        
+        path2write_patient_name = "{}{}{}".format(pathPatientDensity , filesep(), "/".join(exam.split('/')[-2:]))
+        
+        makedir(path2write_patient_name)
+        
+        dcmFiles = [str(item) for item in pathlib.Path(exam).glob("*.dcm")]
+        
+        # Masks already there
+        if libra_masks_found(dcmFiles, path2write_patient_name) and not flags['force_libra']:
+            continue
+        
+        exam_jobs, dcmH = write_libra_inputs(dcmFiles, path2write_patient_name, flags)
+        
+        makedir('{}{}Result_Images'.format(path2write_patient_name, filesep()))
+        np.save('{}{}Result_Images{}bodyPartThickness'.format(path2write_patient_name, filesep(), filesep()), np.float32(dcmH.BodyPartThickness))
+        
+        libra_jobs += exam_jobs
+    
+    if flags['print_debug']:
+        print("Runing LIBRA on {} projections of {} exams...".format(len(libra_jobs), len(exams)))
+    
+    return run_libra(libra_jobs, pathLibra, pathMatlab, pathAuxLibs, flags)
     
 #-----------------------------------------------------------------------------#
 #                                                                             #
 #-----------------------------------------------------------------------------#
 
-def process_dense_mask(mask_dense, mask_breast, cluster_size, dcmFiles, flags):
+def get_exam_info(dcmFiles, dcmHdrs=None):
     
-    if flags['print_debug']:
-        print("Processing density and breast mask...")
-    
-    mask_dense = np.stack(mask_dense, axis=-1)
-    mask_breast = np.stack(mask_breast, axis=-1)
+    """
+    Header facts process_dense_mask needs (ImageLaterality and
+    DetectorSecondaryAngle), from the first projection of the exam. If
+    the headers were already parsed (dcmHdrs, same order as dcmFiles,
+    either Datasets or rows of the header catalog), nothing is read;
+    otherwise only the header of that file is.
+    """
     
     indDcm = [idx for idx, dcmFile in enumerate(dcmFiles) if int(str(dcmFile).split('/')[-1].split('_')[1]) == 1][0]
     
-    dcmH = pydicom.dcmread(str(dcmFiles[indDcm]))
+    if dcmHdrs is not None:
+        dcmH = dcmHdrs[indDcm]
+    else:
+        dcmH = pydicom.dcmread(str(dcmFiles[indDcm]), stop_before_pixels=True)
+    
+    exam_info = dict()
+    exam_info['ImageLaterality'] = dcmH.get('ImageLaterality') or ''
+    exam_info['DetectorSecondaryAngle'] = float(dcmH.get('DetectorSecondaryAngle'))
+    
+    return exam_info
+
+
+def erode_rect(img, ksize):
+    """cv2.erode with a (width, height) rectangle, as a row and a column pass."""
+    
+    img = cv2.erode(img, np.ones((1, ksize[0]), dtype=np.uint8))
     
-    if dcmH.ImageLaterality:
+    return cv2.erode(img, np.ones((ksize[1], 1), dtype=np.uint8))
+
+
+def dilate_rect(img, ksize):
+    """cv2.dilate with a (width, height) rectangle, as a row and a column pass."""
+    
+    img = cv2.dilate(img, np.ones((1, ksize[0]), dtype=np.uint8))
+    
+    return cv2.dilate(img, np.ones((ksize[1], 1), dtype=np.uint8))
+
+
+def process_dense_mask(mask_dense, mask_breast, cluster_size, exam_info, flags):
+    
+    """
+    Map of possible cluster positions on each projection, (H, W, nProj):
+    breast mask eroded away from the skin and chest-wall times the dense
+    mask without isolated pixels. Projections are processed on a pool of
+    threads (flags['threads'], all CPUs by default), as OpenCV
+    releases the GIL. exam_info comes from get_exam_info.
+    """
+    
+    if flags['print_debug']:
+        print("Processing density and breast mask...")
+    
+    # One 2D mask per projection from here on
+    mask_dense = list(mask_dense)
+    mask_breast = list(mask_breast)
+    
+    if exam_info['ImageLaterality']:
         
-        if dcmH.ImageLaterality == 'R':
+        if exam_info['ImageLaterality'] == 'R':
             flags['right_breast'] = True
-        elif dcmH.ImageLaterality == 'L':
+        elif exam_info['ImageLaterality'] == 'L':
             flags['right_breast'] = False
     else:
     
-        if np.sum(mask_breast[:,0:10,0]) != 0:
+        if np.sum(mask_breast[0][:,0:10]) != 0:
             flags['right_breast'] = False
             
         else:
@@ -516,12 +908,12 @@ def process_dense_mask(mask_dense, mask_breast, cluster_size, dcmFiles, flags):
             
     if not flags['right_breast']:
         
-        mask_dense = np.fliplr(mask_dense)
-        mask_breast = np.fliplr(mask_breast)
+        mask_dense = [np.fliplr(x) for x in mask_dense]
+        mask_breast = [np.fliplr(x) for x in mask_breast]
      
     flags['flip_projection_angle'] = False
     # Some projections start from positive DetectorSecondaryAngle, so we flip them 
-    if dcmH.DetectorSecondaryAngle > 0:
+    if exam_info['DetectorSecondaryAngle'] > 0:
         
         if not flags['right_breast']:
             flags['flip_projection_angle'] = True
@@ -532,8 +924,8 @@ def process_dense_mask(mask_dense, mask_breast, cluster_size, dcmFiles, flags):
         
         
     if flags['flip_projection_angle']:
-        mask_dense = np.flip(mask_dense, axis=-1)
-        mask_breast = np.flip(mask_breast, axis=-1)
+        mask_dense = mask_dense[::-1]
+        mask_breast = mask_breast[::-1]
         
         
        
@@ -544,7 +936,7 @@ def process_dense_mask(mask_dense, mask_breast, cluster_size, dcmFiles, flags):
                       (-1, 4,-1),
                       (0 ,-1, 0)))
     
-        edges = cv2.filter2D(mask_breast[:,:,0], -1, g)
+        edges = cv2.filter2D(np.ascontiguousarray(mask_breast[0]), -1, g)
             
         lines = cv2.HoughLines(edges,1,np.pi/90,300)
         
@@ -558,7 +950,7 @@ def process_dense_mask(mask_dense, mask_breast, cluster_size, dcmFiles, flags):
             
         elif n_halfpi_lines >= 1:
             
-            img = 255* mask_breast[:,:,0]
+            img = 255* mask_breast[0]
             img = np.tile(np.expand_dims(img, axis=-1), (1,1,3))
             for line in lines:
                 rho,theta = line[0]
@@ -575,35 +967,36 @@ def process_dense_mask(mask_dense, mask_breast, cluster_size, dcmFiles, flags):
     
     
     
-    # Mask erosion to avoid regions too close to the skin, chest-wall and
-    # pectoral muscle
-    mask_breast[:,-1,:] = 0
-    mask_breast[:,0,:] = 0    
-    
     # Element for erosion
     element = cv2.getStructuringElement(shape=cv2.MORPH_ELLIPSE, ksize=(cluster_size[0]//2,cluster_size[1]//2))
-        
-    # Element to removes isolated pixels
-    element1 = cv2.getStructuringElement(cv2.MORPH_RECT, (31,31))
-    element2 = cv2.getStructuringElement(cv2.MORPH_RECT, (30,30))
-    
-    final_mask = np.empty_like(mask_breast)
     
-    for z in range(mask_dense.shape[-1]):
+    final_mask = np.empty(mask_breast[0].shape + (len(mask_breast),), dtype=np.result_type(mask_breast[0], mask_dense[0]))
     
-        # Mask erosion 
-        mask_breast[:,:,z] = cv2.erode(mask_breast[:,:,z], element)
+    def process_projection(z):
+        
+        # Mask erosion to avoid regions too close to the skin, chest-wall and
+        # pectoral muscle (on a copy, the caller keeps its masks)
+        breast = np.array(mask_breast[z])
+        breast[:,-1] = 0
+        breast[:,0] = 0
+        
+        breast = cv2.erode(breast, element)
         
-        # Removes isolated pixels
-        clean_dense_mask = cv2.morphologyEx(mask_dense[:,:,z], cv2.MORPH_CLOSE, element1)
-        clean_dense_mask = cv2.morphologyEx(clean_dense_mask, cv2.MORPH_OPEN, element2)
-        clean_dense_mask = cv2.erode(clean_dense_mask, element2)
+        dense = np.ascontiguousarray(mask_dense[z])
+        
+        # Removes isolated pixels: closing (31x31), opening (30x30) and
+        # erosion (30x30) with rectangles, i.e., row and column passes
+        clean_dense_mask = erode_rect(dilate_rect(dense, (31,31)), (31,31))
+        clean_dense_mask = dilate_rect(erode_rect(clean_dense_mask, (30,30)), (30,30))
+        clean_dense_mask = erode_rect(clean_dense_mask, (30,30))
+        
+        # Map of possible positions
+        final_mask[:,:,z] = breast * (clean_dense_mask * dense)
     
-        mask_dense[:,:,z] = clean_dense_mask * mask_dense[:,:,z]        
+    n_threads = min(flags.get('threads') or os.cpu_count() or 1, len(mask_breast))
     
-            
-    # Map of possible positions
-    final_mask = mask_breast * mask_dense
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(process_projection, range(len(mask_breast))))
     
     return final_mask, flags
 
@@ -615,73 +1008,26 @@ def apply_mtf_mask_projs(projs_masks, n_projs, detector_size, pathMTF, flags):
     
     if flags['print_debug']:
         print("Applying MTF on MC masks...")
-      
-    # Load fiited MTF function
-    f = np.load(pathMTF, allow_pickle=True)[()]
-    
-    nyquist = 1/(2*detector_size)
-    
-     
-    # A vector of distance (measured in pixels) 
-    x = np.linspace(nyquist, 0, projs_masks.shape[1]+1)
-    x = np.hstack((x, x[1:-1][-1::-1]))
-
-    y = np.linspace(nyquist, 0, projs_masks.shape[0]+1)
-    y = np.hstack((y, y[1:-1][-1::-1]))
-
-    xx, yy = np.meshgrid(x, y)
-    
-    # Now find the distance of each element of a square 2D matrix from it's centre
-    ri = np.sqrt(xx**2+yy**2)
-    
-    # Find indexes which are greater than nyquist
-    idx_extra = ri > nyquist
-    
-    # Truncate to max freq
-    ri[idx_extra] = nyquist
     
-    # Evaluate the fitted MTF function on the points
-    mtf_2d = f(ri)
+    # Fitted MTF function and its 2D grid, loaded once per process
+    mtf_filter = get_mtf_filter(pathMTF, detector_size, flags.get('threads') or -1)
     
-    mtf_2d = np.fft.ifftshift(mtf_2d)
+    projs_masks_mtf = mtf_filter.filter(projs_masks, n_projs)
     
-    # mtf_2d = np.real(np.fft.ifft2(mtf_2d))
-    
-    # mtf_2d = mtf_2d / np.sqrt(np.sum(mtf_2d**2))
-    
-    # mtf_2d = np.abs(np.fft.fft2(mtf_2d))
+    return projs_masks_mtf
+
+def apply_mtf_mask_footprints(projs_masks, detector_size, pathMTF, flags):
+    '''
+    Same as apply_mtf_mask_projs, but blurring only around each cluster:
+    projs_masks is a SparseMasks (libs/masks.py) and so is the output.
+    '''
     
-    projs_masks_mtf = np.empty_like(projs_masks)
+    if flags['print_debug']:
+        print("Applying MTF on MC masks (cluster footprints)...")
     
-    pad_i = projs_masks.shape[0] 
-    pad_j = projs_masks.shape[1] 
+    mtf_filter = get_mtf_filter(pathMTF, detector_size, flags.get('threads') or -1)
     
-    for z in range(n_projs):                    
-        
-        # Pad projection space domain
-        projs_mask_pad = np.pad(projs_masks[:,:,z], ((0,pad_i),(0,pad_j)))
-                               
-        # FFT of pad projection
-        projs_mask_pad_fft = np.fft.fft2(projs_mask_pad) 
-        
-        # Get the modulus (we will use on the multiplication)
-        projs_mask_pad_abs = np.abs(projs_mask_pad_fft)
-        # Get the angle (we will keep the same)
-        projs_mask_pad_angle = np.angle(projs_mask_pad_fft)
-        
-        # Multiplication of modulus
-        projs_mask_pad_abs = projs_mask_pad_abs * mtf_2d
-        
-        # Transform polar to rectangular (modulus * np.exp(1j*angles))
-        projs_mask_pad_fft = projs_mask_pad_abs * np.exp(1j*projs_mask_pad_angle)
-        
-        # iFFT
-        projs_mask_pad = np.real(np.fft.ifft2(projs_mask_pad_fft))
-        
-        # Crop projection
-        projs_masks_mtf[:,:,z] = projs_mask_pad[:pad_i, :pad_j] 
-    
-    return projs_masks_mtf
+    return projs_masks.filter_mtf(mtf_filter, flags.get('mtf_psf_radius', 32))
 
 #-----------------------------------------------------------------------------#
 #                                                                             #
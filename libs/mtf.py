@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:12:36 2026
+
+MTF filtering of the cluster mask projections. The MTF is real and
+non-negative, so blurring is a plain multiplication in the frequency
+domain: the transfer function is built once per (shape, detector size)
+and the projections are filtered with float32 real FFTs, several at a
+time and on all cores.
+
+As the masks are zero outside the inserted clusters, they can also be
+blurred only around each cluster footprint, convolving it with the PSF
+(the MTF in the spatial domain) cropped to a small kernel.
+
+The MTF is stored as a table (.npz, see MTFModel) of sampled
+frequencies and values plus its interpolation and metadata, with no
+pickled objects. tools/convert_mtf.py converts the old .npy files.
+
+"""
+
+import numpy as np
+import scipy.fft
+import scipy.signal
+
+from scipy.interpolate import make_interp_spline
+
+# Filters loaded on this process
+_filters = dict()
+
+
+def get_mtf_filter(pathMTF, detector_size, workers=-1):
+
+    """
+    MTF filter of a fitted MTF file, loaded once per process. workers are
+    the FFT threads (-1 for all cores).
+    """
+
+    key = (str(pathMTF), detector_size, workers)
+
+    if key not in _filters:
+        _filters[key] = MTFFilter(load_mtf(pathMTF), detector_size, workers=workers)
+
+    return _filters[key]
+
+
+def load_mtf(pathMTF):
+
+    """
+    Fitted MTF function (callable on frequencies), from a .npz MTF model.
+    """
+
+    if str(pathMTF).endswith('.npy'):
+        raise ValueError('{} is a pickled MTF, convert it with tools/convert_mtf.py.'.format(pathMTF))
+
+    return MTFModel.load(pathMTF)
+
+
+class MTFModel:
+    '''
+
+    Description: Tabulated MTF. It is evaluated with a cubic spline (the
+    same as interp1d(kind='cubic')) or linear interpolation, clamped to
+    the sampled frequencies.
+
+    Input:
+        - freq = sampled frequencies (increasing)
+        - mtf = MTF at each frequency
+        - kind = 'cubic' or 'linear'
+        - vendor = e.g. 'Hologic'
+        - pitch = detector pixel pitch (mm) the MTF was measured with
+
+    Usage:
+        model = MTFModel(freq, mtf, 'cubic', 'Hologic', 0.140)
+        model.save('data/mtf.npz')
+        model = MTFModel.load('data/mtf.npz')
+        mtf_2d = model(ri)
+
+    '''
+
+    def __init__(self, freq, mtf, kind='cubic', vendor='', pitch=np.nan):
+
+        self.freq = np.asarray(freq, dtype=np.float64)
+        self.mtf = np.asarray(mtf, dtype=np.float64)
+        self.kind = str(kind)
+        self.vendor = str(vendor)
+        self.pitch = float(pitch)
+
+        if self.kind == 'cubic':
+            self._spline = make_interp_spline(self.freq, self.mtf, k=3)
+        elif self.kind == 'linear':
+            self._spline = None
+        else:
+            raise ValueError('Unknown MTF interpolation: {}'.format(self.kind))
+
+    def __call__(self, f):
+
+        f = np.clip(f, self.freq[0], self.freq[-1])
+
+        if self._spline is None:
+            return np.interp(f, self.freq, self.mtf)
+
+        return self._spline(f)
+
+    def save(self, path):
+        np.savez(path, freq=self.freq, mtf=self.mtf, kind=self.kind, vendor=self.vendor, pitch=self.pitch)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            return cls(npz['freq'], npz['mtf'], str(npz['kind']), str(npz['vendor']), float(npz['pitch']))
+
+
+class MTFFilter:
+    '''
+
+    Description: Blur images with the detector MTF. The images are zero
+    padded to twice their size, so the blur does not wrap around.
+
+    Input:
+        - mtf = MTF as a function of the frequency (cycles/mm)
+        - detector_size = pixel pitch (mm)
+        - chunk_size = images transformed together (bounds the memory)
+        - workers = FFT threads (-1 for all cores)
+
+    Usage:
+        mtf_filter = MTFFilter(mtf, 0.140)
+        projs_mtf = mtf_filter.filter(projs)        # (H, W, n) float32
+
+    '''
+
+    def __init__(self, mtf, detector_size, chunk_size=4, workers=-1):
+
+        self.mtf = mtf
+        self.detector_size = detector_size
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+        self._transfer_functions = dict()
+        self._psfs = dict()
+
+    def transfer_function(self, shape):
+        """
+        MTF on the rfft2 grid of an image of the given shape padded to
+        twice its size, (2H, W+1).
+        """
+
+        shape = tuple(int(x) for x in shape[:2])
+
+        if shape not in self._transfer_functions:
+
+            pad_i, pad_j = 2 * shape[0], 2 * shape[1]
+
+            nyquist = 1/(2*self.detector_size)
+
+            fy = np.abs(np.fft.fftfreq(pad_i, self.detector_size))
+            fx = np.fft.rfftfreq(pad_j, self.detector_size)
+
+            # Distance of each frequency to the origin, truncated to nyquist
+            ri = np.minimum(np.sqrt(fy[:,None]**2 + fx[None,:]**2), nyquist)
+
+            self._transfer_functions[shape] = np.float32(self.mtf(ri))
+
+        return self._transfer_functions[shape]
+
+    def psf(self, radius):
+        """
+        Point spread function, (2*radius+1, 2*radius+1), centered. It is
+        the inverse FFT of the MTF on a grid a few times larger than the
+        kernel, so the crop only drops its (tiny) tails.
+        """
+
+        if radius not in self._psfs:
+
+            n = int(2**np.ceil(np.log2(max(4 * (2*radius+1), 64))))
+
+            psf = scipy.fft.irfft2(self.transfer_function((n//2, n//2)), s=(n, n))
+            psf = np.fft.fftshift(psf)
+
+            self._psfs[radius] = np.float32(psf[n//2-radius:n//2+radius+1, n//2-radius:n//2+radius+1])
+
+        return self._psfs[radius]
+
+    def filter_footprint(self, projs_footprint, shape, radius=32):
+        """
+        Blur projections given on their footprint, [(v0, u0, patch), ...]
+        (see libs/projectors.py and libs/masks.py). Each patch grows by
+        radius on every side, cropped to the image shape (H, W), as the
+        padded FFT of the whole image would do.
+        """
+
+        kernel = self.psf(radius)
+
+        projs_footprint_mtf = []
+
+        for v0, u0, patch in projs_footprint:
+
+            if not patch.size:
+                projs_footprint_mtf.append((v0, u0, np.float32(patch)))
+                continue
+
+            patch_mtf = scipy.signal.fftconvolve(np.float32(patch), kernel, mode='full')
+
+            # Top left corner of the blurred patch and its part inside the image
+            v0, u0 = v0 - radius, u0 - radius
+
+            i0, j0 = max(0, -v0), max(0, -u0)
+            i1, j1 = min(patch_mtf.shape[0], shape[0] - v0), min(patch_mtf.shape[1], shape[1] - u0)
+
+            projs_footprint_mtf.append((v0 + i0, u0 + j0, patch_mtf[i0:i1, j0:j1]))
+
+        return projs_footprint_mtf
+
+    def filter(self, projs, n_projs=None):
+        """
+        Blur the first n_projs images of the stack (H, W, n), all of them
+        by default.
+        """
+
+        n_projs = projs.shape[-1] if n_projs is None else n_projs
+
+        pad_i, pad_j = 2 * projs.shape[0], 2 * projs.shape[1]
+
+        mtf_2d = self.transfer_function(projs.shape)
+
+        projs_mtf = np.zeros(projs.shape, dtype=np.float32)
+
+        for start in range(0, n_projs, self.chunk_size):
+
+            stop = min(start + self.chunk_size, n_projs)
+
+            chunk = np.moveaxis(projs[:,:,start:stop], -1, 0).astype(np.float32)
+
+            # Zero padded by s
+            chunk_fft = scipy.fft.rfft2(chunk, s=(pad_i, pad_j), workers=self.workers)
+            chunk_fft *= mtf_2d
+
+            chunk = scipy.fft.irfft2(chunk_fft, s=(pad_i, pad_j), workers=self.workers)
+
+            # Crop projection
+            projs_mtf[:,:,start:stop] = np.moveaxis(chunk[:, :projs.shape[0], :projs.shape[1]], 0, -1)
+
+        return projs_mtf
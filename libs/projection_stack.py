@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:02:17 2026
+
+Lazy reader of the projections of an exam (one Dicom file per
+projection). Only the headers are parsed up front. For uncompressed
+transfer syntaxes, each frame is a read-only memory map of the PixelData
+of its file, so nothing is copied until the caller converts or stacks it.
+Compressed files are decoded by pydicom, only when their frame is
+accessed.
+
+"""
+
+import numpy as np
+import pydicom
+
+from pydicom.uid import ImplicitVRLittleEndian, ExplicitVRLittleEndian
+
+# Transfer syntaxes whose PixelData is the raw little-endian frame
+raw_transfer_syntaxes = (ImplicitVRLittleEndian, ExplicitVRLittleEndian)
+
+# Elements larger than this are not read when parsing the headers
+defer_size = 2**16
+
+
+class ProjectionStack:
+    '''
+
+    Description: Projections of an exam as a lazy (rows, columns, n)
+    stack, ordered by the index of each file.
+
+    Input:
+        - dcmFiles = Dicom files, one projection each
+        - index = function of the file name (str) giving the projection
+          index (0 to n-1). None keeps the order of dcmFiles.
+
+    Usage:
+        stack = ProjectionStack(dcmFiles, index=lambda f: int(f.split('_')[-1].split('.')[0]))
+        proj = stack.frame(ind)                      # zero-copy, read-only
+        proj = stack.frame(ind, 'float32')           # converted copy
+        projs = stack.to_array('float32')            # (rows, columns, n)
+        stack.headers[ind].ImageLaterality
+
+    '''
+
+    def __init__(self, dcmFiles, index=None):
+
+        dcmFiles = [str(dcmFile) for dcmFile in dcmFiles]
+
+        if not dcmFiles:
+            raise ValueError('No DICOM files found in the specified path.')
+
+        if index is None:
+            order = list(range(len(dcmFiles)))
+        else:
+            order = [index(dcmFile) for dcmFile in dcmFiles]
+
+        if sorted(order) != list(range(len(dcmFiles))):
+            raise ValueError('Projection indexes are not 0 to {}: {}'.format(len(dcmFiles) - 1, sorted(order)))
+
+        self.files = len(dcmFiles) * [None]
+        self.headers = len(dcmFiles) * [None]
+
+        # (offset, dtype) of the raw PixelData, None if it must be decoded
+        self._layouts = len(dcmFiles) * [None]
+        self._frames = len(dcmFiles) * [None]
+
+        for ind, dcmFile in zip(order, dcmFiles):
+
+            dcmH = pydicom.dcmread(dcmFile, defer_size=defer_size)
+
+            self.files[ind] = dcmFile
+            self.headers[ind] = dcmH
+            self._layouts[ind] = get_raw_layout(dcmH)
+
+        self.shape = (int(self.headers[0].Rows), int(self.headers[0].Columns), len(dcmFiles))
+
+    def __len__(self):
+        return self.shape[-1]
+
+    def __getitem__(self, ind):
+        return self.frame(ind)
+
+    def is_mapped(self, ind):
+        """Whether projection ind is memory-mapped (not decoded)."""
+        return self._layouts[ind] is not None
+
+    def frame(self, ind, dtype=None):
+        """
+        Projection ind, (rows, columns). Without dtype, it is the raw
+        frame (the read-only memory map or the decoded pixel_array), with
+        the dtype pydicom would give. With dtype, a converted copy.
+        """
+
+        layout = self._layouts[ind]
+
+        if layout is None:
+            # Decoded on every access, the caller keeps it if needed
+            frame = pydicom.dcmread(self.files[ind]).pixel_array
+
+        else:
+            # Maps are kept, they cost no memory
+            if self._frames[ind] is None:
+                offset, frame_dtype = layout
+                self._frames[ind] = np.memmap(self.files[ind], dtype=frame_dtype, mode='r', offset=offset,
+                                              shape=(int(self.headers[ind].Rows), int(self.headers[ind].Columns)))
+
+            frame = self._frames[ind]
+
+        return frame if dtype is None else frame.astype(dtype)
+
+    def to_array(self, dtype=None, out=None):
+        """
+        All projections, (rows, columns, n), in one array of the given
+        dtype (the raw one by default). Each frame is copied straight
+        into it.
+        """
+
+        for ind in range(len(self)):
+
+            frame = self.frame(ind)
+
+            if out is None:
+                out = np.empty(self.shape, dtype=frame.dtype if dtype is None else dtype)
+
+            out[:,:,ind] = frame
+
+        return out
+
+
+def get_raw_layout(dcmH):
+
+    """
+    (offset, dtype) of the PixelData of a single frame, uncompressed,
+    grayscale Dicom header, or None if it has to be decoded by pydicom.
+    The header must be read with the PixelData deferred, so its element
+    is still raw and keeps its position on the file.
+    """
+
+    if 'PixelData' not in dcmH or getattr(dcmH, 'file_meta', None) is None:
+        return None
+
+    if dcmH.file_meta.get('TransferSyntaxUID') not in raw_transfer_syntaxes:
+        return None
+
+    if int(dcmH.get('NumberOfFrames', 1) or 1) != 1 or int(dcmH.get('SamplesPerPixel', 1)) != 1:
+        return None
+
+    bits_allocated = int(dcmH.BitsAllocated)
+    signed = int(dcmH.PixelRepresentation) == 1
+
+    # pydicom fixes the sign of signed pixels stored with fewer bits
+    if bits_allocated not in (8, 16, 32) or (signed and int(dcmH.BitsStored) != bits_allocated):
+        return None
+
+    element = dcmH.get_item('PixelData')
+
+    n_bytes = int(dcmH.Rows) * int(dcmH.Columns) * bits_allocated // 8
+
+    # Already converted, undefined length or truncated file
+    if getattr(element, 'value_tell', None) is None or element.length < n_bytes or element.length == 0xFFFFFFFF:
+        return None
+
+    dtype = np.dtype('<{}{}'.format('i' if signed else 'u', bits_allocated // 8))
+
+    return element.value_tell, dtype
@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:20:44 2026
+
+Projection and backprojection operators. The pipeline asks for a
+projector with get_projector and calls project/backproject on it with
+the usual pyDBT geometry (geometry_settings), so the same code runs with:
+
+    - 'pydbt': pyDBT libraries, projectionDD and backprojectionDDb_cuda
+      (needs a GPU).
+    - 'numpy': distance-driven projector/backprojector in NumPy, threaded,
+      for nodes without a GPU.
+    - 'auto': 'pydbt' when a CUDA device is present and pyDBT is built,
+      'numpy' otherwise (resolved by select_projector).
+
+The pipeline defaults to 'pydbt'. 'numpy' and 'auto' are opt-in until the
+NumPy operators are checked against pyDBT on a GPU node
+(tools/bench_projectors.py).
+
+The NumPy operators follow the pyDBT branchless distance-driven method:
+the detector (or voxel) boundaries are mapped through the X-ray source
+onto the other grid and each cell gets the mean value under its
+footprint, read from an integral image. The coordinate system is the
+one of pyDBT's mapBoundaries:
+
+    detector: x = (nu - k) * du, y = (k - nv/2) * dv
+    volume:   x = (nx - k) * dx + x_offset, y = (k - ny/2) * dy + y_offset,
+              z = DAG + dz/2 + k * dz (slice centers)
+
+with the source rotating by tubeAngle around the rotation center, DDR
+above the detector, and the detector by detAngle.
+
+"""
+
+import os
+import pathlib
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Projectors created on this process
+_projectors = dict()
+
+
+def select_projector(name, buildDir):
+
+    """
+    Resolve 'auto' to 'pydbt' when there is a CUDA device and the pyDBT
+    libraries are built on buildDir, 'numpy' otherwise. Other names are
+    returned as they are. Resolve it once, before initialConfig, so nodes
+    that end up on 'numpy' never load pyDBT.
+    """
+
+    if name == 'auto':
+        return 'pydbt' if cuda_available(buildDir) else 'numpy'
+
+    return name
+
+
+def get_projector(name, libFiles=None, n_threads=None):
+
+    """
+    Projector by name ('pydbt' or 'numpy'), created once per process.
+    """
+
+    if name == 'auto':
+        raise ValueError("Resolve 'auto' with select_projector first.")
+
+    key = (name, n_threads)
+
+    if key not in _projectors:
+        if name == 'pydbt':
+            if libFiles is None:
+                raise ValueError('The pydbt projector needs libFiles (initialConfig).')
+            _projectors[key] = PydbtProjector(libFiles)
+        elif name == 'numpy':
+            _projectors[key] = NumpyProjector(n_threads)
+        else:
+            raise ValueError('Unknown projector: {}'.format(name))
+
+    projector = _projectors[key]
+
+    # libFiles are loaded per process, keep the latest
+    if name == 'pydbt' and libFiles is not None:
+        projector.libFiles = libFiles
+
+    return projector
+
+
+def cuda_available(buildDir):
+
+    """
+    True if there is an NVIDIA driver loaded, pyDBT can be imported and
+    its CUDA libraries are built on buildDir.
+    """
+
+    if not os.path.exists('/proc/driver/nvidia/version'):
+        return False
+
+    try:
+        import pydbt.functions.projection_operators  # noqa: F401
+    except ImportError:
+        return False
+
+    return pydbt_built(buildDir)
+
+
+def pydbt_built(buildDir):
+
+    """
+    True if buildDir has the compiled pyDBT projector and backprojector
+    (the shared libraries initialConfig loads).
+    """
+
+    if buildDir is None or not os.path.isdir(buildDir):
+        return False
+
+    libs = [os.path.basename(str(item)).lower() for ext in ('*.so', '*.so.*', '*.dll', '*.dylib')
+            for item in pathlib.Path(buildDir).glob('**/' + ext)]
+
+    has_projector = any('projectiondd' in lib and 'backprojection' not in lib for lib in libs)
+    has_backprojector = any('backprojectiondd' in lib for lib in libs)
+
+    return has_projector and has_backprojector
+
+#-----------------------------------------------------------------------------#
+#                                                                             #
+#-----------------------------------------------------------------------------#
+
+class PydbtProjector:
+    '''
+
+    Description: pyDBT operators, as called before by the pipeline.
+
+    Input:
+        - libFiles = pyDBT libraries (initialConfig)
+
+    '''
+
+    name = 'pydbt'
+
+    def __init__(self, libFiles):
+        self.libFiles = libFiles
+
+    def project(self, vol, geo):
+        from pydbt.functions.projection_operators import projectionDD
+        return projectionDD(np.float64(vol), geo, -1, self.libFiles)
+
+    def backproject(self, projs, geo):
+        from pydbt.functions.projection_operators import backprojectionDDb_cuda
+        return backprojectionDDb_cuda(np.float64(projs), geo, -1, self.libFiles)
+
+    def project_footprint(self, vol, geo):
+        """
+        Same as NumpyProjector.project_footprint. pyDBT projects the whole
+        detector of geo, so it is given the smallest detector around the
+        footprints that keeps the geometry (see get_detector_window).
+        """
+
+        footprints = get_footprints(geo)
+
+        v0, nv, u0, nu = get_detector_window(geo, footprints)
+
+        if not nv or not nu:
+            return [(fv0, fu0, np.zeros((fv1 - fv0, fu1 - fu0))) for fv0, fv1, fu0, fu1 in footprints]
+
+        # Backup
+        geo_nv = geo.nv
+        geo_nu = geo.nu
+
+        try:
+            geo.nv = nv
+            geo.nu = nu
+
+            projs = self.project(vol, geo)
+        finally:
+            # Refresh backup
+            geo.nv = geo_nv
+            geo.nu = geo_nu
+
+        return [(fv0, fu0, projs[fv0-v0:fv1-v0, fu0-u0:fu1-u0, p].copy()) for p, (fv0, fv1, fu0, fu1) in enumerate(footprints)]
+
+    def project_channels(self, vols, geo):
+        """
+        Same as NumpyProjector.project_channels, but one pyDBT call per
+        channel (each on the footprint window only). projectionDD takes a
+        single volume, and placing the channels side by side would change
+        the ray geometry of each one, so only the NumPy projector batches
+        them.
+        """
+
+        channels = [self.project_footprint(vols[..., c], geo) for c in range(vols.shape[-1])]
+
+        patches = [(v0, u0, np.stack([channel[p][2] for channel in channels], axis=-1))
+                   for p, (v0, u0, _) in enumerate(channels[0])]
+
+        return patches, get_channels_max(patches, vols.shape[-1])
+
+
+class NumpyProjector:
+    '''
+
+    Description: Distance-driven projector and backprojector in NumPy.
+    Projections are computed in parallel over the angles and the
+    backprojection in parallel over the slices.
+
+    Input:
+        - n_threads = worker threads (defaults to the number of CPUs)
+
+    Usage:
+        projector = NumpyProjector()
+        projs = projector.project(vol, geo)             # (nv, nu, nProj)
+        vol = projector.backproject(projs, geo)         # (ny, nx, nz)
+
+    '''
+
+    name = 'numpy'
+
+    def __init__(self, n_threads=None):
+        self.n_threads = n_threads if n_threads is not None else (os.cpu_count() or 1)
+
+    def project(self, vol, geo):
+        """
+        Sum over the slices of the mean voxel value under the footprint of
+        each detector pixel.
+        """
+
+        projs = np.zeros((geo.nv, geo.nu, geo.nProj))
+
+        for p, (v0, u0, patch) in enumerate(self.project_footprint(vol, geo)):
+            projs[v0:v0+patch.shape[0], u0:u0+patch.shape[1], p] = patch
+
+        return projs
+
+    def project_footprint(self, vol, geo):
+        """
+        Projection of a small volume (e.g., a calcification cluster) only
+        on its footprint on the detector. Returns, for each projection,
+        (v0, u0, patch), the patch going on projs[v0:v0+h, u0:u0+w, p].
+        The volume may have channels, (ny, nx, nz, n), projected together;
+        the patches are then (h, w, n).
+        """
+
+        vol = np.asarray(vol, dtype=np.float64)
+
+        sources, detectors = get_source_detector(geo)
+        slices_z = get_slices_z(geo)
+        footprints = get_footprints(geo)
+
+        channels = vol.shape[3:]
+
+        integrals = np.zeros((geo.nz, geo.ny+1, geo.nx+1) + channels)
+        for z in range(geo.nz):
+            np.cumsum(np.cumsum(vol[:,:,z], axis=0), axis=1, out=integrals[z,1:,1:])
+
+        patches = geo.nProj * [None]
+
+        def project_angle(p):
+            v0, v1, u0, u1 = footprints[p]
+            patch = np.zeros((v1 - v0, u1 - u0) + channels)
+            if patch.size:
+                for z in range(geo.nz):
+                    rows, cols = map_detector2slice(geo, sources[p], detectors[p], slices_z[z], footprints[p])
+                    add_footprint_mean(patch, integrals[z], rows, cols)
+            patches[p] = (v0, u0, patch)
+
+        self._map(project_angle, range(geo.nProj))
+
+        return patches
+
+    def project_channels(self, vols, geo):
+        """
+        Projection of the channels of vols (ny, nx, nz, n), e.g. each
+        calcification of a cluster, in a single pass over the geometry.
+        Returns the footprint patches (h, w, n) of each projection (see
+        project_footprint) and the maximum of each channel.
+        """
+
+        patches = self.project_footprint(vols, geo)
+
+        return patches, get_channels_max(patches, vols.shape[-1])
+
+    def backproject(self, projs, geo):
+        """
+        Mean over the projections of the mean detector value under the
+        footprint of each voxel.
+        """
+
+        projs = np.asarray(projs, dtype=np.float64)
+
+        sources, detectors = get_source_detector(geo)
+        slices_z = get_slices_z(geo)
+
+        # Integral image of each projection
+        integrals = np.zeros((geo.nProj, geo.nv+1, geo.nu+1))
+        for p in range(geo.nProj):
+            np.cumsum(np.cumsum(projs[:,:,p], axis=0), axis=1, out=integrals[p,1:,1:])
+
+        vol = np.zeros((geo.ny, geo.nx, geo.nz))
+
+        def backproject_slice(z):
+            for p in range(geo.nProj):
+                rows, cols = map_slice2detector(geo, sources[p], detectors[p], slices_z[z])
+                add_footprint_mean(vol[:,:,z], integrals[p], rows, cols)
+
+        self._map(backproject_slice, range(geo.nz))
+
+        vol /= geo.nProj
+
+        return vol
+
+    def _map(self, fn, items):
+
+        items = list(items)
+
+        if self.n_threads == 1 or len(items) == 1:
+            for item in items:
+                fn(item)
+            return
+
+        with ThreadPoolExecutor(max_workers=min(self.n_threads, len(items))) as executor:
+            # list() re-raises the exceptions of the threads
+            list(executor.map(fn, items))
+
+#-----------------------------------------------------------------------------#
+#                                                                             #
+#-----------------------------------------------------------------------------#
+
+def get_source_detector(geo):
+
+    """
+    Source position (x, y, z) and detector frame (center, direction of
+    the rows on the y-z plane) of each projection.
+    """
+
+    DSR = geo.DSD - geo.DDR
+
+    tubeAngle = np.deg2rad(np.linspace(-geo.tubeAngle/2, geo.tubeAngle/2, geo.nProj))
+    detAngle = np.deg2rad(np.linspace(-geo.detAngle/2, geo.detAngle/2, geo.nProj))
+
+    sources = np.zeros((geo.nProj, 3))
+    sources[:,1] = DSR * np.sin(tubeAngle)
+    sources[:,2] = DSR * np.cos(tubeAngle) + geo.DDR
+
+    # Detector rotation around the rotation center (y = 0, z = DDR), in the
+    # same direction as the source
+    detectors = np.zeros((geo.nProj, 4))
+    detectors[:,0] = -geo.DDR * np.sin(detAngle)
+    detectors[:,1] = geo.DDR - geo.DDR * np.cos(detAngle)
+    detectors[:,2] = np.cos(detAngle)
+    detectors[:,3] = -np.sin(detAngle)
+
+    return sources, detectors
+
+
+def get_channels_max(patches, n_channels):
+
+    """
+    Maximum of each channel over all the footprint patches.
+    """
+
+    maxima = [patch.reshape(-1, n_channels).max(axis=0) for _, _, patch in patches if patch.size]
+
+    return np.max(maxima, axis=0) if maxima else np.zeros(n_channels)
+
+
+def get_slices_z(geo):
+    return geo.DAG + geo.dz/2 + np.arange(geo.nz) * geo.dz
+
+
+def get_footprints(geo, margin=1):
+
+    """
+    Bounding box of the volume on the detector for each projection,
+    (v0, v1, u0, u1) so that it is on projs[v0:v1, u0:u1, p].
+    """
+
+    sources, detectors = get_source_detector(geo)
+
+    # Top and bottom of the volume
+    slabs_z = (geo.DAG, geo.DAG + geo.nz * geo.dz)
+
+    footprints = np.zeros((geo.nProj, 4), dtype=int)
+
+    for p in range(geo.nProj):
+
+        rows, cols = zip(*[map_slice2detector(geo, sources[p], detectors[p], z) for z in slabs_z])
+
+        rows = np.hstack(rows)
+        cols = np.hstack([c.ravel() for c in cols])
+
+        footprints[p] = (np.clip(np.floor(rows.min()) - margin, 0, geo.nv),
+                         np.clip(np.ceil(rows.max()) + margin, 0, geo.nv),
+                         np.clip(np.floor(cols.min()) - margin, 0, geo.nu),
+                         np.clip(np.ceil(cols.max()) + margin, 0, geo.nu))
+
+    return footprints
+
+
+def get_detector_window(geo, footprints):
+
+    """
+    Smallest detector, inside the one of geo, that covers all the
+    footprints and has the same geometry: pyDBT has no detector offset, so
+    its columns go from the first one needed to the chest wall (x = 0) and
+    its rows are centered (y = 0). Returns (v0, nv, u0, nu), the window
+    being [v0:v0+nv, u0:u0+nu] of the full detector.
+    """
+
+    footprints = [footprint for footprint in footprints if footprint[1] > footprint[0] and footprint[3] > footprint[2]]
+
+    if not footprints:
+        return 0, 0, 0, 0
+
+    v0, v1, u0, _ = zip(*footprints)
+
+    # Rows symmetric around the center, same parity as geo.nv
+    half = max(geo.nv/2 - min(v0), max(v1) - geo.nv/2)
+    v0 = max(int(np.floor(geo.nv/2 - half)), 0)
+
+    u0 = int(min(u0))
+
+    return v0, geo.nv - 2 * v0, u0, geo.nu - u0
+
+
+def map_detector2slice(geo, source, detector, z, window=None):
+
+    """
+    Detector pixel boundaries, through the source, on the slice at height
+    z, as fractional voxel indexes: rows (nv+1,) and cols (nv+1, nu+1).
+    The magnification depends on the row if the detector is tilted;
+    otherwise cols is (nu+1,). window = (v0, v1, u0, u1) maps only the
+    pixels [v0:v1, u0:u1].
+    """
+
+    sx, sy, sz = source
+    cy, cz, ey, ez = detector
+
+    v0, v1, u0, u1 = window if window is not None else (0, geo.nv, 0, geo.nu)
+
+    det_v = (np.arange(v0, v1+1) - geo.nv/2) * geo.dv
+    det_x = (geo.nu - np.arange(u0, u1+1)) * geo.du
+
+    det_y = cy + det_v * ey
+    det_z = cz + det_v * ez
+
+    t = (z - sz) / (det_z - sz)
+
+    y = sy + (det_y - sy) * t
+
+    # Same magnification for all the rows if the detector is not tilted
+    if ez == 0:
+        x = sx + (det_x - sx) * t[0]
+    else:
+        x = sx + (det_x[None,:] - sx) * t[:,None]
+
+    rows = (y - geo.y_offset) / geo.dy + geo.ny/2
+    cols = geo.nx - (x - geo.x_offset) / geo.dx
+
+    return rows, cols
+
+
+def map_slice2detector(geo, source, detector, z):
+
+    """
+    Voxel boundaries of the slice at height z, through the source, on the
+    detector, as fractional pixel indexes: rows (ny+1,) and cols (ny+1, nx+1),
+    or (nx+1,) if the detector is not tilted.
+    """
+
+    sx, sy, sz = source
+    cy, cz, ey, ez = detector
+
+    vox_y = (np.arange(geo.ny+1) - geo.ny/2) * geo.dy + geo.y_offset
+    vox_x = (geo.nx - np.arange(geo.nx+1)) * geo.dx + geo.x_offset
+
+    # Ray source -> (y, z) against the detector line (cy, cz) + v * (ey, ez)
+    dy, dz = vox_y - sy, z - sz
+    oy, oz = cy - sy, cz - sz
+
+    det = dz * ey - dy * ez
+
+    t = (oz * ey - oy * ez) / det
+    v = (dy * oz - dz * oy) / det
+
+    if ez == 0:
+        x = sx + (vox_x - sx) * t[0]
+    else:
+        x = sx + (vox_x[None,:] - sx) * t[:,None]
+
+    rows = v / geo.dv + geo.nv/2
+    cols = geo.nu - x / geo.du
+
+    return rows, cols
+
+
+def add_footprint_mean(out, integral, rows, cols):
+
+    """
+    out[i, j] += mean of the image under the cell with corners at the
+    fractional indexes (rows[i], cols[i, j]) ... (rows[i+1], cols[i+1, j+1]),
+    the image given by its integral image. cols may also be the same for
+    every row, (n+1,). The image is zero outside its borders, and only the
+    cells that overlap it are computed. The image (and out) may have
+    channels on the trailing axes.
+    """
+
+    n_rows, n_cols = integral.shape[0] - 1, integral.shape[1] - 1
+
+    separable = cols.ndim == 1
+
+    # Cells that overlap the image (indexes are increasing)
+    inside_rows = np.flatnonzero((rows[1:] > 0) & (rows[:-1] < n_rows))
+    if not inside_rows.size:
+        return
+    r0, r1 = inside_rows[0], inside_rows[-1] + 1
+
+    if separable:
+        inside_cols = np.flatnonzero((cols[1:] > 0) & (cols[:-1] < n_cols))
+    else:
+        cols_rows = cols[r0:r1+1]
+        inside_cols = np.flatnonzero(np.any((cols_rows[:,1:] > 0) & (cols_rows[:,:-1] < n_cols), axis=0))
+    if not inside_cols.size:
+        return
+    c0, c1 = inside_cols[0], inside_cols[-1] + 1
+
+    rows = rows[r0:r1+1]
+    cols = cols[c0:c1+1] if separable else cols[r0:r1+1, c0:c1+1]
+
+    # Broadcast over the channels
+    channels = (None,) * (integral.ndim - 2)
+
+    # Footprint area, before clipping to the image
+    if separable:
+        area = np.diff(rows)[:,None] * np.diff(cols)[None,:]
+    else:
+        area = np.diff(rows)[:,None] * 0.5 * (np.diff(cols[:-1], axis=1) + np.diff(cols[1:], axis=1))
+
+    # Interpolate the integral image at the corners, first on the rows...
+    rows = np.clip(rows, 0, n_rows)
+    ind = np.minimum(rows.astype(int), n_rows - 1)
+    frac = (rows - ind)[(slice(None), None) + channels]
+    integral = integral[ind] * (1 - frac) + integral[ind+1] * frac
+
+    # ... and then on the columns (of each row)
+    cols = np.clip(cols, 0, n_cols)
+    ind = np.minimum(cols.astype(int), n_cols - 1)
+    frac = cols - ind
+    if separable:
+        frac = frac[(None, slice(None)) + channels]
+        corners = integral[:, ind] * (1 - frac) + integral[:, ind+1] * frac
+    else:
+        ind, frac = ind[(Ellipsis,) + channels], frac[(Ellipsis,) + channels]
+        corners = np.take_along_axis(integral, ind, axis=1) * (1 - frac) + np.take_along_axis(integral, ind+1, axis=1) * frac
+
+    sums = np.diff(np.diff(corners, axis=0), axis=1)
+
+    out[r0:r1, c0:c1] += sums / area[(Ellipsis,) + channels]
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:40:03 2026
+
+Breast and density segmentation in Python, an alternative to LIBRA
+(flags['mask_backend'] = 'numpy'). It returns the same DenseMask and
+BreastMask arrays get_breast_masks reads from LIBRA, but runs
+in-process on the whole projection stack, so it needs neither MATLAB
+nor the temporary Dicom and .mat files.
+
+"""
+
+import cv2
+import numpy as np
+
+from .projection_stack import ProjectionStack
+
+
+def get_breast_masks_numpy(dcmFiles, flags):
+
+    """
+    Same output as get_breast_masks with LIBRA: lists of dense and breast
+    masks indexed by projection, and the body part thickness.
+    """
+
+    if flags['print_debug']:
+        print("Segmenting density and breast mask...")
+
+    stack = ProjectionStack(dcmFiles, index=lambda dcmFile: int(dcmFile.split('/')[-1].split('_')[2].split('.')[0]))
+
+    projs = stack.to_array()
+
+    mask_breast = segment_breast(projs)
+    mask_dense = segment_dense(projs, mask_breast)
+
+    bdyThick = np.float32(stack.headers[-1].BodyPartThickness)
+
+    mask_dense = [mask_dense[:,:,z] for z in range(mask_dense.shape[-1])]
+    mask_breast = [mask_breast[:,:,z] for z in range(mask_breast.shape[-1])]
+
+    return mask_dense, mask_breast, bdyThick
+
+
+def get_attenuation(projs):
+
+    """
+    Log attenuation of a raw projection stack (H, W, nProj), using the
+    bright background (direct exposure) of each projection as I0.
+    """
+
+    projs = projs.astype(np.float32)
+
+    I0 = np.percentile(projs.reshape(-1, projs.shape[-1])[::16], 99.5, axis=0)
+
+    att = np.log(I0 + 1) - np.log(np.maximum(projs, 0) + 1)
+
+    return np.maximum(att, 0)
+
+
+def segment_breast(projs, ksize=15):
+
+    """
+    Breast mask of each projection: Otsu threshold on the attenuation,
+    opening/closing, largest connected component and hole filling.
+    """
+
+    att = to_uint8(get_attenuation(projs))
+
+    element = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (ksize, ksize))
+
+    mask_breast = np.zeros(att.shape, dtype=np.uint8)
+
+    for z in range(att.shape[-1]):
+
+        _, mask = cv2.threshold(att[:,:,z], 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, element)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, element)
+
+        mask_breast[:,:,z] = fill_holes(largest_component(mask))
+
+    return mask_breast
+
+
+def segment_dense(projs, mask_breast, ksize=5):
+
+    """
+    Dense tissue mask: pixels of the breast that attenuate more than the
+    Otsu threshold of the attenuation inside the breast.
+    """
+
+    att = get_attenuation(projs)
+
+    element = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (ksize, ksize))
+
+    mask_dense = np.zeros(att.shape, dtype=np.uint8)
+
+    for z in range(att.shape[-1]):
+
+        breast = mask_breast[:,:,z].astype(bool)
+
+        if not breast.any():
+            continue
+
+        att_breast = att[:,:,z][breast]
+
+        # Otsu on the breast pixels only
+        att_min, att_max = att_breast.min(), att_breast.max()
+        att_breast = to_uint8(att_breast, att_min, att_max)
+        threshold, _ = cv2.threshold(att_breast.reshape(-1, 1), 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        threshold = att_min + (threshold / 255) * (att_max - att_min)
+
+        mask = np.uint8((att[:,:,z] > threshold) & breast)
+
+        mask_dense[:,:,z] = cv2.morphologyEx(mask, cv2.MORPH_OPEN, element)
+
+    return mask_dense
+
+
+def to_uint8(x, x_min=None, x_max=None):
+
+    x_min = x.min() if x_min is None else x_min
+    x_max = x.max() if x_max is None else x_max
+
+    return np.uint8(255 * (x - x_min) / max(x_max - x_min, 1e-8))
+
+
+def largest_component(mask):
+
+    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+    if n_labels <= 1:
+        return mask
+
+    # Label 0 is the background
+    label = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+
+    return np.uint8(labels == label)
+
+
+def fill_holes(mask):
+
+    # Flood fill the background from the border; what is left are holes
+    background = np.pad(1 - mask, 1, constant_values=1)
+    cv2.floodFill(background, None, (0, 0), 2)
+
+    return np.uint8(background[1:-1, 1:-1] != 2)
@@ -7,11 +7,23 @@ Created on Tue Feb  1 15:15:03 2022
 """
 
 import os
+import io
+import copy
+import uuid
+import struct
 import pydicom
 import numpy as np
 import pathlib
 import pydicom._storage_sopclass_uids
 
+from .projection_stack import ProjectionStack
+
+# Dicom writers (one per series) kept on this process
+_writers = dict()
+
+# Number of series kept by getDicomWriter
+writers_cache_size = 64
+
 def filesep():
     """Check the system and use / or \\"""
     
@@ -54,40 +66,30 @@ def check_file_exist(file):
     return os.path.isfile(file)
 
 def readDicom(dir2Read):
-    """Read dicom folder."""
+    """Read dicom folder. The headers only read their pixel data if it is accessed."""
     
     # List dicom files
     dcmFiles = list(pathlib.Path(dir2Read).glob('*.dcm'))
     
-    dcmData = len(dcmFiles) * [None]
-    dcmHdr = len(dcmFiles) * [None]
+    # Frames are copied once, straight into the float32 stack
+    stack = ProjectionStack(dcmFiles, index=lambda dcm: int(dcm.split('/')[-1].split('.')[0][1:]))
     
-    if not dcmFiles:    
-        raise ValueError('No DICOM files found in the specified path.')
-
-    for dcm in dcmFiles:
-        
-        dcmH = pydicom.dcmread(str(dcm))
-           
-        ind = int(str(dcm).split('/')[-1].split('.')[0][1:]) 
-        
-        dcmHdr[ind] = dcmH
-                
-        dcmData[ind] = dcmH.pixel_array.astype('float32')
-        
-    
-    dcmData = np.stack(dcmData, axis=-1)
+    dcmData = stack.to_array('float32')
     
-    return dcmData, dcmHdr
+    return dcmData, stack.headers
 
 def writeDecompressedDicom(dcmFileName, dcmImg, dcmHdr):
     '''
     
-    Description: Write empty Dicom file
+    Description: Write a decompressed projection with the fields of its
+    original header LIBRA and the insertion need. The header is built once
+    per series (see DicomTemplateWriter) and only the per-projection
+    fields are patched on each file.
     
     Input:
         - dcmFileName = File name, e.g. "myDicom.dcm".
         - dcmImg = image np array
+        - dcmHdr = original header
     
     Output:
         - 
@@ -96,8 +98,32 @@ def writeDecompressedDicom(dcmFileName, dcmImg, dcmHdr):
     Source:
     
     '''
-        
-    dcmImg = dcmImg.astype(np.uint16)
+    
+    key = ('decompressed', str(dcmHdr.get('SeriesInstanceUID', '')), str(dcmHdr.ImageLaterality), str(dcmHdr.BodyPartThickness))
+    
+    writer = getDicomWriter(key, lambda: decompressedHeader(dcmFileName, dcmHdr), fields=('InstanceNumber', 'DetectorSecondaryAngle'))
+    
+    writer.write(dcmFileName, dcmImg, InstanceNumber=dcmHdr.InstanceNumber, DetectorSecondaryAngle=dcmHdr.DetectorSecondaryAngle)
+    
+    return
+
+
+def decompressedHeader(dcmFileName, dcmHdr):
+    '''
+    
+    Description: Create the Dicom header used by writeDecompressedDicom
+    
+    Input:
+        - dcmFileName = File name, e.g. "myDicom.dcm".
+        - dcmHdr = original header
+    
+    Output:
+        - ds = pydicom FileDataset without PixelData
+            
+    
+    Source:
+    
+    '''
 
     # print("Setting file meta information...")
 
@@ -128,8 +154,8 @@ def writeDecompressedDicom(dcmFileName, dcmImg, dcmHdr):
     
     ds.ImagesInAcquisition = "1"
     
-    ds.Rows = dcmImg.shape[0]
-    ds.Columns = dcmImg.shape[1]
+    ds.Rows = 0
+    ds.Columns = 0
     
     ds.ImageLaterality = dcmHdr.ImageLaterality
     ds.DetectorSecondaryAngle = dcmHdr.DetectorSecondaryAngle
@@ -144,32 +170,26 @@ def writeDecompressedDicom(dcmFileName, dcmImg, dcmHdr):
     
     # pydicom.dataset.validate_file_meta(ds.file_meta, enforce_standard=True)
     
-    # print("Setting pixel data...")
-    ds.PixelData = dcmImg.tobytes()
-    
-    ds.save_as(dcmFileName)
-    
-    return
+    return ds
     
 
-def writeDicom(dcmFileName, dcmImg, dcmHdr=None):
+def dicomHeader(dcmFileName, rows, columns):
     '''
     
-    Description: Write empty Dicom file
+    Description: Create the Dicom header used by writeDicom
     
     Input:
         - dcmFileName = File name, e.g. "myDicom.dcm".
-        - dcmImg = image np array
+        - rows = number of rows of each frame
+        - columns = number of columns of each frame
     
     Output:
-        - 
+        - ds = pydicom FileDataset without PixelData
             
     
     Source:
     
     '''
-    
-    dcmImg = dcmImg.astype(np.uint16)
 
     # print("Setting file meta information...")
 
@@ -200,8 +220,8 @@ def writeDicom(dcmFileName, dcmImg, dcmHdr=None):
     
     ds.ImagesInAcquisition = "1"
     
-    ds.Rows = dcmImg.shape[0]
-    ds.Columns = dcmImg.shape[1]
+    ds.Rows = rows
+    ds.Columns = columns
     ds.InstanceNumber = 1
     
     ds.RescaleIntercept = "0"
@@ -212,14 +232,314 @@ def writeDicom(dcmFileName, dcmImg, dcmHdr=None):
     
     # pydicom.dataset.validate_file_meta(ds.file_meta, enforce_standard=True)
     
-    # print("Setting pixel data...")
-    ds.PixelData = dcmImg.tobytes()
+    return ds
+    
+
+def writeDicom(dcmFileName, dcmImg, dcmHdr=None):
+    '''
+    
+    Description: Write empty Dicom file. Each output folder is a series:
+    its header is serialized once (see DicomTemplateWriter), so the files
+    of a folder share the Study/Series UIDs and only get their own
+    SOPInstanceUID, while files on different folders do not share them.
+    
+    Input:
+        - dcmFileName = File name, e.g. "myDicom.dcm".
+        - dcmImg = image np array
+    
+    Output:
+        - 
+            
+    
+    Source:
+    
+    '''
     
-    ds.save_as(dcmFileName)
+    writer = getDicomWriter(('default', os.path.dirname(os.path.abspath(dcmFileName))), lambda: dicomHeader(dcmFileName, 0, 0))
+    
+    writer.write(dcmFileName, dcmImg)
     
     return
 
 
+def newUID():
+    """Random UID (2.25 and a UUID), always 44 characters, so it can be patched in place."""
+    return '2.25.' + str(10**38 + uuid.uuid4().int % (9 * 10**38))
+
+
+def pixelDataElement(n_bytes):
+    """Header of the PixelData element (Explicit VR Little Endian, OW) with n_bytes of data."""
+    return struct.pack('<HH2sHI', 0x7FE0, 0x0010, b'OW', 0, n_bytes)
+
+
+def getDicomWriter(key, make_header, fields=('InstanceNumber',)):
+    """
+    DicomTemplateWriter kept on this process under key, built from
+    make_header() the first time. Only the writers_cache_size most
+    recently used are kept, so a series (key) is only dropped once it has
+    not been written to for that many other series.
+    """
+    
+    if key in _writers:
+        
+        # Most recently used go last
+        _writers[key] = _writers.pop(key)
+        
+    else:
+        
+        # Drop the least recently used series
+        if len(_writers) >= writers_cache_size:
+            _writers.pop(next(iter(_writers)))
+        
+        _writers[key] = DicomTemplateWriter(make_header(), fields)
+    
+    return _writers[key]
+
+
+class DicomTemplateWriter:
+    '''
+    
+    Description: Write the single-frame uint16 Dicom files of a series
+    from one header template. The header is serialized once; each file
+    is a copy of those bytes with its SOPInstanceUID, Rows, Columns,
+    PixelData length and the given text fields (IS or DS, fixed width)
+    patched in place, followed by the raw pixel buffer.
+    
+    Input:
+        - ds = header template, e.g. dicomHeader(...) (PixelData is dropped)
+        - fields = keywords of the IS/DS fields set on each file
+    
+    Usage:
+        writer = DicomTemplateWriter(dicomHeader(dcmFileName, rows, columns))
+        writer.write(dcmFileName, img, InstanceNumber=ind+1)
+    
+    '''
+    
+    # Width of the patched text fields (maximum length of each VR)
+    field_widths = {'IS': 12, 'DS': 16}
+    
+    def __init__(self, ds, fields=('InstanceNumber',)):
+        
+        ds = copy.deepcopy(ds)
+        
+        if 'PixelData' in ds:
+            del ds.PixelData
+        
+        ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        
+        # Placeholders, found on the serialized header
+        uid = newUID()
+        ds.file_meta.MediaStorageSOPInstanceUID = uid
+        ds.SOPInstanceUID = uid
+        
+        defaults = dict()
+        
+        for keyword in fields:
+            vr = pydicom.datadict.dictionary_VR(keyword)
+            if vr not in self.field_widths:
+                raise ValueError('Only IS and DS fields can be patched, {} is {}.'.format(keyword, vr))
+            defaults[keyword] = ds.get(keyword, 0)
+            setattr(ds, keyword, '0' * self.field_widths[vr])
+        
+        header = io.BytesIO()
+        ds.save_as(header)
+        header.write(pixelDataElement(0))
+        
+        self.header = bytearray(header.getvalue())
+        self.pixel_length_offset = len(self.header) - 4
+        
+        self.uid_length = len(uid)
+        self.uid_offsets = findAll(self.header, uid.encode())
+        
+        self.rows_offset = findElement(self.header, 0x0028, 0x0010, b'US', 2)
+        self.columns_offset = findElement(self.header, 0x0028, 0x0011, b'US', 2)
+        
+        self.fields = dict()
+        
+        for keyword in fields:
+            tag = pydicom.datadict.tag_for_keyword(keyword)
+            vr = pydicom.datadict.dictionary_VR(keyword)
+            self.fields[keyword] = (findElement(self.header, tag >> 16, tag & 0xFFFF, vr.encode(), self.field_widths[vr]), vr)
+        
+        # Template values of the fields
+        self._patch(self.header, defaults)
+        
+    def _patch(self, header, fields):
+        
+        for keyword, value in fields.items():
+            
+            offset, vr = self.fields[keyword]
+            width = self.field_widths[vr]
+            
+            if vr == 'IS':
+                text = str(int(value))
+            else:
+                text = str(value)
+                if len(text) > width:
+                    text = '{:.10g}'.format(float(value))
+            
+            if len(text) > width:
+                raise ValueError('{} = {} does not fit in {} characters.'.format(keyword, value, width))
+            
+            header[offset:offset+width] = text.ljust(width).encode()
+    
+    def write(self, dcmFileName, dcmImg, **fields):
+        """Write dcmImg (cast to uint16) with a new SOPInstanceUID and the given fields."""
+        
+        dcmImg = np.ascontiguousarray(dcmImg, dtype='<u2')
+        
+        header = bytearray(self.header)
+        
+        uid = newUID().encode()
+        for offset in self.uid_offsets:
+            header[offset:offset+self.uid_length] = uid
+        
+        struct.pack_into('<H', header, self.rows_offset, dcmImg.shape[0])
+        struct.pack_into('<H', header, self.columns_offset, dcmImg.shape[1])
+        struct.pack_into('<I', header, self.pixel_length_offset, dcmImg.nbytes)
+        
+        self._patch(header, fields)
+        
+        with open(dcmFileName, 'wb') as file:
+            file.write(header)
+            file.write(dcmImg.data)
+
+
+def findAll(buffer, value):
+    """Offsets of every occurrence of value on buffer."""
+    
+    offsets = []
+    offset = buffer.find(value)
+    
+    while offset >= 0:
+        offsets.append(offset)
+        offset = buffer.find(value, offset + 1)
+    
+    return offsets
+
+
+def findElement(buffer, group, element, vr, length):
+    """Offset of the value of a (short VR) Explicit VR Little Endian element."""
+    
+    offsets = findAll(buffer, struct.pack('<HH2sH', group, element, vr, length))
+    
+    if len(offsets) != 1:
+        raise ValueError('Element ({:04X},{:04X}) found {} times on the header.'.format(group, element, len(offsets)))
+    
+    return offsets[0] + 8
+
+
+class MultiFrameDicomWriter:
+    '''
+    
+    Description: Stream frames into one multi-frame Dicom file. The
+    header is written once and each frame is written straight to its
+    position in the PixelData, so frames can be written in any order
+    without holding the whole stack in memory.
+    
+    The projections' SOP class (Digital Mammography) is single-frame, so
+    the file is a Multi-frame Grayscale Word Secondary Capture image, with
+    the projection index of each frame on FrameLabelVector.
+    
+    Frames go to a temporary file next to dcmFileName, which is renamed
+    to dcmFileName only when the writer is closed without errors. Use it
+    as a context manager, so a failure never leaves a partial file.
+    
+    Input:
+        - dcmFileName = File name, e.g. "contrast_0.100.dcm".
+        - n_frames = number of frames
+        - frame_shape = (rows, columns) of each frame
+    
+    Usage:
+        with MultiFrameDicomWriter(dcmFileName, n_frames, frame_shape) as writer:
+            writer.write(ind, frame)
+    
+    '''
+    
+    def __init__(self, dcmFileName, n_frames, frame_shape):
+        
+        self.dcmFileName = str(dcmFileName)
+        self.dcmFileName_tmp = '{}.{}.tmp'.format(self.dcmFileName, os.getpid())
+        
+        self.n_frames = n_frames
+        self.frame_shape = tuple(frame_shape)
+        self.frame_bytes = int(np.prod(self.frame_shape)) * 2
+        
+        ds = dicomHeader(dcmFileName, self.frame_shape[0], self.frame_shape[1])
+        
+        ds.file_meta.MediaStorageSOPClassUID = pydicom._storage_sopclass_uids.MultiFrameGrayscaleWordSecondaryCaptureImageStorage
+        ds.SOPClassUID = pydicom._storage_sopclass_uids.MultiFrameGrayscaleWordSecondaryCaptureImageStorage
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        
+        ds.NumberOfFrames = n_frames
+        ds.FrameIncrementPointer = pydicom.tag.Tag('FrameLabelVector')
+        ds.FrameLabelVector = [str(ind) for ind in range(n_frames)]
+        
+        header = io.BytesIO()
+        ds.save_as(header)
+        header.write(pixelDataElement(n_frames * self.frame_bytes))
+        
+        self.pixel_offset = header.tell()
+        
+        self.file = open(self.dcmFileName_tmp, 'wb')
+        self.file.write(header.getvalue())
+        self.file.truncate(self.pixel_offset + n_frames * self.frame_bytes)
+        
+    def write(self, ind, frame):
+        """Write frame at position ind."""
+        
+        frame = np.ascontiguousarray(frame, dtype='<u2')
+        
+        if frame.shape != self.frame_shape:
+            raise ValueError('Frame shape {} does not match {}.'.format(frame.shape, self.frame_shape))
+        
+        self.file.seek(self.pixel_offset + ind * self.frame_bytes)
+        self.file.write(frame.tobytes())
+        
+    def close(self):
+        """Finish the file and move it to dcmFileName."""
+        
+        if self.file.closed:
+            return
+        
+        self.file.close()
+        os.replace(self.dcmFileName_tmp, self.dcmFileName)
+        
+    def abort(self):
+        """Drop the file, dcmFileName is left as it was."""
+        
+        if self.file.closed:
+            return
+        
+        self.file.close()
+        os.remove(self.dcmFileName_tmp)
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def readMultiFrameDicom(dcmFileName):
+    """Read multi-frame Dicom file as (rows, columns, frames) float32 array."""
+    
+    dcmH = pydicom.dcmread(str(dcmFileName), force=True)
+    
+    dcmData = dcmH.pixel_array.astype('float32')
+    
+    if dcmData.ndim == 2:
+        dcmData = dcmData[np.newaxis]
+    
+    return np.moveaxis(dcmData, 0, -1)
+
+
 def writeDicomFromTemplate(dcmFileName, dcmImg, dcmH):
     '''
     
@@ -9,241 +9,440 @@ This code does the whole thing - it generates artificial clusters,
 finds candidate positions depending on the breast density and
 insert the lesion in a clinical case.
 
+Exams are independent, so they are distributed over a pool of worker
+processes (see n_workers). Each worker keeps its pyDBT libFiles loaded
+and reports the exam back to the parent when it is done. The state of
+each exam is kept in data/jobs.sqlite (see libs/jobstore.py).
+
 OBS: This code uses LIBRA to estimate density. Please refer to
 https://www.pennmedicine.org/departments-and-centers/department-of-radiology/radiology-research/labs-and-centers/biomedical-imaging-informatics/cbig-computational-breast-imaging-group
 for more information.
- 
+
 """
 
+import os
 import sys
+import zlib
+import functools
+import contextlib
+import traceback
 import numpy as np
-import pydicom
 import pathlib
-import pandas as pd
+import multiprocessing as mp
 import matplotlib.pyplot as plt
 
 sys.path.insert(1, '/home/rodrigo/Documents/Rodrigo/Codigos/pyDBT')
 
-from libs.utilities import makedir, filesep, writeDicom
-from libs.methods import get_XYZ_calc_positions, get_breast_masks, process_dense_mask, \
+from libs.jobstore import JobStore
+from libs.catalog import HeaderCatalog
+from libs.masks import SparseMasks
+from libs.projection_stack import ProjectionStack
+from libs.projectors import select_projector
+from libs.utilities import makedir, filesep, dicomHeader, DicomTemplateWriter, MultiFrameDicomWriter
+from libs.methods import sample_calc_positions, get_breast_masks, get_exam_info, process_dense_mask, run_libra_cohort, \
     get_calc_cluster, get_XYZ_cluster_positions, get_projection_cluster_mask, \
-    apply_mtf_mask_projs
+    apply_mtf_mask_projs, apply_mtf_mask_footprints, get_contrast_sweep
+
+from pydbt.functions.initialConfig import initialConfig
+
+# State kept alive in each worker process between exams
+worker_state = dict()
 
 #%%
 
-if __name__ == '__main__':
+def init_worker(pathBuildDirpyDBT, projector_name, n_workers):
+    """Load pyDBT once per worker (only if it is the projector in use) and set its thread budget."""
 
-    np.random.seed(564456)
-    
-    cluster_dimensions  = (5, 5, 5)              # In mm
-    calc_dimensions     = (1, 1, 1)                 # In mm
-    
-    cluster_pixel_size = 0.048                      # In mm
-    detector_size = 0.140                             # In mm
-    n_max_calcs = 7
-    
-    pathPatientCases            = '/media/rodrigo/SSD480/ACRIN_CLINICAL_DBT_PROJs_RAW_2016/'
-    pathCalcifications          = '/media/rodrigo/Dados_2TB/Imagens/UPenn/Phantom/VCT/db_calcium/calc'
-    pathCalcificationsReport    = '/media/rodrigo/Dados_2TB/Imagens/UPenn/Phantom/VCT/db_calcium/report.xlsx'
-    pathMatlab                  = '/usr/local/MATLAB/R2019a/bin/matlab'
-    pathLibra                   = 'LIBRA-1.0.4'
-    pathAuxLibs                 = 'libs'
-    pathBuildDirpyDBT           = '/home/rodrigo/Documents/Rodrigo/Codigos/pyDBT/build'
-    pathMTF                     = 'data/mtf_function_hologic3d_fourier.npy'
-    pathPatientDensity          = pathPatientCases + '/density'
-    pathPatientCalcs            = pathPatientCases + '/calcifications'
-    
-    # Flags
-    flags = dict()
-    flags['fix_compression_paddle'] = False
-    flags['print_debug'] = True
-    flags['vct_image'] = False
-    flags['delete_masks_folder'] = False
-    flags['force_libra'] = False
+    # Each worker gets its share of the CPUs for its threads, so n_workers
+    # processes do not oversubscribe the machine (see flags['threads'])
+    worker_state['n_threads'] = max((os.cpu_count() or 1) // n_workers, 1)
 
-    cluster_size = [int(x/cluster_pixel_size) for x in cluster_dimensions]
-    calc_window  = [int(x/cluster_pixel_size) for x in calc_dimensions]
+    if projector_name == 'pydbt':
+        worker_state['libFiles'] = initialConfig(buildDir=pathBuildDirpyDBT, createOutFolder=False)
+    else:
+        worker_state['libFiles'] = None
 
-    contrasts = [0.1]
-    for x in range(14):
-        contrasts.append(np.round(0.85 * contrasts[x], 3))
-    
-    # List all patients    
-    patient_cases = [str(item) for item in pathlib.Path(pathPatientCases).glob("*") if pathlib.Path(item).is_dir()]
-    
-    makedir(pathPatientDensity)
-    makedir(pathPatientCalcs)
 
-    with open('data/IDs_calc.txt', 'r') as file:
-        lines = file.readlines()
+def run_exam(exam, params):
+    """Claim, process and record one exam. Returns (ID, state)."""
 
-    # Assuming each line contains an ID
-    ids2run = [line.strip() for line in lines]
+    store = params['store']
 
-    file = pathlib.Path('data/IDs_processed.txt')
-    if file.exists():
-        with file.open('r') as file:
-            lines = file.readlines()
-        ids_processed = [line.strip() for line in lines]
-    else:
-        ids_processed = []
+    current_id = '/'.join(exam.split('/')[-2:])
+
+    # Another worker (or another run) may have claimed it already
+    if not store.start(current_id, 'insert', retry_failed=params['retry_failed']):
+        return current_id, 'skipped'
 
     try:
-        df = pd.read_csv('data/status.csv')
-    except:
-        df = pd.DataFrame({'ID': ids2run, 'nROIsCluster': len(ids2run) * [0], 'nROIsNoCluster': len(ids2run) * [0]})
+        process_exam(exam, params)
+    except Exception:
+        print("Exam {} failed:".format(current_id))
+        traceback.print_exc()
+        store.fail(current_id, 'insert', traceback.format_exc())
+        return current_id, 'failed'
 
-    n_rois_cluster_total = 0
-    n_rois_no_cluster_total = 0
+    store.done(current_id, 'insert')
 
-    for patient_case in patient_cases:
-        
-        exams = [str(item) for item in pathlib.Path(patient_case).glob("*") if pathlib.Path(item).is_dir() and 'density' not in str(item) and 'calcifications' not in str(item)]
-        
-        for exam in exams:
+    return current_id, 'done'
 
-            current_id = '/'.join(exam.split('/')[-2:])
 
-            # if current_id != '29738414/903':
-            #     continue
+def process_exam(exam, params):
 
-            # ID read not in ID to run
-            if current_id not in ids2run or current_id in ids_processed:
-                continue
+    cluster_size = params['cluster_size']
+    calc_window = params['calc_window']
+    cluster_pixel_size = params['cluster_pixel_size']
+    detector_size = params['detector_size']
+    n_max_calcs = params['n_max_calcs']
+    contrasts = params['contrasts']
 
-            with open('data/IDs_processed.txt', 'a') as file:
-                file.write(current_id + '\n')
+    pathCalcifications = params['pathCalcifications']
+    pathCalcificationsReport = params['pathCalcificationsReport']
+    pathMatlab = params['pathMatlab']
+    pathLibra = params['pathLibra']
+    pathAuxLibs = params['pathAuxLibs']
+    pathBuildDirpyDBT = params['pathBuildDirpyDBT']
+    pathMTF = params['pathMTF']
+    pathPatientDensity = params['pathPatientDensity']
+    pathPatientCalcs = params['pathPatientCalcs']
 
-            print("Processing exam: " + current_id)
+    # Each exam gets its own copy of the flags, as they are changed below
+    flags = dict(params['flags'])
 
-            #%%
+    if flags['threads'] is None:
+        flags['threads'] = worker_state['n_threads']
 
-            dcmFiles = [str(item) for item in pathlib.Path(exam).glob("*.dcm")]
+    current_id = '/'.join(exam.split('/')[-2:])
 
-            # Run LIBRA
-            mask_dense, mask_breast, bdyThick = get_breast_masks(dcmFiles, exam, pathPatientDensity, pathLibra, pathMatlab, pathAuxLibs, flags)
+    # Seed from the exam ID, so results do not depend on the worker scheduling
+    exam_seed = (params['seed'] + zlib.crc32(current_id.encode())) % 2**32
+    np.random.seed(exam_seed)
+    rng = np.random.default_rng(exam_seed)
 
-            # Process dense mask
-            final_mask, flags = process_dense_mask(mask_dense, mask_breast, cluster_size, dcmFiles, flags)
+    print("Processing exam: " + current_id)
 
-            del mask_dense
+    #%%
 
-            #%%
+    # Files and header fields from the catalog, ordered by projection
+    dcmFiles = params['catalog'].files(current_id)
+    dcmHdrs = params['catalog'].headers(current_id)
 
-            # Reconstruct the dense mask and find the coords for the cluster
-            (x_clust, y_clust, z_clust), geo, libFiles, bound_X, slice2check = get_XYZ_cluster_positions(final_mask, mask_breast, bdyThick, pathBuildDirpyDBT, flags)
+    # Projections (memory-mapped)
+    stack = ProjectionStack(dcmFiles, index=lambda dcmFile: int(dcmFile.split('/')[-1].split('_')[-1].split('.')[0]))
 
-            del mask_breast
+    # Run LIBRA
+    mask_dense, mask_breast, bdyThick = get_breast_masks(dcmFiles, exam, pathPatientDensity, pathLibra, pathMatlab, pathAuxLibs, flags)
 
-            n_rois = len(x_clust)
+    # Laterality and angle, from the catalog
+    exam_info = get_exam_info(dcmFiles, dcmHdrs)
 
-            if n_rois_cluster_total < 115:
-                n_rois_cluster = n_rois
-                n_rois_no_cluster = 0
-            else:
-                n_rois_cluster = 0
-                n_rois_no_cluster = n_rois
+    # Process dense mask
+    final_mask, flags = process_dense_mask(mask_dense, mask_breast, cluster_size, exam_info, flags)
 
-            n_rois_cluster_total += n_rois_cluster
-            n_rois_no_cluster_total += n_rois_no_cluster
+    del mask_dense
 
-            print("Total number of ROIs (cluster): " + str(n_rois_cluster_total))
-            print("Total number of ROIs (NO cluster): " + str(n_rois_no_cluster_total))
+    #%%
 
-            df.loc[df.ID == current_id, 'nROIsCluster'] = n_rois_cluster
-            df.loc[df.ID == current_id, 'nROIsNoCluster'] = n_rois_no_cluster
+    # Reconstruct the dense mask and find the coords for the cluster
+    (x_clust, y_clust, z_clust), geo, libFiles, bound_X, slice2check = get_XYZ_cluster_positions(final_mask, mask_breast, bdyThick, pathBuildDirpyDBT, flags,
+                                                                                                    libFiles=worker_state['libFiles'])
 
-            path2write_patient_name = "{}{}{}".format(pathPatientCalcs, filesep(), "/".join(exam.split('/')[-2:]))
+    del mask_breast
 
-            makedir(path2write_patient_name)
+    n_rois = len(x_clust)
 
-            # Save slice with density
-            # plt.imsave("{}{}slice_density.png".format(path2write_patient_name, filesep()),
-            #                                             cv2.resize(255*np.uint8(slice2check), (slice2check.shape[1] // 4, slice2check.shape[0] // 4)),
-            #                                             cmap='gray')
+    # The ROI budget with cluster is shared by all workers
+    n_rois_cluster, n_rois_no_cluster = params['store'].allocate_rois(current_id, 'insert', n_rois, params['n_max_rois_cluster'])
 
-            df.to_csv('data/status.csv')
+    path2write_patient_name = "{}{}{}".format(pathPatientCalcs, filesep(), "/".join(exam.split('/')[-2:]))
 
-            if n_rois == 0:
-                continue
+    makedir(path2write_patient_name)
 
-            del final_mask
+    # Save slice with density
+    # plt.imsave("{}{}slice_density.png".format(path2write_patient_name, filesep()),
+    #                                             cv2.resize(255*np.uint8(slice2check), (slice2check.shape[1] // 4, slice2check.shape[0] // 4)),
+    #                                             cmap='gray')
 
-            # %%
+    if n_rois == 0:
+        return n_rois_cluster, n_rois_no_cluster
 
-            projs_masks = np.zeros((geo.nv, geo.nu, geo.nProj))
+    del final_mask
 
-            for idr in range(n_rois_cluster):
+    # %%
 
-                if flags['print_debug']:
-                    print("Processing ROI {}/{}...".format(idr+1, len(x_clust)))
+    # Projections of the clusters, only on their footprint
+    projs_masks = SparseMasks((geo.nv, geo.nu, geo.nProj))
 
-                number_calc = np.random.randint(5, n_max_calcs+1)
+    # Get X, Y and Z position for each calcification of every cluster at once
+    number_calcs = rng.integers(5, n_max_calcs+1, n_rois_cluster)
+    calc_positions, _ = sample_calc_positions(number_calcs, cluster_size, calc_window, rng)
 
-                # Get  X, Y and Z position for each calcification
-                (x_calc, y_calc, z_calc), _ = get_XYZ_calc_positions(number_calc, cluster_size, calc_window, flags)
+    for idr in range(n_rois_cluster):
 
-                # Load each calcification and put them on specified position
-                roi_3D, contrasts_individual = get_calc_cluster(pathCalcifications, pathCalcificationsReport, number_calc,
-                                                                cluster_size, x_calc, y_calc, z_calc, flags)
+        if flags['print_debug']:
+            print("Processing ROI {}/{}...".format(idr+1, len(x_clust)))
 
-                # Inserting cluster at position and projecting the cluster mask
-                projs_masks += get_projection_cluster_mask(roi_3D, contrasts_individual, geo, x_clust[idr], y_clust[idr], z_clust[idr], cluster_pixel_size, libFiles, flags)
+        number_calc = number_calcs[idr]
 
-            # Apply the fitted MTF on the mask projections
-            projs_masks_mtf = apply_mtf_mask_projs(projs_masks, len(dcmFiles), detector_size, pathMTF, flags)
+        x_calc, y_calc, z_calc = calc_positions[idr]
 
+        # Load each calcification and put them on specified position
+        roi_3D, contrasts_individual = get_calc_cluster(pathCalcifications, pathCalcificationsReport, number_calc,
+                                                        cluster_size, x_calc, y_calc, z_calc, flags)
 
-            cropCoords_file = pathlib.Path('{}{}{}{}Result_Images{}cropCoords.npy'.format(pathPatientDensity , filesep(), "/".join(exam.split('/')[-3:]), filesep(), filesep()))
-            if cropCoords_file.is_file():
-                cropCoords = np.load(str(cropCoords_file))
-                flags['mask_crop'] = True
-                flags['cropCoords'] = cropCoords
-            else:
-                flags['mask_crop'] = False
+        # Inserting cluster at position and projecting the cluster mask
+        projs_masks.add(get_projection_cluster_mask(roi_3D, contrasts_individual, geo, x_clust[idr], y_clust[idr], z_clust[idr], cluster_pixel_size, libFiles, flags))
 
+    # Apply the fitted MTF on the mask projections
+    if flags['mtf_mode'] == 'roi':
+        projs_masks_mtf = apply_mtf_mask_footprints(projs_masks, detector_size, pathMTF, flags)
+    else:
+        projs_masks_mtf = SparseMasks.from_dense(apply_mtf_mask_projs(projs_masks.to_dense(), len(dcmFiles), detector_size, pathMTF, flags))
 
-            flags['calc_coords'] = (x_clust, y_clust, z_clust)
-            flags['cluster_flag'] = np.hstack((n_rois_cluster*[1], n_rois_no_cluster*[0]))
-            flags['bound_X'] = bound_X
-            flags['bdyThick'] = bdyThick
+    del projs_masks
 
-            np.save(path2write_patient_name + '{}flags'.format(filesep()), flags)
 
-            for idc, contrast in enumerate(contrasts):
+    cropCoords_file = pathlib.Path('{}{}{}{}Result_Images{}cropCoords.npy'.format(pathPatientDensity , filesep(), "/".join(exam.split('/')[-3:]), filesep(), filesep()))
+    if cropCoords_file.is_file():
+        cropCoords = np.load(str(cropCoords_file))
+        flags['mask_crop'] = True
+        flags['cropCoords'] = cropCoords
+    else:
+        flags['mask_crop'] = False
 
-                if n_rois_cluster == 0 and idc > 0:
-                    continue
 
-                path2write_contrast = "{}{}contrast_{:.3f}".format(path2write_patient_name , filesep(), contrast)
+    flags['calc_coords'] = (x_clust, y_clust, z_clust)
+    flags['cluster_flag'] = np.hstack((n_rois_cluster*[1], n_rois_no_cluster*[0]))
+    flags['bound_X'] = bound_X
+    flags['bdyThick'] = bdyThick
 
-                makedir(path2write_contrast)
+    np.save(path2write_patient_name + '{}flags'.format(filesep()), flags)
 
-                for dcmFile in dcmFiles:
+    # Exams without cluster only need the first contrast level
+    if n_rois_cluster > 0:
+        sweep_contrasts = contrasts
+    else:
+        sweep_contrasts = contrasts[:1]
+
+    paths2write_contrast = ["{}{}contrast_{:.3f}".format(path2write_patient_name , filesep(), contrast) for contrast in sweep_contrasts]
+
+    if flags['output_format'] == 'dicom':
+        for path2write_contrast in paths2write_contrast:
+            makedir(path2write_contrast)
+
+        # One series per contrast, its header is serialized only once
+        series_writers = [DicomTemplateWriter(dicomHeader(path2write_contrast, *stack.shape[:2])) for path2write_contrast in paths2write_contrast]
+
+    with contextlib.ExitStack() as exit_stack:
 
-                    dcmH = pydicom.dcmread(str(dcmFile))
+        if flags['output_format'] == 'multiframe':
 
-                    dcmData = dcmH.pixel_array.astype('float32').copy()
+            frame_shape = stack.shape[:2]
+            if flags['mask_crop']:
+                frame_shape = stack.frame(0)[cropCoords[0]:cropCoords[1], cropCoords[2]:cropCoords[3]].shape
 
-                    if flags['mask_crop']:
-                        dcmData = dcmData[cropCoords[0]:cropCoords[1], cropCoords[2]:cropCoords[3]]
+            # One multi-frame file per contrast. They only show up under
+            # their names once complete, and are dropped on an exception
+            writers = [exit_stack.enter_context(MultiFrameDicomWriter(path2write_contrast + '.dcm', len(dcmFiles), frame_shape))
+                       for path2write_contrast in paths2write_contrast]
 
-                    if not flags['right_breast']:
-                        dcmData = np.fliplr(dcmData)
+        # Each projection is read once and all contrasts are emitted from it
+        for ind, dcmFile in enumerate(stack.files):
 
-                    ind = int(str(dcmFile).split('/')[-1].split('_')[-1].split('.')[0])
+            dcmData = stack.frame(ind)
+
+            # Crop before the conversion, so only the crop is copied
+            if flags['mask_crop']:
+                dcmData = dcmData[cropCoords[0]:cropCoords[1], cropCoords[2]:cropCoords[3]]
+
+            dcmData = dcmData.astype('float32')
+
+            if n_rois_cluster > 0:
+                proj_mask = projs_masks_mtf.dense(ind, normalize=True)
+            else:
+                proj_mask = None
 
-                    if n_rois_cluster > 0:
-                        tmp_mask = np.abs(projs_masks_mtf[:,:,ind])
-                        tmp_mask = (tmp_mask - tmp_mask.min()) / (tmp_mask.max() - tmp_mask.min())
-                        tmp_mask[tmp_mask > 0] *= contrast
-                        tmp_mask = 1 - tmp_mask
+            dcmData_sweep = get_contrast_sweep(dcmData, proj_mask, sweep_contrasts, flags)
 
-                        dcmData[:,bound_X:] = dcmData[:,bound_X:] * tmp_mask
+            if flags['output_format'] == 'multiframe':
 
-                    if not flags['right_breast']:
-                        dcmData = np.fliplr(dcmData)
+                for writer, dcmData_contrast in zip(writers, dcmData_sweep):
+                    writer.write(ind, np.uint16(dcmData_contrast))
+
+            else:
+
+                for path2write_contrast, series_writer, dcmData_contrast in zip(paths2write_contrast, series_writers, dcmData_sweep):
 
                     dcmFile_tmp = path2write_contrast + '{}{}'.format(filesep(), dcmFile.split('/')[-1])
 
-                    writeDicom(dcmFile_tmp, np.uint16(dcmData))
+                    series_writer.write(dcmFile_tmp, np.uint16(dcmData_contrast), InstanceNumber=ind+1)
+
+    return n_rois_cluster, n_rois_no_cluster
+
+#%%
+
+if __name__ == '__main__':
+
+    seed = 564456
+
+    n_workers = 1                                   # Number of exams processed at the same time
+    retry_failed = False                            # Run exams that failed before again
+    recover_crashed = True                          # Run exams left running by a crashed run again
+    n_max_rois_cluster = 115                        # ROIs with cluster, then only ROIs without cluster
+
+    cluster_dimensions  = (5, 5, 5)              # In mm
+    calc_dimensions     = (1, 1, 1)                 # In mm
+
+    cluster_pixel_size = 0.048                      # In mm
+    detector_size = 0.140                             # In mm
+    n_max_calcs = 7
+
+    pathPatientCases            = '/media/rodrigo/SSD480/ACRIN_CLINICAL_DBT_PROJs_RAW_2016/'
+    pathCalcifications          = '/media/rodrigo/Dados_2TB/Imagens/UPenn/Phantom/VCT/db_calcium/calc'
+    pathCalcificationsReport    = '/media/rodrigo/Dados_2TB/Imagens/UPenn/Phantom/VCT/db_calcium/report.xlsx'
+    pathMatlab                  = '/usr/local/MATLAB/R2019a/bin/matlab'
+    pathLibra                   = 'LIBRA-1.0.4'
+    pathAuxLibs                 = 'libs'
+    pathBuildDirpyDBT           = '/home/rodrigo/Documents/Rodrigo/Codigos/pyDBT/build'
+    pathMTF                     = 'data/mtf_function_hologic3d_fourier.npz'
+    pathPatientDensity          = pathPatientCases + '/density'
+    pathPatientCalcs            = pathPatientCases + '/calcifications'
+
+    # Flags
+    flags = dict()
+    flags['fix_compression_paddle'] = False
+    flags['print_debug'] = True
+    flags['vct_image'] = False
+    flags['delete_masks_folder'] = False
+    flags['force_libra'] = False
+    flags['mask_backend'] = 'libra'                 # 'libra' (MATLAB) or 'numpy' (in-process segmentation)
+    flags['libra_batch'] = True                     # One MATLAB session per exam instead of one per projection
+    flags['libra_cohort'] = False                   # One MATLAB session for all exams, before the insertion
+    flags['output_format'] = 'dicom'                # 'dicom' (one file per projection) or 'multiframe' (one file per contrast)
+    flags['roi_overlap'] = 0                        # Overlap between candidate cluster windows (0 to <1)
+    flags['roi_min_spacing'] = 0                    # Minimum distance between cluster centers (pixels), 0 for none
+    flags['projector'] = 'pydbt'                    # 'pydbt' (GPU), 'numpy' (CPU) or 'auto' (pydbt if there is a GPU)
+    flags['mtf_mode'] = 'fft'                       # 'fft' (whole projections, exact) or 'roi' (blur around each cluster, PSF cropped)
+    flags['threads'] = None                         # Threads of each worker: masks, MTF and NumPy projector (None for all CPUs / n_workers)
+
+    cluster_size = [int(x/cluster_pixel_size) for x in cluster_dimensions]
+    calc_window  = [int(x/cluster_pixel_size) for x in calc_dimensions]
+
+    contrasts = [0.1]
+    for x in range(14):
+        contrasts.append(np.round(0.85 * contrasts[x], 3))
+
+    # List all patients
+    patient_cases = [str(item) for item in pathlib.Path(pathPatientCases).glob("*") if pathlib.Path(item).is_dir()]
+
+    makedir(pathPatientDensity)
+    makedir(pathPatientCalcs)
+
+    with open('data/IDs_calc.txt', 'r') as file:
+        lines = file.readlines()
+
+    # Assuming each line contains an ID
+    ids2run = [line.strip() for line in lines]
+
+    store = JobStore('data/jobs.sqlite')
+
+    # Progress of runs made before the job manifest
+    if not store.ids('insert'):
+        store.import_legacy('insert', 'data/IDs_processed.txt', 'data/status.csv')
+
+    store.add(ids2run, 'insert')
+
+    # Exams left running by a crashed run go back to pending. Set it to
+    # False if more than one main.py share the same data/jobs.sqlite
+    if recover_crashed:
+        store.reset('insert')
+
+    ids2claim = set(store.ids('insert', 'pending'))
+    if retry_failed:
+        ids2claim.update(store.ids('insert', 'failed'))
+
+    exams2run = []
+
+    for patient_case in patient_cases:
+
+        exams = [str(item) for item in pathlib.Path(patient_case).glob("*") if pathlib.Path(item).is_dir() and 'density' not in str(item) and 'calcifications' not in str(item)]
+
+        for exam in exams:
+
+            current_id = '/'.join(exam.split('/')[-2:])
+
+            # if current_id != '29738414/903':
+            #     continue
+
+            # ID read not in ID to run
+            if current_id not in ids2claim:
+                continue
+
+            exams2run.append(exam)
+
+    # 'auto' is resolved here, so every worker uses the same projector
+    flags['projector'] = select_projector(flags['projector'], pathBuildDirpyDBT)
+
+    if flags['print_debug']:
+        print("Projector: " + flags['projector'])
+
+    # Header fields of all exams, parsed once (then only new or changed files)
+    catalog = HeaderCatalog('data/catalog.sqlite')
+    catalog.update(exams2run, print_debug=flags['print_debug'])
+
+    # Run LIBRA for all exams at once, so MATLAB starts only once
+    if flags['mask_backend'] == 'libra' and flags['libra_cohort']:
+        if run_libra_cohort(exams2run, pathPatientDensity, pathLibra, pathMatlab, pathAuxLibs, flags):
+            # Masks were just made for every exam, the workers only load them
+            flags['force_libra'] = False
+
+    params = dict()
+    params['seed'] = seed
+    params['n_max_rois_cluster'] = n_max_rois_cluster
+    params['cluster_size'] = cluster_size
+    params['calc_window'] = calc_window
+    params['cluster_pixel_size'] = cluster_pixel_size
+    params['detector_size'] = detector_size
+    params['n_max_calcs'] = n_max_calcs
+    params['contrasts'] = contrasts
+    params['pathCalcifications'] = pathCalcifications
+    params['pathCalcificationsReport'] = pathCalcificationsReport
+    params['pathMatlab'] = pathMatlab
+    params['pathLibra'] = pathLibra
+    params['pathAuxLibs'] = pathAuxLibs
+    params['pathBuildDirpyDBT'] = pathBuildDirpyDBT
+    params['pathMTF'] = pathMTF
+    params['pathPatientDensity'] = pathPatientDensity
+    params['pathPatientCalcs'] = pathPatientCalcs
+    params['flags'] = flags
+    params['store'] = store
+    params['catalog'] = catalog
+    params['retry_failed'] = retry_failed
+
+    def report(result):
+        """Runs on the parent for every finished exam."""
+
+        current_id, state = result
+
+        status = store.status('insert')
+
+        print("Exam {} {}".format(current_id, state))
+        print("Exams done/failed/pending: {}/{}/{}".format(status['done'], status['failed'], status['pending']))
+        print("Total number of ROIs (cluster): " + str(status['nROIsCluster']))
+        print("Total number of ROIs (NO cluster): " + str(status['nROIsNoCluster']))
+
+    if n_workers == 1:
+
+        init_worker(pathBuildDirpyDBT, flags['projector'], n_workers)
+
+        for exam in exams2run:
+            report(run_exam(exam, params))
+
+    else:
+
+        ctx = mp.get_context('spawn')
+
+        with ctx.Pool(n_workers, initializer=init_worker, initargs=(pathBuildDirpyDBT, flags['projector'], n_workers)) as pool:
+
+            for result in pool.imap_unordered(functools.partial(run_exam, params=params), exams2run):
+                report(result)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:31:08 2026
+
+Benchmark of the projectors of libs/projectors.py on a synthetic phantom
+(a few ellipsoids) with the Hologic geometry: time of the projection and
+backprojection and, if pyDBT runs on this machine, how close the NumPy
+operators are to it.
+
+"""
+
+import sys
+import time
+import numpy as np
+
+sys.path.insert(1, '../')
+
+from libs.projectors import NumpyProjector, PydbtProjector, cuda_available
+
+from pydbt.parameters.parameterSettings import geometry_settings
+from pydbt.functions.initialConfig import initialConfig
+
+
+def ellipsoids_phantom(geo, n_ellipsoids=8, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    yy, xx, zz = np.meshgrid(np.arange(geo.ny), np.arange(geo.nx), np.arange(geo.nz), indexing='ij')
+
+    vol = np.zeros((geo.ny, geo.nx, geo.nz))
+
+    for _ in range(n_ellipsoids):
+
+        center = rng.uniform(0.2, 0.8, 3) * (geo.ny, geo.nx, geo.nz)
+        radius = rng.uniform(0.05, 0.2, 3) * (geo.ny, geo.nx, geo.nz)
+
+        inside = ((yy - center[0]) / radius[0])**2 + ((xx - center[1]) / radius[1])**2 + ((zz - center[2]) / radius[2])**2 <= 1
+
+        vol[inside] += rng.uniform(0.2, 1)
+
+    return vol
+
+
+def compare(x, ref):
+
+    """
+    Relative RMSE of x against ref as they are, the least-squares scale
+    between the two (1 if they are normalized the same way), the relative
+    RMSE after that scale and the correlation.
+    """
+
+    x, ref = x.ravel(), ref.ravel()
+
+    ref_norm = max(np.sqrt(np.mean(ref**2)), 1e-12)
+
+    scale = np.dot(x, ref) / max(np.dot(x, x), 1e-12)
+
+    rmse = np.sqrt(np.mean((x - ref)**2)) / ref_norm
+    rmse_scaled = np.sqrt(np.mean((scale * x - ref)**2)) / ref_norm
+
+    return rmse, scale, rmse_scaled, np.corrcoef(x, ref)[0, 1]
+
+
+def report(label, x, ref):
+
+    rmse, scale, rmse_scaled, corr = compare(x, ref)
+
+    print("{}: relative RMSE {:.4f} (after scale {:.4f}: {:.4f}), correlation {:.5f}".format(label, rmse, scale, rmse_scaled, corr))
+
+
+def timeit(fn, *args):
+
+    start = time.time()
+    out = fn(*args)
+
+    return out, time.time() - start
+
+
+if __name__ == '__main__':
+
+    pathBuildDirpyDBT = '/home/rodrigo/Documents/Rodrigo/Codigos/pyDBT/build'
+
+    # Create a DBT geometry (smaller than a real exam)
+    geo = geometry_settings()
+    geo.Hologic()
+
+    geo.nx = 400
+    geo.ny = 600
+    geo.nz = 40
+    geo.nu = 500
+    geo.nv = 700
+
+    vol = ellipsoids_phantom(geo)
+
+    projectors = [NumpyProjector()]
+
+    if cuda_available(pathBuildDirpyDBT):
+        libFiles = initialConfig(buildDir=pathBuildDirpyDBT, createOutFolder=False)
+        projectors.append(PydbtProjector(libFiles))
+    else:
+        print("pyDBT (CUDA) not available, benchmarking NumPy only")
+
+    results = dict()
+
+    for projector in projectors:
+
+        projs, t_proj = timeit(projector.project, vol, geo)
+        vol_bp, t_bp = timeit(projector.backproject, projs, geo)
+
+        results[projector.name] = (projs, vol_bp)
+
+        # get_XYZ_cluster_positions thresholds the backprojection at values
+        # tuned on pyDBT, so the two gains must match (1 for the mean over
+        # projections) before 'numpy' is used there
+        gain = projector.backproject(np.ones((geo.nv, geo.nu, geo.nProj)), geo).max()
+
+        print("{:>6}: projection {:.2f}s, backprojection {:.2f}s, backprojection gain {:.4f}".format(projector.name, t_proj, t_bp, gain))
+
+    if 'pydbt' in results:
+
+        # Unscaled errors are the ones that matter, the operators must
+        # agree in scale as well as in shape
+        for ind, label in enumerate(('projection', 'backprojection')):
+            report(label, results['numpy'][ind], results['pydbt'][ind])
+
+        # Backprojection of the same (pyDBT) projections, so only the
+        # backprojector differs
+        vol_bp, _ = timeit(projectors[0].backproject, results['pydbt'][0], geo)
+
+        report('backprojection (same projections)', vol_bp, results['pydbt'][1])
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:02:17 2026
+
+Pack the VCT calcification library (one .zip per calcification) into a
+single memory-mapped atlas, atlas.npy and atlas.npz, inside the
+calcification folder. get_calc_cluster uses it automatically when it is
+there. Run it again whenever the library changes.
+
+"""
+
+import sys
+import time
+
+sys.path.insert(1, '../')
+
+from libs.calc_library import build_calc_atlas, get_atlas_path
+
+
+if __name__ == '__main__':
+    
+    pathCalcifications          = '/media/rodrigo/Dados_2TB/Imagens/UPenn/Phantom/VCT/db_calcium/calc'
+    pathCalcificationsReport    = '/media/rodrigo/Dados_2TB/Imagens/UPenn/Phantom/VCT/db_calcium/report.xlsx'
+    
+    start = time.time()
+    
+    n_calcs = build_calc_atlas(pathCalcifications, pathCalcificationsReport, print_debug=True)
+    
+    print("{} calcifications packed on {}.npy/.npz in {:.1f}s".format(n_calcs, get_atlas_path(pathCalcifications), time.time() - start))
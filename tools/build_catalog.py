@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:03:48 2026
+
+Scan the whole cohort and catalog the header fields of every projection
+(libs/catalog.py) on data/catalog.sqlite. main.py and the tools update
+the catalog themselves, but only for the exams they use; run this once
+to have the whole archive there. Running it again only parses the files
+that are new or changed.
+
+"""
+
+import sys
+import time
+import pathlib
+
+sys.path.insert(1, '../')
+
+from libs.catalog import HeaderCatalog
+
+
+if __name__ == '__main__':
+
+    pathPatientCases = '/media/rodrigo/SSD480/ACRIN_CLINICAL_DBT_PROJs_RAW_2016/'
+    pathCatalog = '../data/catalog.sqlite'
+
+    n_workers = None                                # None for all CPUs
+
+    patient_cases = [str(item) for item in pathlib.Path(pathPatientCases).glob("*") if pathlib.Path(item).is_dir()]
+
+    exams = [str(item) for patient_case in patient_cases for item in pathlib.Path(patient_case).glob("*") if
+             pathlib.Path(item).is_dir() and 'density' not in str(item) and 'calcifications' not in str(item)]
+
+    start = time.time()
+
+    catalog = HeaderCatalog(pathCatalog)
+
+    n_parsed = catalog.update(exams, n_workers, print_debug=True)
+
+    print("{} exams, {} headers parsed in {:.1f}s".format(len(exams), n_parsed, time.time() - start))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:48:20 2026
+
+Convert the old MTF files (a pickled scipy interp1d saved with np.save)
+to the .npz MTF model of libs/mtf.py, next to the original file. Only
+run it on files you trust, as loading them unpickles the object.
+
+    python convert_mtf.py ../data/mtf_function_hologic3d_fourier.npy --vendor Hologic --pitch 0.140
+
+The interp1d object does not expose its interpolation kind (only SciPy
+internals do), so it is given with --kind: 'cubic' by default, as
+tools/mtf.py fits them. The maximum difference to the old function is
+printed, and a large one means the kind is wrong.
+
+"""
+
+import sys
+import argparse
+import pathlib
+import numpy as np
+
+sys.path.insert(1, '../')
+
+from libs.mtf import MTFModel
+
+
+if __name__ == '__main__':
+    
+    parser = argparse.ArgumentParser(description='Convert pickled MTF (.npy) files to MTF models (.npz).')
+    parser.add_argument('paths', nargs='+', help='.npy files')
+    parser.add_argument('--vendor', default='', help='e.g. Hologic')
+    parser.add_argument('--pitch', type=float, default=np.nan, help='detector pixel pitch (mm)')
+    parser.add_argument('--kind', default='cubic', help="interp1d kind the file was made with (default 'cubic', as tools/mtf.py)")
+    args = parser.parse_args()
+    
+    for path in args.paths:
+        
+        f = np.load(path, allow_pickle=True)[()]
+        
+        model = MTFModel(f.x, f.y, args.kind, args.vendor, args.pitch)
+        
+        # Same values as the old function on its whole range
+        freq = np.linspace(f.x[0], f.x[-1], 1001)
+        error = np.abs(model(freq) - f(freq)).max()
+        
+        path_model = str(pathlib.Path(path).with_suffix('.npz'))
+        
+        model.save(path_model)
+        
+        print("{} -> {} ({}, max difference {:.2e})".format(path, path_model, model.kind, error))
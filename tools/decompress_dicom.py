@@ -4,29 +4,109 @@
 Created on Tue Dec 20 09:24:27 2022
 
 @author: rodrigo
+
+Decompress, in place, every Dicom file under a folder. Files are
+processed on a pool of worker processes. Files that are already
+uncompressed (from their header) are skipped, so the tool can be run
+again on the same tree, e.g. after an interruption. Each file is written
+to a temporary file next to it and then renamed over the original, so an
+interrupted run never leaves a truncated file behind.
+
 """
 
 
+import os
+import sys
+import time
 import pathlib
 import pydicom
-import sys
 
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.insert(1, '../')
 
-from libs.utilities import makedir, filesep, writeDecompressedDicom
+from libs.utilities import writeDecompressedDicom
+from libs.projection_stack import raw_transfer_syntaxes
+
+
+def is_uncompressed(dcm_file):
+
+    """
+    Whether the file is already uncompressed, from its header only.
+    """
+
+    proj_header = pydicom.dcmread(dcm_file, force=True, stop_before_pixels=True)
+
+    file_meta = getattr(proj_header, 'file_meta', None)
+
+    return file_meta is not None and file_meta.get('TransferSyntaxUID') in raw_transfer_syntaxes
+
+
+def decompress_file(dcm_file):
+
+    """
+    Decompress one file in place. Returns (state, bytes read), state
+    being 'done', 'skipped' or 'failed: <error>'.
+    """
+
+    n_bytes = os.path.getsize(dcm_file)
+
+    dcm_file_tmp = '{}.{}.tmp'.format(dcm_file, os.getpid())
+
+    try:
+
+        if is_uncompressed(dcm_file):
+            return 'skipped', n_bytes
+
+        proj_header = pydicom.dcmread(dcm_file, force=True)
+        proj  = proj_header.pixel_array
+
+        writeDecompressedDicom(dcm_file_tmp, proj, proj_header)
+
+        os.replace(dcm_file_tmp, dcm_file)
+
+    except Exception as e:
+
+        if os.path.exists(dcm_file_tmp):
+            os.remove(dcm_file_tmp)
+
+        return 'failed: {}'.format(e), n_bytes
+
+    return 'done', n_bytes
 
 
 if __name__ == '__main__':
-    
+
     path2read = '/media/rodrigo/Dados_2TB/Imagens/HC_Barretos/Imagens_Clinicas_Pristina_Out_2022/raws_02'
-    
+
+    n_workers = None                                # None for all CPUs
+
+    # Temporary files left by an interrupted run
+    for dcm_file_tmp in pathlib.Path(path2read).glob("**/*.dcm.*.tmp"):
+        dcm_file_tmp.unlink()
+
     dcm_files = [str(item) for item in pathlib.Path(path2read).glob("**/*.dcm")]
-    
-    for dcm_file in tqdm(dcm_files):
-        
-        proj_header = pydicom.dcmread(dcm_file, force=True)
-        proj  = proj_header.pixel_array
-        
-        writeDecompressedDicom(dcm_file, proj, proj_header)
+
+    start = time.time()
+
+    counts = {'done': 0, 'skipped': 0, 'failed': 0}
+    n_bytes_done = 0
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+
+        for dcm_file, (state, n_bytes) in tqdm(zip(dcm_files, executor.map(decompress_file, dcm_files, chunksize=16)), total=len(dcm_files)):
+
+            if state.startswith('failed'):
+                print("{} {}".format(dcm_file, state))
+                state = 'failed'
+
+            counts[state] += 1
+
+            if state == 'done':
+                n_bytes_done += n_bytes
+
+    elapsed = max(time.time() - start, 1e-6)
+
+    print("Decompressed {done}, skipped {skipped} (already uncompressed), failed {failed} files".format(**counts))
+    print("{:.1f}s, {:.1f} files/s, {:.1f} MB/s (compressed input)".format(elapsed, counts['done'] / elapsed, n_bytes_done / elapsed / 2**20))
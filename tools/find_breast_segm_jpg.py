@@ -3,12 +3,12 @@ import os
 import pathlib
 import pandas as pd
 import shutil
-import pydicom
 
 from tqdm import tqdm
 
 sys.path.insert(1, '/home/rodrigo/Documents/Rodrigo/Codigos/pyDBT')
 
+from libs.catalog import HeaderCatalog, get_exam_id
 from libs.utilities import filesep
 
 # %%
@@ -27,18 +27,20 @@ if __name__ == '__main__':
 
     df = pd.DataFrame(columns=['ID', 'PatientOrientation', 'Laterality', 'ViewPosition'])
 
-    for patient_case in tqdm(patient_cases):
+    exams_per_case = [[str(item) for item in pathlib.Path(patient_case).glob("*") if
+                       pathlib.Path(item).is_dir() and 'density' not in str(item) and 'calcifications' not in str(item)] for patient_case in patient_cases]
 
-        exams = [str(item) for item in pathlib.Path(patient_case).glob("*") if
-                 pathlib.Path(item).is_dir() and 'density' not in str(item) and 'calcifications' not in str(item)]
+    # Header fields of all exams, parsed once (then only new or changed files)
+    catalog = HeaderCatalog('data/catalog.sqlite')
+    catalog.update([exam for exams in exams_per_case for exam in exams])
 
-        for exam in exams:
+    for exams in tqdm(exams_per_case):
 
-            dcmFiles = [str(item) for item in pathlib.Path(exam).glob("*.dcm")]
+        for exam in exams:
 
-            dcmH = pydicom.dcmread(dcmFiles[0])
+            dcmH = catalog.headers(get_exam_id(exam))[0]
 
-            if dcmH.ViewPosition == 'MLO':
+            if dcmH['ViewPosition'] == 'MLO':
 
                 path2write_patient_name_density = "{}{}{}/Result_Images/".format(pathPatientDensity, filesep(),
                                                                   "/".join(exam.split('/')[-2:]))
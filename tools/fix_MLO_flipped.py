@@ -10,6 +10,7 @@ from tqdm import tqdm
 
 sys.path.insert(1, '/home/rodrigo/Documents/Rodrigo/Codigos/pyDBT')
 
+from libs.catalog import HeaderCatalog, get_exam_id
 from libs.utilities import makedir, filesep, writeDicom
 from libs.methods import get_XYZ_calc_positions, get_breast_masks, process_dense_mask, \
     get_calc_cluster, get_XYZ_cluster_positions, get_projection_cluster_mask, \
@@ -29,21 +30,23 @@ if __name__ == '__main__':
 
     df = pd.DataFrame(columns=['ID', 'PatientOrientation', 'Laterality', 'ViewPosition'])
 
-    for patient_case in tqdm(patient_cases):
+    exams_per_case = [[str(item) for item in pathlib.Path(patient_case).glob("*") if
+                       pathlib.Path(item).is_dir() and 'density' not in str(item) and 'calcifications' not in str(item)] for patient_case in patient_cases]
 
-        exams = [str(item) for item in pathlib.Path(patient_case).glob("*") if
-                 pathlib.Path(item).is_dir() and 'density' not in str(item) and 'calcifications' not in str(item)]
+    # Header fields of all exams, parsed once (then only new or changed files)
+    catalog = HeaderCatalog('data/catalog.sqlite')
+    catalog.update([exam for exams in exams_per_case for exam in exams])
 
-        for exam in exams:
+    for exams in tqdm(exams_per_case):
 
-            dcmFiles = [str(item) for item in pathlib.Path(exam).glob("*.dcm")]
+        for exam in exams:
 
-            dcmH = pydicom.dcmread(dcmFiles[0])
+            dcmH = catalog.headers(get_exam_id(exam))[0]
 
             new_entry = {
-                'PatientOrientation': dcmH.PatientOrientation,
-                'Laterality': dcmH.Laterality,
-                'ViewPosition': dcmH.ViewPosition,
+                'PatientOrientation': dcmH['PatientOrientation'],
+                'Laterality': dcmH['Laterality'],
+                'ViewPosition': dcmH['ViewPosition'],
                 'ID': "_".join(exam.split('/')[-2:])}
 
             df = df.append(new_entry, ignore_index=True)
@@ -27,14 +27,13 @@ Created on Tue Mar 15 11:06:34 2022
 import pathlib
 import numpy as np
 import pydicom
-import subprocess
 import matplotlib.pyplot as plt
 import sys
 
 sys.path.insert(1, '/home/rodrigo/Documents/rodrigo/codes/pyDBT')
 sys.path.insert(1, '../')
 
-from libs.methods import get_breast_masks
+from libs.methods import get_breast_masks, run_libra
     
 from libs.utilities import makedir, filesep, writeDicomFromTemplate
 
@@ -64,6 +63,7 @@ flags['print_debug'] = True
 flags['vct_image'] = False
 flags['delete_masks_folder'] = False
 flags['force_libra'] = False
+flags['libra_batch'] = True
 
 
 for exam in files:
@@ -92,6 +92,8 @@ for exam in files:
     w_min, w_max = res[0][0], res[0][-1]
     
     path2write_patient_name = "{}{}{}".format(pathPatientDensity , filesep(), "/".join(exam.split('/')[-3:]))
+    
+    libra_jobs = []
         
     for idX, dcmFile in enumerate(dcmFiles):
         
@@ -134,12 +136,11 @@ for exam in files:
                                     dcmData_crop,
                                     dcmH)
                    
-            # Run LIBRA again
-            subprocess.run("{} -r \"addpath(genpath('{}'));addpath('{}');run('libra_startup');libra('{}', '{}', 1);exit\" -nodisplay -nosplash".format(pathMatlab,
-                                                          pathLibra,
-                                                          pathAuxLibs,
-                                                          dcmFile_tmp,
-                                                          path2write_patient_name), shell=True)
+            libra_jobs.append((dcmFile_tmp, path2write_patient_name))
+    
+    # Run LIBRA again (one MATLAB session per exam)
+    run_libra(libra_jobs, pathLibra, pathMatlab, pathAuxLibs, flags)
+
             
         
         
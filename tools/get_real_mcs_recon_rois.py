@@ -11,7 +11,6 @@ To remove:
 
 import sys
 import numpy as np
-import pydicom
 import pathlib
 import matplotlib.pyplot as plt
 
@@ -20,23 +19,16 @@ from scipy.io import loadmat
 sys.path.insert(1, '../')
 
 from libs.utilities import makedir, filesep, writeDicom
+from libs.projection_stack import ProjectionStack
 
 
 def readDicom(path):
     
     dcmFiles = [str(item) for item in pathlib.Path(path).glob("*.dcm")]
     
-    # Test if list is empty
-    if not dcmFiles:    
-        raise ValueError('No DICOM files found in the specified path.')
+    stack = ProjectionStack(dcmFiles, index=lambda f: int(f.split('/')[-1].split('.')[0]))
     
-    slices = [None] * len(dcmFiles)
-    
-    for f in dcmFiles:
-        nSlice = int(f.split('/')[-1].split('.')[0])
-        slices[nSlice] = pydicom.dcmread(f, force=True).pixel_array
-    
-    slices = np.stack(slices, axis=-1).astype(np.uint16)
+    slices = stack.to_array(np.uint16)
     
     return slices
 
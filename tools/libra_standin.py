@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:02:15 2026
+
+Stand-in for MATLAB + LIBRA. It accepts the same command line that
+run_libra (libs/methods.py) sends to MATLAB, i.e.,
+
+    matlab -r "...;libra_batch('list.txt');exit" -nodisplay -nosplash
+    matlab -r "...;libra('1.dcm', 'out', 1);exit" -nodisplay -nosplash
+
+and writes out/Result_Images/Masks_<name>.mat with the same 'res'
+struct (DenseMask and BreastMask) LIBRA writes. The masks are simple
+thresholds, it is only meant to check the pipeline without MATLAB:
+
+    pathMatlab = 'python3 tools/libra_standin.py'
+
+"""
+
+import re
+import sys
+import pathlib
+import pydicom
+import numpy as np
+
+from scipy.io import savemat
+
+
+def libra(dcmFile, path2write):
+    
+    dcmData = pydicom.dcmread(dcmFile).pixel_array.astype('float32')
+    
+    # Breast attenuates, so it is darker than the background
+    mask_breast = dcmData < dcmData.mean()
+    mask_dense = mask_breast & (dcmData < np.median(dcmData[mask_breast])) if mask_breast.any() else mask_breast
+    
+    path2write = pathlib.Path(path2write) / 'Result_Images'
+    path2write.mkdir(parents=True, exist_ok=True)
+    
+    res = {'DenseMask': np.uint8(mask_dense), 'BreastMask': np.uint8(mask_breast)}
+    
+    savemat(str(path2write / 'Masks_{}.mat'.format(pathlib.Path(dcmFile).stem)), {'res': res})
+
+
+if __name__ == '__main__':
+    
+    cmd = sys.argv[sys.argv.index('-r') + 1]
+    
+    for listFile in re.findall(r"libra_batch\('([^']*)'\)", cmd):
+        with open(listFile, 'r') as file:
+            for line in file:
+                if line.strip():
+                    libra(*line.rstrip('\n').split('\t'))
+    
+    for dcmFile, path2write in re.findall(r"libra\('([^']*)',\s*'([^']*)',\s*1\)", cmd):
+        libra(dcmFile, path2write)
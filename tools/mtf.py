@@ -6,11 +6,16 @@ Created on Thu Jun  9 15:56:42 2022
 @author: Rodrigo
 """
 
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 
 from scipy.interpolate import interp1d
 
+sys.path.insert(1, '../')
+
+from libs.mtf import MTFModel
+
 def array2D_from_array1D(y, kind='cubic'):
     '''
     Description: Create 2D matrix from 1D vector through interpolation.
@@ -61,7 +66,10 @@ mtf = np.array((1, 0.95, 0.90, 0.85, 0.80, 0.75, 0.71, 0.67, 0.63, 0.59, 0.55, 0
 
 mtf_2d, f = array2D_from_array1D(np.hstack((mtf[-1:0:-1],mtf)))
 
-np.save("../data/mtf_function_hologic3d_fourier.npy", f)
+# Tabulated MTF, evaluated the same way as f (cubic spline)
+model = MTFModel(np.arange(mtf.size), mtf, 'cubic', vendor='Hologic', pitch=0.140)
+
+model.save("../data/mtf_function_hologic3d_fourier.npz")
 
 
 
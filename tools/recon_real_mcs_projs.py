@@ -8,7 +8,6 @@ Created on Mon Jun 27 13:42:15 2022
 
 import sys
 import numpy as np
-import pydicom
 import pathlib
 import matplotlib.pyplot as plt
 
@@ -18,8 +17,9 @@ sys.path.insert(1, '../')
 sys.path.insert(1, '/home/rodrigo/Documents/Rodrigo/Codigos/pyDBT')
 
 from libs.utilities import makedir, filesep, writeDicom
+from libs.projectors import get_projector, select_projector
+from libs.projection_stack import ProjectionStack
 
-from pydbt.functions.projection_operators import backprojectionDDb_cuda
 from pydbt.parameters.parameterSettings import geometry_settings
 from pydbt.functions.initialConfig import initialConfig
 from pydbt.functions.dataPreProcess import dataPreProcess
@@ -28,21 +28,14 @@ def readDicom(path, geo):
     
     dcmFiles = [str(item) for item in pathlib.Path(path).glob("*.dcm")]
     
-    # Test if list is empty
-    if not dcmFiles:    
-        raise ValueError('No DICOM files found in the specified path.')
+    stack = ProjectionStack(dcmFiles, index=lambda f: int(f.split('/')[-1].split('_')[1]) - 1)
     
-    proj = [None] * geo.nProj
-    proj_header = [None] * geo.nProj
+    if len(stack) != geo.nProj:
+        raise ValueError('Expected {} projections, found {}.'.format(geo.nProj, len(stack)))
     
-    for f in dcmFiles:
-        nProj = int(f.split('/')[-1].split('_')[1]) - 1
-        proj_header[nProj] = pydicom.dcmread(f)
-        proj[nProj]  = proj_header[nProj].pixel_array
+    proj = stack.to_array(np.uint16)
     
-    proj = np.stack(proj, axis=-1).astype(np.uint16)
-    
-    return proj, proj_header
+    return proj, stack.headers
 
 def recon_exam(geo, patient_case): 
     
@@ -85,7 +78,7 @@ def recon_exam(geo, patient_case):
         geo.nv = proj.shape[0]      # number of pixels (rows)
         geo.nz = np.ceil(np.float32(dcmH[0].BodyPartThickness)/geo.dz).astype(int)
         
-        vol = backprojectionDDb_cuda(np.float64(proj), geo, -1, libFiles)
+        vol = projector.backproject(proj, geo)
         
         # vol = (vol - vol.min()) / (vol.max() - vol.min()) + 1e-5
         
@@ -124,8 +117,13 @@ if __name__ == '__main__':
     patient_cases = patient_cases.split('\n')
     
 
-    # Call function for initial configurations
-    libFiles = initialConfig(buildDir=pathBuildDirpyDBT, createOutFolder=False)
+    # 'pydbt' (GPU), 'numpy' (CPU) or 'auto' (pydbt if there is a GPU)
+    projector_name = select_projector('pydbt', pathBuildDirpyDBT)
+    
+    # Call function for initial configurations, only pyDBT needs them
+    libFiles = initialConfig(buildDir=pathBuildDirpyDBT, createOutFolder=False) if projector_name == 'pydbt' else None
+    
+    projector = get_projector(projector_name, libFiles)
     
     # Create a DBT geometry  
     geo = geometry_settings()
@@ -8,9 +8,8 @@ Created on Mon Mar 28 12:37:32 2022
 
 import sys
 import numpy as np
-import pydicom
 import pathlib
-import pandas as pd
+import traceback
 import matplotlib.pyplot as plt
 
 from scipy.io import loadmat
@@ -18,9 +17,11 @@ from scipy.io import loadmat
 sys.path.insert(1, '../')
 sys.path.insert(1, '/home/rodrigo/Documents/Rodrigo/Codigos/pyDBT')
 
-from libs.utilities import makedir, filesep, writeDicom
+from libs.jobstore import JobStore
+from libs.utilities import makedir, filesep, writeDicom, readMultiFrameDicom
+from libs.projectors import get_projector, select_projector
+from libs.projection_stack import ProjectionStack
 
-from pydbt.functions.projection_operators import backprojectionDDb_cuda
 from pydbt.parameters.parameterSettings import geometry_settings
 from pydbt.functions.initialConfig import initialConfig
 from pydbt.functions.dataPreProcess import dataPreProcess
@@ -35,6 +36,9 @@ if __name__ == '__main__':
     pathPatientDensity          = pathPatientCases + '/density'
     pathPatientCalcs            = pathPatientCases + '/calcifications'
 
+    retry_failed = False                            # Run exams that failed before again
+    recover_crashed = True                          # Run exams left running by a crashed run again
+
     contrasts = [0.2]
     for x in range(14):
         contrasts.append(np.round(0.85 * contrasts[x], 3))
@@ -43,20 +47,28 @@ if __name__ == '__main__':
     patient_cases = [str(item) for item in pathlib.Path(pathPatientCalcs).glob("*") if pathlib.Path(item).is_dir()]
     
         
-    # Call function for initial configurations
-    libFiles = initialConfig(buildDir=pathBuildDirpyDBT, createOutFolder=False)
+    # 'pydbt' (GPU), 'numpy' (CPU) or 'auto' (pydbt if there is a GPU)
+    projector_name = select_projector('pydbt', pathBuildDirpyDBT)
+    
+    # Call function for initial configurations, only pyDBT needs them
+    libFiles = initialConfig(buildDir=pathBuildDirpyDBT, createOutFolder=False) if projector_name == 'pydbt' else None
+    
+    projector = get_projector(projector_name, libFiles)
     
     # Create a DBT geometry  
     geo = geometry_settings()
     geo.Hologic()
 
-    file = pathlib.Path('../data/IDs_processed_recon.txt')
-    if file.exists():
-        with file.open('r') as file:
-            lines = file.readlines()
-        ids_processed = [line.strip() for line in lines]
-    else:
-        ids_processed = []
+    store = JobStore('../data/jobs.sqlite')
+
+    # Progress of runs made before the job manifest
+    if not store.ids('recon'):
+        store.import_legacy('recon', '../data/IDs_processed_recon.txt')
+
+    # Exams left running by a crashed run go back to pending. Turn it off
+    # while another run is still working on the same store
+    if recover_crashed:
+        store.reset('recon')
 
     file = pathlib.Path('../data/to_exclude.txt')
     if file.exists():
@@ -66,9 +78,11 @@ if __name__ == '__main__':
     else:
         to_exclude = []
 
-    df = pd.read_csv('../data/status.csv')
-    # Filter cases that have ROIs
-    df = df[~((df['nROIsNoCluster'] == 0) & (df['nROIsCluster'] == 0))]
+    df = store.to_dataframe('insert')
+    # Filter cases that were inserted and have ROIs
+    df = df[(df['state'] == 'done') & ~((df['n_rois_no_cluster'] == 0) & (df['n_rois_cluster'] == 0))]
+
+    store.add(df['exam_id'], 'recon')
 
     for patient_case in patient_cases:
         
@@ -82,116 +96,123 @@ if __name__ == '__main__':
             #     continue
 
             # ID read not in ID to run
-            if current_id not in df['ID'].values or current_id in ids_processed or current_id in to_exclude:
+            if current_id not in df['exam_id'].values or current_id in to_exclude:
                 continue
 
-            print("Processing exam: " + current_id)
+            # Already done or claimed by another run
+            if not store.start(current_id, 'recon', retry_failed=retry_failed):
+                continue
 
-            with open('../data/IDs_processed_recon.txt', 'a') as file:
-                file.write(current_id + '\n')
+            try:
 
-            path2write_patient_name = "{}{}{}".format(pathPatientCalcs , filesep(), "/".join(exam.split('/')[-2:]))
+                print("Processing exam: " + current_id)
 
-            flags = np.load(path2write_patient_name + '{}flags.npy'.format(filesep()), allow_pickle=True)[()]
+                path2write_patient_name = "{}{}{}".format(pathPatientCalcs , filesep(), "/".join(exam.split('/')[-2:]))
 
-            bdyThick = flags['bdyThick']
+                flags = np.load(path2write_patient_name + '{}flags.npy'.format(filesep()), allow_pickle=True)[()]
 
-            nROIsNoCluster = df[df.ID == current_id]['nROIsNoCluster'].iloc[0]
-            nROIsCluster = df[df.ID == current_id]['nROIsCluster'].iloc[0]
+                bdyThick = flags['bdyThick']
 
-            for idc, contrast in enumerate(contrasts):
+                nROIsNoCluster = df[df.exam_id == current_id]['n_rois_no_cluster'].iloc[0]
+                nROIsCluster = df[df.exam_id == current_id]['n_rois_cluster'].iloc[0]
 
-                if idc != 0 and nROIsCluster == 0:
-                    break
+                for idc, contrast in enumerate(contrasts):
 
-                bound_X = flags['bound_X']#np.max((int(np.where(np.sum(mask_breast, axis=0) > 1)[0][0]) - 30, 0))
+                    if idc != 0 and nROIsCluster == 0:
+                        break
 
-                path2write_contrast = "{}{}recon_contrast_{:.3f}_ROI".format(path2write_patient_name , filesep(), contrast)
-                
-                path2write_contrast = "{}{}contrast_{:.3f}".format(path2write_patient_name , filesep(), contrast)
-    
-                dcmFiles = [str(item) for item in pathlib.Path(path2write_contrast).glob("*.dcm")]
+                    bound_X = flags['bound_X']#np.max((int(np.where(np.sum(mask_breast, axis=0) > 1)[0][0]) - 30, 0))
+
+                    path2write_contrast = "{}{}recon_contrast_{:.3f}_ROI".format(path2write_patient_name , filesep(), contrast)
                 
-                dcmData = len(dcmFiles) * [None]
+                    path2write_contrast = "{}{}contrast_{:.3f}".format(path2write_patient_name , filesep(), contrast)
                 
-                for dcmFile in dcmFiles:
+                    # Multi-frame output (one file per contrast)
+                    if pathlib.Path(path2write_contrast + '.dcm').is_file():
                     
-                    dcmH = pydicom.dcmread(str(dcmFile), force=True)
+                        dcmData = readMultiFrameDicom(path2write_contrast + '.dcm')
                     
-                    ind = int(str(dcmFile).split('/')[-1].split('_')[-1].split('.')[0])
+                    else:
+    
+                        dcmFiles = [str(item) for item in pathlib.Path(path2write_contrast).glob("*.dcm")]
                     
-                    dcmData[ind] = dcmH.pixel_array.astype('float32').copy()
-                 
+                        stack = ProjectionStack(dcmFiles, index=lambda dcmFile: int(dcmFile.split('/')[-1].split('_')[-1].split('.')[0]))
                     
-                dcmData = np.stack(dcmData, axis=-1) 
+                        dcmData = stack.to_array('float32')
                        
                 
-                if not flags['right_breast']:
-                    dcmData = np.fliplr(dcmData)
+                    if not flags['right_breast']:
+                        dcmData = np.fliplr(dcmData)
                     
-                if flags['flip_projection_angle']:
-                    dcmData = np.flip(dcmData, axis=-1)
+                    if flags['flip_projection_angle']:
+                        dcmData = np.flip(dcmData, axis=-1)
                  
-                # Crop to save reconstruction time
-                dcmData = dcmData[:,bound_X:,:]
+                    # Crop to save reconstruction time
+                    dcmData = dcmData[:,bound_X:,:]
                 
                 
-                geo.nx = dcmData.shape[1]      # number of voxels (columns)
-                geo.ny = dcmData.shape[0]      # number of voxels (rows)
-                geo.nu = dcmData.shape[1]      # number of pixels (columns)
-                geo.nv = dcmData.shape[0]      # number of pixels (rows)
-                geo.nz = np.ceil(bdyThick/geo.dz).astype(int)
-
-                geo.dy = 0.14
-                geo.dx = 0.14
+                    geo.nx = dcmData.shape[1]      # number of voxels (columns)
+                    geo.ny = dcmData.shape[0]      # number of voxels (rows)
+                    geo.nu = dcmData.shape[1]      # number of pixels (columns)
+                    geo.nv = dcmData.shape[0]      # number of pixels (rows)
+                    geo.nz = np.ceil(bdyThick/geo.dz).astype(int)
+
+                    geo.dy = 0.14
+                    geo.dx = 0.14
                 
-                # dcmData, _ = dataPreProcess(dcmData, geo,  flagCropProj=False)
+                    # dcmData, _ = dataPreProcess(dcmData, geo,  flagCropProj=False)
 
-                geo.detAngle = 0
+                    geo.detAngle = 0
 
-                vol = backprojectionDDb_cuda(np.float64(dcmData), geo, -1, libFiles)
+                    vol = projector.backproject(dcmData, geo)
                 
-                vol[vol < 0 ] = 0
+                    vol[vol < 0 ] = 0
                 
-                vol = (vol / vol.max()) * (2**12-1)
+                    vol = (vol / vol.max()) * (2**12-1)
                 
-                vol = np.uint16(vol)
+                    vol = np.uint16(vol)
                     
                 
-                # The cluster origin is located at the same as the DBT systemes, i.e., right midle. Z is at the half
-                cluster_pixel_size = int(20/0.140)
+                    # The cluster origin is located at the same as the DBT systemes, i.e., right midle. Z is at the half
+                    cluster_pixel_size = int(20/0.140)
 
-                (x_clust, y_clust, z_clust) = flags['calc_coords']
+                    (x_clust, y_clust, z_clust) = flags['calc_coords']
 
-                cluster_flag = flags['cluster_flag']
+                    cluster_flag = flags['cluster_flag']
 
-                for idr in range(len(x_clust)):
+                    for idr in range(len(x_clust)):
 
-                    ind_x = int(x_clust[idr] - (cluster_pixel_size / 2))
-                    ind_y = int(y_clust[idr] - (cluster_pixel_size / 2))
-                    ind_z = z_clust[idr]
-                    # plt.imshow(vol[ind_y:ind_y+cluster_pixel_size,
-                    #                 ind_x:ind_x+cluster_pixel_size,
-                    #                 ind_z], 'gray')
-                    # plt.show()
+                        ind_x = int(x_clust[idr] - (cluster_pixel_size / 2))
+                        ind_y = int(y_clust[idr] - (cluster_pixel_size / 2))
+                        ind_z = z_clust[idr]
+                        # plt.imshow(vol[ind_y:ind_y+cluster_pixel_size,
+                        #                 ind_x:ind_x+cluster_pixel_size,
+                        #                 ind_z], 'gray')
+                        # plt.show()
 
-                    if cluster_flag[idr] == 0 and idc > 0:
-                        continue
+                        if cluster_flag[idr] == 0 and idc > 0:
+                            continue
 
-                    path2write_contrast = "{}{}recon_roi_{:02d}_contrast_{:.3f}_ROI_{}".format(path2write_patient_name ,
-                                                                                               filesep(),
-                                                                                               idr,
-                                                                                               contrast,
-                                                                                               'cluster1' if cluster_flag[idr] else 'cluster0')
+                        path2write_contrast = "{}{}recon_roi_{:02d}_contrast_{:.3f}_ROI_{}".format(path2write_patient_name ,
+                                                                                                   filesep(),
+                                                                                                   idr,
+                                                                                                   contrast,
+                                                                                                   'cluster1' if cluster_flag[idr] else 'cluster0')
 
-                    makedir(path2write_contrast)
+                        makedir(path2write_contrast)
 
-                    for z in range(-7, 8):
+                        for z in range(-7, 8):
 
-                        dcmFile_tmp = path2write_contrast + '{}{}.dcm'.format(filesep(), ind_z + z)
+                            dcmFile_tmp = path2write_contrast + '{}{}.dcm'.format(filesep(), ind_z + z)
 
-                        writeDicom(dcmFile_tmp, np.uint16(vol[ind_y:ind_y+cluster_pixel_size,
-                                                              ind_x:ind_x+cluster_pixel_size,
-                                                              ind_z + z]))
-                
-                
+                            writeDicom(dcmFile_tmp, np.uint16(vol[ind_y:ind_y+cluster_pixel_size,
+                                                                  ind_x:ind_x+cluster_pixel_size,
+                                                                  ind_z + z]))
+
+            except Exception:
+                print("Exam {} failed:".format(current_id))
+                traceback.print_exc()
+                store.fail(current_id, 'recon', traceback.format_exc())
+                continue
+
+            store.done(current_id, 'recon')